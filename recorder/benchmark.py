@@ -0,0 +1,281 @@
+"""
+Benchmarks of the recorder components, meant to be run on the recording machine to choose the settings per deployment.
+
+Usage:
+    python benchmark.py depth [--resolution 640x576] [--frames 300] [--source depth.mp4]
+    python benchmark.py recorder [--duration 10] [--resolutions 720 1440] [--fps 15 30] [--report report.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import itertools
+import psutil
+import numpy as np
+from argparse import ArgumentParser
+from threading import Thread, Event
+from typing import List, Tuple, Optional, Dict
+from kinrec_recorder.writers import open_stream_writer, depth_format_files
+from kinrec_recorder.simulator import synthetic_depth_frames, SimulatorBackend
+from kinrec_recorder.recorder import Kinect, RecorderThread
+
+# Depth modes by name: (WFOV, binned)
+DEPTH_MODES = {"nfov_unbinned": (False, False), "nfov_binned": (False, True), "wfov_unbinned": (True, False),
+               "wfov_binned": (True, True)}
+
+
+def cpu_time() -> float:
+    # Encoders may run in ffmpeg subprocesses, their time is counted after they are waited for
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+def load_depth_frames(path: str, count: int) -> List[np.ndarray]:
+    from videoio import Uint16Reader
+    frames = []
+    for frame in Uint16Reader(path):
+        frames.append(frame)
+        if len(frames) >= count:
+            break
+    return frames
+
+
+def open_depth_scroller(depth_format: str, path: str):
+    """
+    Returns the kinrec_utils reader for the depth file, None if kinrec_utils is not installed
+    """
+    try:
+        from kinrec_utils.reader.videoscroller import Uint16Scroller, Ffv1DepthScroller, DepthChunkScroller
+    except ImportError:
+        return None
+    if depth_format in ["zstd", "lz4"]:
+        return DepthChunkScroller(path, cache_size=1)
+    elif depth_format == "ffv1":
+        return Ffv1DepthScroller(path, cache_size=1)
+    return Uint16Scroller(path, cache_size=1)
+
+
+def benchmark_depth_backend(depth_format: str, frames: List[np.ndarray], fps: float, workdir: str,
+        decode_samples: int = 30, seed: int = 0) -> Dict[str, Optional[float]]:
+    resolution = frames[0].shape[::-1]
+    backend_dir = os.path.join(workdir, depth_format)
+    os.makedirs(backend_dir)
+    start_time, start_cpu = time.perf_counter(), cpu_time()
+    with open_stream_writer("depth", backend_dir, resolution, fps, depth_format=depth_format) as writer:
+        for frame in frames:
+            writer.write(frame)
+    encode_time, encode_cpu = time.perf_counter() - start_time, cpu_time() - start_cpu
+    size = sum(os.path.getsize(os.path.join(backend_dir, x)) for x in depth_format_files[depth_format])
+    results = {"encode_fps": len(frames) / encode_time, "cpu_percent": encode_cpu / encode_time * 100.,
+               "bytes_per_frame": size / len(frames), "decode_ms": None, "lossless": None}
+    scroller = open_depth_scroller(depth_format, os.path.join(backend_dir, depth_format_files[depth_format][0]))
+    if scroller is not None:
+        rng = np.random.default_rng(seed)
+        frame_inds = rng.permutation(len(frames))[:decode_samples]
+        decode_times = []
+        lossless = True
+        for frame_ind in frame_inds:
+            start_time = time.perf_counter()
+            decoded = scroller.get_frame(int(frame_ind))
+            decode_times.append(time.perf_counter() - start_time)
+            lossless = lossless and np.array_equal(decoded, frames[frame_ind])
+        results["decode_ms"] = float(np.median(decode_times)) * 1000.
+        results["lossless"] = lossless
+    return results
+
+
+def run_depth_benchmark(args):
+    resolution = tuple(int(x) for x in args.resolution.split("x"))
+    if args.source is not None:
+        frames = load_depth_frames(args.source, args.frames)
+    else:
+        frames = synthetic_depth_frames(resolution, args.frames)
+    workdir = tempfile.mkdtemp(prefix="kinrec_depth_benchmark_")
+    print(f"Benchmarking {len(frames)} depth frames of resolution {frames[0].shape[1]}x{frames[0].shape[0]}")
+    print(f"{'backend':>8} {'enc. fps':>9} {'CPU %':>7} {'KB/frame':>9} {'decode ms':>10} {'lossless':>9}")
+    try:
+        for depth_format in args.backends:
+            try:
+                res = benchmark_depth_backend(depth_format, frames, args.fps, workdir)
+            except ImportError as e:
+                print(f"{depth_format:>8} skipped: {e}")
+                continue
+            decode_str = "n/a" if res["decode_ms"] is None else f"{res['decode_ms']:.2f}"
+            lossless_str = "n/a" if res["lossless"] is None else str(res["lossless"])
+            print(f"{depth_format:>8} {res['encode_fps']:>9.1f} {res['cpu_percent']:>7.1f} "
+                  f"{res['bytes_per_frame'] / 1024.:>9.1f} {decode_str:>10} {lossless_str:>9}")
+    finally:
+        if args.keep_files:
+            print(f"Encoded files are kept in {workdir}")
+        else:
+            shutil.rmtree(workdir)
+
+
+def mode_supported(resolution: int, wfov: bool, binned: bool, fps: int) -> bool:
+    # The Azure Kinect runs 3072p color and WFOV unbinned depth at 15 FPS at most
+    return fps <= 15 or (resolution != 3072 and (not wfov or binned))
+
+
+class PeakRssSampler(Thread):
+    """
+    Samples the resident memory of the process and its children (encoder processes, ffmpeg) until stopped
+    """
+
+    def __init__(self, period: float = 0.2):
+        super().__init__(daemon=True)
+        self.period = period
+        self.peak_rss = 0
+        self._stop_event = Event()
+
+    def sample(self) -> int:
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return rss
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            self.peak_rss = max(self.peak_rss, self.sample())
+            self._stop_event.wait(self.period)
+
+    def stop(self) -> int:
+        self._stop_event.set()
+        self.join()
+        return self.peak_rss
+
+
+def benchmark_recorder_mode(kinect: Kinect, resolution: int, depth_mode: str, fps: int, duration: float,
+        workdir: str, encoder_mode: str = "thread", depth_format: str = "mp4") -> dict:
+    """
+    Records from the simulated Kinect in the given mode and measures the sustained capture and storage rates
+    """
+    wfov, binned = DEPTH_MODES[depth_mode]
+    kinect.update_params(resolution, wfov, binned, fps)
+    recording_dir = os.path.join(workdir, f"{resolution}p_{depth_mode}_{fps}fps")
+    os.makedirs(recording_dir)
+    kinect.camera_start()
+    recorder = RecorderThread(kinect, recording_dir, duration, encoder_mode=encoder_mode, depth_format=depth_format)
+    rss_sampler = PeakRssSampler()
+    rss_sampler.start()
+    start_time, start_cpu = time.perf_counter(), cpu_time()
+    try:
+        recorder.start_recording()
+        recorder.join()
+    finally:
+        kinect.camera_stop()
+    wall_time, cpu = time.perf_counter() - start_time, cpu_time() - start_cpu
+    peak_rss = rss_sampler.stop()
+    # Written over the whole run, including the flush of the encoders after the capture is over
+    disk_bytes = sum(os.path.getsize(os.path.join(recording_dir, x)) for x in os.listdir(recording_dir))
+    frame_gaps = recorder.frame_gaps
+    sustained_fps = 0.
+    if recorder.frames_recorded > 1:
+        # Rate over the device time of the recorded frames, so that the start and stop moments don't count
+        sustained_fps = (recorder.frames_recorded - 1) * 1e6 / (recorder.last_timestamps[0] -
+                                                                recorder.first_timestamps[0])
+    stage_latency = recorder.stage_latency
+    # Busy time of each stage relative to the run time; encoding runs in parallel, so the stages may sum over 100%
+    stage_busy = {stage: histogram["mean_ms"] * histogram["count"] / 10. / wall_time
+                  for stage, histogram in stage_latency.items()}
+    return {"resolution": resolution, "depth_mode": depth_mode, "fps": fps,
+            "frames_recorded": recorder.frames_recorded, "sustained_fps": sustained_fps,
+            "buffer_overflows": recorder.frame_buffer.overflow_count,
+            "dropped_color": frame_gaps["dropped_color"], "dropped_depth": frame_gaps["dropped_depth"],
+            "cpu_percent": cpu / wall_time * 100., "stage_busy_percent": stage_busy,
+            "stage_max_ms": {stage: histogram["max_ms"] for stage, histogram in stage_latency.items()},
+            "disk_bytes_per_second": disk_bytes / wall_time, "peak_rss_bytes": peak_rss,
+            "exception": None if recorder.exception is None else repr(recorder.exception)}
+
+
+def machine_info() -> dict:
+    return {"platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "memory_bytes": psutil.virtual_memory().total, "python": sys.version.split()[0],
+            "numpy": np.__version__}
+
+
+def run_recorder_benchmark(args):
+    backend = SimulatorBackend(source_dir=args.source, frames_count=args.frames)
+    kinect = Kinect(color_format=args.color_format, backend=backend)
+    # Frames of the default mode opened by Kinect are not benchmarked
+    backend.clear()
+    modes = [(resolution, depth_mode, fps) for resolution, depth_mode, fps in
+             itertools.product(args.resolutions, args.depth_modes, args.fps)
+             if mode_supported(resolution, *DEPTH_MODES[depth_mode], fps)]
+    workdir = tempfile.mkdtemp(prefix="kinrec_recorder_benchmark_")
+    report = {"machine": machine_info(), "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "settings": {"duration": args.duration, "encoder_mode": args.encoder_mode,
+                           "color_format": args.color_format, "depth_format": args.depth_format,
+                           "source": args.source}, "results": []}
+    print(f"Benchmarking {len(modes)} modes, {args.duration:.0f} seconds each")
+    print(f"{'color':>6} {'depth mode':>14} {'fps':>4} {'sust. fps':>10} {'dropped':>8} {'CPU %':>7} "
+          f"{'enc. busy % (c/d)':>18} {'MB/s':>7} {'peak RSS MB':>12}")
+    try:
+        for resolution, depth_mode, fps in modes:
+            res = benchmark_recorder_mode(kinect, resolution, depth_mode, fps, args.duration, workdir,
+                                          args.encoder_mode, args.depth_format)
+            report["results"].append(res)
+            dropped = res["buffer_overflows"] + max(res["dropped_color"], res["dropped_depth"])
+            stage_busy = res["stage_busy_percent"]
+            print(f"{resolution:>5}p {depth_mode:>14} {fps:>4} {res['sustained_fps']:>10.2f} {dropped:>8} "
+                  f"{res['cpu_percent']:>7.1f} {stage_busy['color_encode']:>8.1f}/{stage_busy['depth_encode']:<9.1f} "
+                  f"{res['disk_bytes_per_second'] / 2 ** 20:>7.1f} {res['peak_rss_bytes'] / 2 ** 20:>12.0f}")
+            if res["exception"] is not None:
+                print(f"    recording stopped with {res['exception']}")
+            if not args.keep_files:
+                shutil.rmtree(os.path.join(workdir, f"{resolution}p_{depth_mode}_{fps}fps"))
+            # Frames of the finished mode are not needed anymore
+            backend.clear()
+    finally:
+        if kinect.initialized:
+            kinect.close()
+        if args.keep_files:
+            print(f"Recordings are kept in {workdir}")
+        else:
+            shutil.rmtree(workdir)
+    if args.report is not None:
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=1)
+        print(f"Report is written to {args.report}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Kinect recorder benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    depth_parser = subparsers.add_parser("depth", help="Compare lossless depth storage backends")
+    depth_parser.add_argument("--backends", nargs="+", choices=list(depth_format_files.keys()),
+                              default=list(depth_format_files.keys()))
+    depth_parser.add_argument("--resolution", default="640x576", help="Resolution of the synthetic frames")
+    depth_parser.add_argument("--frames", type=int, default=300, help="Number of frames to encode")
+    depth_parser.add_argument("--fps", type=float, default=30.)
+    depth_parser.add_argument("--source", default=None, help="Take the frames from an existing depth.mp4 recording "
+                                                             "instead of generating them")
+    depth_parser.add_argument("--keep_files", action="store_true", help="Do not delete the encoded files")
+    depth_parser.set_defaults(func=run_depth_benchmark)
+    recorder_parser = subparsers.add_parser("recorder", help="Measure the sustained recording capacity per camera mode "
+                                                             "with a simulated Kinect")
+    recorder_parser.add_argument("--resolutions", nargs="+", type=int, choices=list(Kinect._color_resolutions_dict),
+                                 default=list(Kinect._color_resolutions_dict))
+    recorder_parser.add_argument("--depth_modes", nargs="+", choices=list(DEPTH_MODES), default=list(DEPTH_MODES))
+    recorder_parser.add_argument("--fps", nargs="+", type=int, choices=[5, 15, 30], default=[5, 15, 30])
+    recorder_parser.add_argument("--duration", type=float, default=10., help="Recording length per mode, seconds")
+    recorder_parser.add_argument("--encoder_mode", choices=["thread", "process"], default="thread")
+    recorder_parser.add_argument("--color_format", choices=["bgra", "mjpeg"], default="bgra")
+    recorder_parser.add_argument("--depth_format", choices=list(depth_format_files.keys()), default="mp4")
+    recorder_parser.add_argument("--frames", type=int, default=30, help="Number of distinct simulated frames")
+    recorder_parser.add_argument("--source", default=None, help="Replay the frames of an existing recording folder "
+                                                                "instead of generating them")
+    recorder_parser.add_argument("--report", default=None, help="Path to write the JSON report to")
+    recorder_parser.add_argument("--keep_files", action="store_true", help="Do not delete the recordings")
+    recorder_parser.set_defaults(func=run_recorder_benchmark)
+
+    args = parser.parse_args()
+    args.func(args)
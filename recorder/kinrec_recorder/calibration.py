@@ -0,0 +1,79 @@
+import os
+import json
+import shutil
+import logging
+import numpy as np
+from typing import Optional
+
+logger = logging.getLogger("KR.calibration")
+
+
+class CalibrationCache:
+    """
+    On-disk cache of the Kinect calibrations and depth-to-pointcloud maps, keyed by the Kinect serial number and
+    the camera mode. The factory calibration of a device doesn't change, so it is queried from the SDK only once.
+    Cached depth2pc maps are stored in the format of the recording "depth2pc_map.npz" and linked into the recordings.
+    """
+    version = 1
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _depth_mode(params: dict) -> str:
+        return f"{'wfov' if params['wfov'] else 'nfov'}_{'binned' if params['binned'] else 'unbinned'}"
+
+    def calibration_path(self, serial: str, params: dict) -> str:
+        # Color intrinsics depend on the color resolution, depth ones on the depth mode
+        return os.path.join(self.cache_dir, f"{serial}_{params['resolution']}p_{self._depth_mode(params)}.json")
+
+    def depth2pc_map_path(self, serial: str, params: dict) -> str:
+        return os.path.join(self.cache_dir, f"{serial}_{self._depth_mode(params)}_depth2pc_map.npz")
+
+    def load_calibration(self, serial: str, params: dict) -> Optional[dict]:
+        """
+        Returns the cached calibration dict (see Kinect.calibration_dict) with the current params, None if not cached
+        """
+        path = self.calibration_path(serial, params)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path) as calibration_file:
+                cached = json.load(calibration_file)
+        except json.JSONDecodeError as e:
+            logger.warning(f"Failed to read the cached calibration {path}: {e}")
+            return None
+        if cached.get("version") != self.version:
+            return None
+        calibration = cached["calibration"]
+        # Frame rate and sync settings are not a part of the calibration
+        calibration["params"] = dict(params)
+        return calibration
+
+    def save_calibration(self, serial: str, params: dict, calibration: dict):
+        path = self.calibration_path(serial, params)
+        with open(path + ".tmp", "w") as calibration_file:
+            json.dump({"version": self.version, "calibration": calibration}, calibration_file, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def has_depth2pc_map(self, serial: str, params: dict) -> bool:
+        return os.path.isfile(self.depth2pc_map_path(serial, params))
+
+    def save_depth2pc_map(self, serial: str, params: dict, depth2pc_map: np.ndarray):
+        path = self.depth2pc_map_path(serial, params)
+        # np.savez_compressed appends .npz to the names without it
+        tmp_path = path[:-len(".npz")] + ".tmp.npz"
+        np.savez_compressed(tmp_path, **{serial: depth2pc_map})
+        os.replace(tmp_path, path)
+
+    def link_depth2pc_map(self, serial: str, params: dict, target_path: str):
+        """
+        Places the cached depth2pc map at target_path as a hard link, or as a copy if linking is not possible
+        """
+        path = self.depth2pc_map_path(serial, params)
+        try:
+            os.link(path, target_path)
+        except OSError as e:
+            logger.info(f"Cannot link the cached depth2pc map ({e}), copying it")
+            shutil.copyfile(path, target_path)
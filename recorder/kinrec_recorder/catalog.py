@@ -0,0 +1,140 @@
+import os
+import json
+import logging
+from typing import Dict, List, Optional
+from .writers import recording_stream_files
+
+logger = logging.getLogger("KR.catalog")
+
+# Keys of the local metadata.json reported in the recordings list
+LISTED_METADATA_KEYS = ["id", "name", "duration", "server_time", "kinect_id", "participating_kinects",
+                        "kinect_calibration"]
+
+
+def recording_files(metadata: dict) -> List[str]:
+    """
+    Data files of the recording (metadata.json excluded), recordings without "color_format" are mpeg2,
+    without "depth_format" are mp4.
+    Timestamps of the recordings made before the binary log was introduced are in "times.json"
+    """
+    return recording_stream_files(metadata.get("color_format", "mpeg2"), metadata.get("depth_format", "mp4")) + \
+        [metadata.get("timestamps_file", "times.json"), "depth2pc_map.npz"]
+
+
+class RecordingCatalog:
+    """
+    Persistent index of the recordings in the recordings folder, so that listing them doesn't require loading
+    every metadata.json and checking every file.
+    The catalog is a JSON-lines log next to the recordings: each line either sets the entry of a recording folder
+    or removes it, the last line of a folder wins. The log is compacted when loaded.
+    Entries are revalidated with the modification time of the recording folders, which changes whenever a file
+    is added to or removed from the folder, so only the changed folders are rescanned.
+    Folders of the unfinished recordings are kept with no metadata until their metadata.json appears.
+    Files rewritten in place don't change the folder mtime, so the listed file sizes are not revalidated then;
+    recordings are not modified after their metadata.json is written, call update() if one is.
+    """
+    catalog_filename = "catalog.jsonl"
+
+    def __init__(self, recordings_dir: str):
+        self.recordings_dir = recordings_dir
+        self.catalog_path = os.path.join(recordings_dir, self.catalog_filename)
+        # Folder name -> {"mtime_ns": folder modification time, "metadata": listed metadata or None}
+        self._entries: Dict[str, dict] = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.catalog_path):
+            return
+        lines_count = 0
+        with open(self.catalog_path) as catalog_file:
+            for line in catalog_file:
+                lines_count += 1
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line may be cut if the recorder was killed while appending
+                    logger.warning(f"Skipping a corrupted catalog line {lines_count}")
+                    continue
+                if record.get("removed", False):
+                    self._entries.pop(record["dirname"], None)
+                else:
+                    self._entries[record["dirname"]] = {"mtime_ns": record["mtime_ns"], "metadata": record["metadata"]}
+        if lines_count > len(self._entries):
+            self._compact()
+
+    def _compact(self):
+        tmp_path = self.catalog_path + ".tmp"
+        with open(tmp_path, "w") as catalog_file:
+            for dirname, entry in self._entries.items():
+                catalog_file.write(json.dumps({"dirname": dirname, **entry}) + "\n")
+        os.replace(tmp_path, self.catalog_path)
+
+    def _append(self, record: dict):
+        with open(self.catalog_path, "a") as catalog_file:
+            catalog_file.write(json.dumps(record) + "\n")
+
+    def _scan(self, dirname: str) -> Optional[dict]:
+        """
+        Reads the listed metadata of the recording folder, None if the recording is not complete
+        """
+        dirpath = os.path.join(self.recordings_dir, dirname)
+        metadata_path = os.path.join(dirpath, "metadata.json")
+        if not os.path.exists(metadata_path):
+            return None
+        try:
+            with open(metadata_path) as metadata_file:
+                local_metadata = json.load(metadata_file)
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to read {metadata_path}: {e}")
+            return None
+        files = recording_files(local_metadata)
+        if not all(os.path.exists(os.path.join(dirpath, x)) for x in files):
+            return None
+        metadata = {k: local_metadata[k] for k in LISTED_METADATA_KEYS}
+        metadata["color_format"] = local_metadata.get("color_format", "mpeg2")
+        metadata["depth_format"] = local_metadata.get("depth_format", "mp4")
+        if "start_params" in local_metadata:
+            metadata["start_params"] = local_metadata["start_params"]
+        # Sizes of the separate files let the server resume the interrupted transfers
+        metadata["files"] = {filename: os.path.getsize(os.path.join(dirpath, filename)) for filename in files}
+        metadata["size"] = sum(metadata["files"].values())
+        return metadata
+
+    def update(self, dirname: str):
+        """
+        Rescans the recording folder, called when the recording is finalized
+        """
+        mtime_ns = os.stat(os.path.join(self.recordings_dir, dirname)).st_mtime_ns
+        entry = {"mtime_ns": mtime_ns, "metadata": self._scan(dirname)}
+        self._entries[dirname] = entry
+        self._append({"dirname": dirname, **entry})
+
+    def remove(self, dirname: str):
+        if self._entries.pop(dirname, None) is not None:
+            self._append({"dirname": dirname, "removed": True})
+
+    def refresh(self):
+        """
+        Rescans the folders changed since the last refresh and drops the deleted ones
+        """
+        present_dirnames = set()
+        with os.scandir(self.recordings_dir) as dir_entries:
+            for dir_entry in dir_entries:
+                if "_" not in dir_entry.name or not dir_entry.is_dir():
+                    continue
+                present_dirnames.add(dir_entry.name)
+                mtime_ns = dir_entry.stat().st_mtime_ns
+                entry = self._entries.get(dir_entry.name)
+                if entry is None or entry["mtime_ns"] != mtime_ns:
+                    self.update(dir_entry.name)
+        for dirname in list(self._entries.keys()):
+            if dirname not in present_dirnames:
+                self.remove(dirname)
+
+    def recordings(self) -> Dict[str, dict]:
+        """
+        Returns:
+            dict: listed metadata of the complete recordings, by the folder name
+        """
+        self.refresh()
+        return {dirname: entry["metadata"] for dirname, entry in self._entries.items() if entry["metadata"] is not None}
@@ -0,0 +1,41 @@
+import logging
+
+logger = logging.getLogger("KR.devices")
+
+device_backend_names = ["kinz", "simulator"]
+
+
+class KinzBackend:
+    """
+    Azure Kinect devices accessed through the KinZ SDK wrapper
+    """
+    name = "kinz"
+
+    def __init__(self):
+        # The SDK is imported only when the real devices are used, so the recorder can run without it
+        import kinz
+        self._kinz = kinz
+
+    def connected_count(self) -> int:
+        return self._kinz.get_connected_kinects_count()
+
+    def open(self, device_index: int = 0, **start_params):
+        if device_index > 0:
+            # Index is passed only for the additional devices, the first one is opened as before
+            start_params["device_index"] = device_index
+        return self._kinz.Kinect(**start_params)
+
+
+def open_device_backend(name: str = "kinz", **kwargs):
+    """
+    Args:
+        name: "kinz" for the Azure Kinect devices, "simulator" for the simulated ones
+        kwargs: options of the backend, see simulator.SimulatorBackend
+    """
+    if name == "kinz":
+        return KinzBackend()
+    elif name == "simulator":
+        from .simulator import SimulatorBackend
+        return SimulatorBackend(**kwargs)
+    else:
+        raise ValueError(f"Unknown device backend '{name}'")
@@ -0,0 +1,191 @@
+import numpy as np
+import logging
+from threading import Condition
+from multiprocessing.shared_memory import SharedMemory
+from typing import Tuple, Sequence, Optional, Dict
+
+logger = logging.getLogger("KR.framebuffer")
+
+
+class FrameRingBuffer:
+    """
+    Fixed pool of preallocated color/depth/timestamp slots shared between a single producer (capture)
+    and several consumers (encoders). Every consumer reads all the frames in order, a slot is reused only
+    after all consumers have released it.
+    While held, the committed frames are kept from the consumers, so that the buffer acts as a pre-roll ring:
+    the producer drops the oldest frames to make room and finally lets the consumers start from a chosen frame.
+    """
+    TIMESTAMP_FIELDS = ["device_color_usec", "device_depth_usec", "monotonic_color_nsec", "monotonic_depth_nsec",
+                        "system_received_usec", "monotonic_pickup_nsec"]
+
+    class ClosedException(Exception):
+        pass
+
+    def __init__(self, size: int, color_resolution: Tuple[int, int], depth_resolution: Tuple[int, int],
+            consumers: Sequence[str] = ("color", "depth"), shared: bool = False, color_format: str = "bgra"):
+        self.size = size
+        self.color_resolution = color_resolution
+        self.depth_resolution = depth_resolution
+        self.color_format = color_format
+        # If shared, frame slots are placed in shared memory, so that other processes can read them without pickling
+        self._shared_memory: Dict[str, SharedMemory] = {}
+        if color_format == "mjpeg":
+            # Compressed payloads have variable length, 1 byte per pixel is a safe upper bound for MJPEG
+            self.color = self._allocate("color", (size, color_resolution[0] * color_resolution[1]), np.uint8, shared)
+        else:
+            # Color is kept in the native camera layout ("bgra") or as RGB ("rgb")
+            channels = 4 if color_format == "bgra" else 3
+            self.color = self._allocate("color", (size, color_resolution[1], color_resolution[0], channels), np.uint8,
+                                        shared)
+        self.color_lengths = np.zeros(size, dtype=np.int64)
+        self.depth = self._allocate("depth", (size, depth_resolution[1], depth_resolution[0]), np.uint16, shared)
+        self.timestamps = np.zeros((size, len(self.TIMESTAMP_FIELDS)), dtype=np.int64)
+        self._write_index = 0
+        self._read_indices = {name: 0 for name in consumers}
+        self._condition = Condition()
+        self._closed = False
+        self._held = False
+        self.overflow_count = 0
+
+    def _allocate(self, stream: str, shape: Tuple[int, ...], dtype, shared: bool) -> np.ndarray:
+        if not shared:
+            return np.empty(shape, dtype=dtype)
+        shm = SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        self._shared_memory[stream] = shm
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    def shared_spec(self, stream: str) -> Tuple[str, Tuple[int, ...], str]:
+        """
+        Returns (shared memory name, shape, dtype) of the stream slots, used to attach to them from another process
+        """
+        frames = getattr(self, stream)
+        return self._shared_memory[stream].name, frames.shape, frames.dtype.str
+
+    def frame(self, stream: str, slot: int) -> np.ndarray:
+        frames = getattr(self, stream)
+        if stream == "color" and self.color_format == "mjpeg":
+            return frames[slot, :self.color_lengths[slot]]
+        return frames[slot]
+
+    def frame_length(self, stream: str, slot: int) -> Optional[int]:
+        """
+        Returns the payload length for the variable-length slots, None for the fixed ones
+        """
+        if stream == "color" and self.color_format == "mjpeg":
+            return int(self.color_lengths[slot])
+        return None
+
+    @property
+    def shared(self) -> bool:
+        return len(self._shared_memory) > 0
+
+    def free(self):
+        """
+        Releases the shared memory blocks (if any), the buffer cannot be used afterwards
+        """
+        for stream, shm in self._shared_memory.items():
+            setattr(self, stream, None)
+            shm.close()
+            shm.unlink()
+        self._shared_memory = {}
+
+    def acquire_write_slot(self) -> Optional[int]:
+        """
+        Returns the index of a free slot to capture the next frame into, or None if all slots are busy
+        """
+        with self._condition:
+            if self._write_index - min(self._read_indices.values()) >= self.size:
+                return None
+            return self._write_index % self.size
+
+    def commit(self):
+        """
+        Makes the slot obtained with acquire_write_slot visible to the consumers
+        """
+        with self._condition:
+            self._write_index += 1
+            self._condition.notify_all()
+
+    def register_overflow(self):
+        with self._condition:
+            self.overflow_count += 1
+
+    def get(self, consumer: str, timeout: Optional[float] = None) -> Optional[int]:
+        """
+        Waits for the next frame for the given consumer
+        Returns the slot index, or None on timeout; raises ClosedException if the buffer is closed and drained
+        """
+        with self._condition:
+            while self._held or self._read_indices[consumer] >= self._write_index:
+                if self._closed:
+                    raise FrameRingBuffer.ClosedException()
+                if not self._condition.wait(timeout):
+                    return None
+            return self._read_indices[consumer] % self.size
+
+    def release(self, consumer: str):
+        with self._condition:
+            self._read_indices[consumer] += 1
+            self._condition.notify_all()
+
+    def hold(self):
+        """
+        Keeps the committed frames from the consumers until start_from is called
+        """
+        with self._condition:
+            self._held = True
+
+    @property
+    def held(self) -> bool:
+        return self._held
+
+    def held_range(self) -> Tuple[int, int]:
+        """
+        Returns the indices of the oldest kept and the next to be committed frames, frame index i is in slot i % size
+        """
+        with self._condition:
+            return min(self._read_indices.values()), self._write_index
+
+    def discard_oldest(self):
+        """
+        Drops the oldest committed frame while the buffer is held, freeing its slot
+        """
+        with self._condition:
+            assert self._held, "Frames can be discarded only while the buffer is held"
+            for consumer in self._read_indices:
+                self._read_indices[consumer] += 1
+
+    def start_from(self, index: int):
+        """
+        Releases the held buffer, the consumers start reading from the frame with the given index,
+        older kept frames are dropped
+        """
+        with self._condition:
+            for consumer in self._read_indices:
+                self._read_indices[consumer] = max(index, self._read_indices[consumer])
+            self._held = False
+            self._condition.notify_all()
+
+    def close(self):
+        """
+        Signals the consumers that no more frames will be committed, frames of a held buffer are dropped
+        """
+        with self._condition:
+            self._closed = True
+            if self._held:
+                self._held = False
+                for consumer in self._read_indices:
+                    self._read_indices[consumer] = self._write_index
+            self._condition.notify_all()
+
+    @property
+    def fill_level(self) -> int:
+        with self._condition:
+            return self._write_index - min(self._read_indices.values())
+
+    @property
+    def frames_committed(self) -> int:
+        return self._write_index
+
+    def status_dict(self) -> dict:
+        return {"size": self.size, "fill": self.fill_level, "overflows": self.overflow_count}
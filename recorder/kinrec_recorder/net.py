@@ -5,7 +5,11 @@ import asyncio
 import logging
 import json
 import queue
+import socket
+from typing import Optional
+from threading import Thread
 from multiprocessing import Process, Queue as MPQueue
+from .transfer import FileSender, SendFileJob, CancelTransfers
 
 
 logger = logging.getLogger("KR.nethandler")
@@ -13,27 +17,53 @@ logger = logging.getLogger("KR.nethandler")
 
 class NetHandler:
     NET_MESSAGE_MAX_SIZE = 100 * 2 ** 20  # 100 MB
+    SENDFILE_CHUNK_SIZE = 4 * 2 ** 20  # 4 MB
+    SENDFILE_MAX_STREAMS = 3  # files sent at once
     class StopEvent:
         pass
 
     class ConnectedEvent:
         pass
 
-    def __init__(self, server: str = "kinrec.cv:4400", queue_size: int = 100, outqueue_delay=1e-2):
+    def __init__(self, server: str = "kinrec.cv:4400", queue_size: int = 100, outqueue_delay=1e-2, mode="process"):
+        """
+        Args:
+            server: server address and port
+            queue_size: capacity of the incoming and outgoing message queues in the process mode
+            outqueue_delay: polling period of the outgoing queue in the process mode, in seconds
+            mode: "process" runs the websocket client in a child process, messages are pickled through
+                multiprocessing queues; "thread" runs it in an asyncio thread of the recorder process,
+                outgoing messages wake the event loop up immediately and are passed without copies
+        """
+        assert mode in ["process", "thread"], f"Unknown network mode '{mode}'"
         self.serveraddr = server
-        self._in_queue = MPQueue(maxsize=queue_size)
-        self._out_queue = MPQueue(maxsize=queue_size)
+        self.mode = mode
+        if mode == "process":
+            self._in_queue = MPQueue(maxsize=queue_size)
+            self._out_queue = MPQueue(maxsize=queue_size)
+        else:
+            # Filled from the coroutines of the event loop (including the FileSender callback), so it is unbounded
+            # to never block the loop; the main loop drains it
+            self._in_queue = queue.Queue()
+            # asyncio.Queue of the network thread, created in its event loop
+            self._out_queue = None
+        self._event_loop = None
         self._is_active = False
         self._main_active = False
         self._websocket = None
         self.process = None
         self.outqueue_delay = outqueue_delay
+        self._file_sender = None
 
     def start(self):
-        self.process = Process(target=self._main)
-        logger.info("Starting the new process")
+        if self.mode == "process":
+            self.process = Process(target=self._main)
+            logger.info("Starting the new process")
+        else:
+            self.process = Thread(target=self._main, daemon=True)
+            logger.info("Starting the network thread")
         self.process.start()
-        logger.info("Waiting for the new process to connect")
+        logger.info("Waiting for the network loop to connect")
         event = self._in_queue.get()
         if isinstance(event, self.ConnectedEvent):
             self._main_active = True
@@ -43,25 +73,47 @@ class NetHandler:
 
     def close(self):
         logger.info("Sending the stop message to the loop")
-        self._out_queue.put(self.StopEvent())
+        self._put_out(self.StopEvent())
         self._close_root()
 
     def _close_root(self):
         self.process.join()
         logger.info("Closing the pipes (root)")
         self._main_active = False
-        self._in_queue.close()
-        self._out_queue.close()
+        if self.mode == "process":
+            self._in_queue.close()
+            self._out_queue.close()
+
+    def _put_out(self, msg):
+        if self.mode == "process":
+            self._out_queue.put(msg)
+        else:
+            try:
+                self._event_loop.call_soon_threadsafe(self._out_queue.put_nowait, msg)
+            except RuntimeError:
+                # The network loop has already stopped
+                logger.warning(f"Network loop is closed, dropping an outgoing {type(msg).__name__}")
 
     @property
     def active(self) -> bool:
-        return self._main_active
+        # The network process (or thread) may also die without sending the stop message
+        return self._main_active and self.process.is_alive()
 
-    def get(self, wait: bool = False):
+    def get(self, wait: bool = False, timeout: Optional[float] = None):
+        """
+        Returns the next incoming message (dict) or event, None if there is none
+
+        Args:
+            wait: block until a message arrives
+            timeout: maximal time to wait, in seconds, None to wait indefinitely
+        """
         if not wait and self._in_queue.empty():
             return None
         else:
-            msg = self._in_queue.get()
+            try:
+                msg = self._in_queue.get(timeout=timeout)
+            except queue.Empty:
+                return None
             if isinstance(msg, str):
                 msg = json.loads(msg)
             elif isinstance(msg, self.StopEvent):
@@ -69,34 +121,78 @@ class NetHandler:
                 return None
             return msg
 
+    def post(self, event):
+        """
+        Puts a local event into the incoming queue to wake up the consumer waiting in get(), thread-safe
+        """
+        self._in_queue.put(event)
+
     def send(self, data):
+        """
+        Args:
+            data: dict (sent as JSON), str or a binary payload (bytes, bytearray or memoryview); in the thread mode
+                the binary payload is sent without copying and must not be modified afterwards
+        """
         if isinstance(data, dict):
             data = json.dumps(data)
-        self._out_queue.put(data)
+        elif isinstance(data, memoryview) and self.mode == "process":
+            data = data.tobytes()
+        self._put_out(data)
+
+    def send_file(self, path: str, relpath: str, recording_id: int, offset: int = 0, device: int = 0):
+        """
+        Queues the file for the transfer, the file is read and sent by the network process itself.
+        Completion is reported by a SendFileDone object returned from get()
+
+        Args:
+            offset: number of bytes the server already has, only the rest of the file is sent
+            device: index of the Kinect the recording is of
+        """
+        self._put_out(SendFileJob(path=path, relpath=relpath, recording_id=recording_id, offset=offset,
+                                  device=device))
+
+    def cancel_file_transfers(self, device: Optional[int] = None):
+        """
+        Args:
+            device: cancel only the transfers of the recordings of this device, all of them if None
+        """
+        self._put_out(CancelTransfers(device))
 
     def _main(self):
-        asyncio.get_event_loop().run_until_complete(self._loop())
-        logger.info("Child process completed")
+        if self.mode == "process":
+            asyncio.get_event_loop().run_until_complete(self._loop())
+            logger.info("Child process completed")
+        else:
+            asyncio.run(self._loop())
+            logger.info("Network thread completed")
+
+    async def _get_out_msg(self):
+        if self.mode == "thread":
+            return await self._out_queue.get()
+        while self._out_queue.empty():
+            await asyncio.sleep(self.outqueue_delay)
+        return self._out_queue.get()
 
     async def _out_queue_handler(self):
         while self._is_active:
-            if self._out_queue.empty():
-                await asyncio.sleep(self.outqueue_delay)
+            msg = await self._get_out_msg()
+            if isinstance(msg, self.StopEvent):
+                logger.info("Got the Stop message, shutting the loop down")
+                self._is_active = False
+                self._stop_event.set()
+            elif isinstance(msg, SendFileJob):
+                self._file_sender.add(msg)
+            elif isinstance(msg, CancelTransfers):
+                self._file_sender.cancel(msg.device)
             else:
-                msg = self._out_queue.get()
-                if isinstance(msg, self.StopEvent):
-                    logger.info("Got the Stop message, shutting the loop down")
+                try:
+                    await self._websocket.send(msg)
+                except websockets.ConnectionClosed as e:
+                    logger.info(f"Websocket connection is closed: {e}")
+                    logger.info("Shutting the loop down")
+                    self._in_queue.put(self.StopEvent())
                     self._is_active = False
                     self._stop_event.set()
-                else:
-                    try:
-                        await self._websocket.send(msg)
-                    except websockets.ConnectionClosed as e:
-                        logger.info(f"Websocket connection is closed: {e}")
-                        logger.info("Shutting the loop down")
-                        self._in_queue.put(self.StopEvent())
-                        self._is_active = False
-                        self._stop_event.set()
 
     async def _in_queue_handler(self):
         while self._is_active:
@@ -113,11 +209,17 @@ class NetHandler:
                 self._in_queue.put(msg)
 
     async def _loop(self):
+        if self.mode == "thread":
+            self._event_loop = asyncio.get_running_loop()
+            self._out_queue = asyncio.Queue()
         connected = False
         while not connected:
             try:
                 logger.info("Trying to connect WS")
-                self._websocket = await websockets.connect("ws://" + self.serveraddr, max_size=self.NET_MESSAGE_MAX_SIZE)
+                # Write buffer holds a couple of file chunks, so that the socket is never idle during the transfer
+                self._websocket = await websockets.connect("ws://" + self.serveraddr,
+                                                           max_size=self.NET_MESSAGE_MAX_SIZE,
+                                                           write_limit=2 * self.SENDFILE_CHUNK_SIZE)
             except ConnectionRefusedError as e:
                 logger.info("Connection refused, trying again")
                 time.sleep(2)
@@ -131,18 +233,33 @@ class NetHandler:
                 self._stop_event = asyncio.Event()
                 logger.info(f"Connected to {self.serveraddr} successfully")
                 self._in_queue.put(self.ConnectedEvent())
+                self._enlarge_send_buffer()
                 logger.info("Starting the handler loop")
+                self._file_sender = FileSender(self._websocket, self._in_queue.put, self.SENDFILE_CHUNK_SIZE,
+                                               self.SENDFILE_MAX_STREAMS)
                 asyncio.create_task(self._in_queue_handler())
                 asyncio.create_task(self._out_queue_handler())
+                file_sender_task = asyncio.create_task(self._file_sender.run())
                 await self._stop_event.wait()
+                file_sender_task.cancel()
                 logger.info("Waiting for WS to close")
                 await self._websocket.close()
-        logger.info("Closing the pipes (child)")
-        self._in_queue.close()
-        while not self._out_queue.empty():
-            try:
-                self._out_queue.get_nowait()
-            except queue.Empty:
-                pass
-        self._out_queue.close()
-        logger.info("Child process mainloop completed")
+        if self.mode == "process":
+            logger.info("Closing the pipes (child)")
+            self._in_queue.close()
+            while not self._out_queue.empty():
+                try:
+                    self._out_queue.get_nowait()
+                except queue.Empty:
+                    pass
+            self._out_queue.close()
+        logger.info("Network mainloop completed")
+
+    def _enlarge_send_buffer(self):
+        sock = self._websocket.transport.get_extra_info("socket")
+        if sock is None:
+            return
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SENDFILE_CHUNK_SIZE)
+        except OSError as e:
+            logger.warning(f"Failed to enlarge the socket send buffer: {e}")
@@ -0,0 +1,163 @@
+import io
+import time
+import struct
+import logging
+import numpy as np
+from PIL import Image
+from threading import Thread, Condition
+from typing import Optional, Union, Tuple, Callable
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+logger = logging.getLogger("KR.preview")
+
+
+# Binary preview_frame reply: header followed by the JPEG color and the (optional) PNG depth images.
+# Header fields: magic, version, flags (bit 0 - depth is present), device index (reserved before, always 0 then),
+# color and depth timestamps (int64), color and depth image sizes (uint32)
+PREVIEW_HEADER_FORMAT = "<4sBBHqqII"
+PREVIEW_MAGIC = b"KRPV"
+PREVIEW_VERSION = 1
+PREVIEW_FLAG_DEPTH = 1
+
+
+def image_encode(image: np.ndarray, format: str = "jpeg", quality: int = 75) -> bytes:
+    fp = io.BytesIO()
+    if format == "jpeg":
+        Image.fromarray(image).save(fp, format, quality=quality)
+    else:
+        Image.fromarray(image).save(fp, format)
+    return fp.getvalue()
+
+
+def pack_preview_frame(color_ts: int, color_data: bytes, depth_ts: Optional[int] = None,
+        depth_data: Optional[bytes] = None, device: int = 0) -> bytes:
+    flags = 0 if depth_data is None else PREVIEW_FLAG_DEPTH
+    depth_data = b"" if depth_data is None else depth_data
+    header = struct.pack(PREVIEW_HEADER_FORMAT, PREVIEW_MAGIC, PREVIEW_VERSION, flags, device, color_ts,
+                         0 if depth_ts is None else depth_ts, len(color_data), len(depth_data))
+    return b"".join([header, color_data, depth_data])
+
+
+def area_downscale(img: np.ndarray, scale: Union[float, int]) -> np.ndarray:
+    """
+    Downscales the image by averaging over the pixel areas, with OpenCV if available.
+    Without OpenCV, integer scales are averaged over scale x scale blocks, non-integer ones are resized by PIL.
+    """
+    if scale == 1:
+        return np.ascontiguousarray(img)
+    height, width = img.shape[:2]
+    target_size = (max(int(round(width / scale)), 1), max(int(round(height / scale)), 1))
+    if cv2 is not None:
+        return cv2.resize(np.ascontiguousarray(img), target_size, interpolation=cv2.INTER_AREA)
+    if isinstance(scale, int):
+        height, width = height // scale * scale, width // scale * scale
+        blocks = img[:height, :width].reshape(height // scale, scale, width // scale, scale, *img.shape[2:])
+        return blocks.mean(axis=(1, 3), dtype=np.float32).astype(img.dtype)
+    return np.array(Image.fromarray(np.ascontiguousarray(img)).resize(target_size, Image.BOX))
+
+
+class PreviewWorker(Thread):
+    """
+    Produces encoded preview frames in the background while the preview is active,
+    so that the main loop only picks up the latest ready frame and is never blocked by the frame processing
+    """
+
+    def __init__(self, kinect, max_fps: float = 15., frame_callback: Optional[Callable[[], None]] = None,
+            device: int = 0):
+        """
+        Args:
+            kinect: Kinect to take the frames from
+            max_fps: limit of the frame production rate
+            frame_callback: called from the worker thread after every produced frame
+            device: index of the Kinect in the recorder, written to the frame packets
+        """
+        super().__init__(daemon=True)
+        self.kinect = kinect
+        self.device = device
+        self.frame_callback = frame_callback
+        self.min_period = 1. / max_fps
+        self.active = False
+        self._condition = Condition()
+        self._params: Optional[Tuple[Union[float, int], Optional[int], int]] = None
+        self._latest: Optional[dict] = None
+        # Params the latest frame was made with
+        self._latest_params: Optional[Tuple[Union[float, int], Optional[int], int]] = None
+        self._latest_ind = 0
+        self._taken_ind = 0
+
+    def request(self, color_scale: Union[float, int], depth_scale: Optional[int], jpeg_quality: int = 75):
+        """
+        Sets the scales and the color quality of the frames to produce, frames are produced only after the first request
+        """
+        with self._condition:
+            self._params = (color_scale, depth_scale, jpeg_quality)
+            self._condition.notify_all()
+
+    def take_latest(self) -> Optional[dict]:
+        """
+        Returns the latest frame produced since the previous call, or None if there is no new frame yet.
+        Frames made before the params were changed by request() are not returned.
+        The frame dict contains either the binary reply "packet" or the "exception" raised while getting the frame.
+        """
+        with self._condition:
+            if self._latest_ind == self._taken_ind or self._latest_params != self._params:
+                return None
+            self._taken_ind = self._latest_ind
+            return self._latest
+
+    def make_frame(self, color_scale: Union[float, int], depth_scale: Optional[int], jpeg_quality: int = 75) -> dict:
+        # Frames are borrowed from the SDK, only the downscaled versions are copied
+        color, depth, color_ts, depth_ts, system_color_ts, system_depth_ts, system_frameget_ts = \
+            self.kinect.get_next_frame(copy=False)
+        if self.kinect.color_format == "mjpeg":
+            if isinstance(color_scale, int):
+                color = self.kinect.decode_mjpeg(color, color_scale)
+                color_scale = 1
+            else:
+                color = self.kinect.decode_mjpeg(color)
+        else:
+            # BGRA -> RGB
+            color = color[:, :, 2::-1]
+        color_data = image_encode(area_downscale(color, color_scale), "jpeg", jpeg_quality)
+        if depth_scale is None:
+            return {"packet": pack_preview_frame(color_ts, color_data, device=self.device)}
+        # Averaging would mix the invalid (zero) depth values into the valid ones, so depth is subsampled
+        depth = np.ascontiguousarray(depth[::depth_scale, ::depth_scale])
+        return {"packet": pack_preview_frame(color_ts, color_data, depth_ts, image_encode(depth, "png"), self.device)}
+
+    def run(self) -> None:
+        while self.active:
+            with self._condition:
+                while self.active and self._params is None:
+                    self._condition.wait()
+                if not self.active:
+                    break
+                params = self._params
+            start_time = time.monotonic()
+            try:
+                frame = self.make_frame(*params)
+            except Exception as e:
+                frame = {"exception": e}
+            with self._condition:
+                self._latest = frame
+                self._latest_params = params
+                self._latest_ind += 1
+            if "exception" in frame:
+                logger.warning(f"Failed to make a preview frame: {frame['exception']}")
+            if self.frame_callback is not None:
+                self.frame_callback()
+            time.sleep(max(self.min_period - (time.monotonic() - start_time), 0))
+
+    def start_preview(self):
+        self.active = True
+        self.start()
+
+    def stop_preview(self):
+        with self._condition:
+            self.active = False
+            self._condition.notify_all()
+        self.join()
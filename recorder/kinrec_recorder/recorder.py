@@ -1,5 +1,4 @@
 import numpy as np
-import kinz
 import logging
 import time
 import io
@@ -7,16 +6,21 @@ import os
 import json
 import shutil
 import psutil
-import base64
 from PIL import Image
-from glob import glob
 from copy import deepcopy
-from skimage.transform import rescale
-from threading import Thread
+from threading import Thread, Event
 from .net import NetHandler
-from videoio import VideoWriter, Uint16Writer
-from typing import Tuple, Sequence, List, Optional, IO, Union
-from dataclasses import dataclass
+from .transfer import SendFileDone
+from .catalog import RecordingCatalog
+from .calibration import CalibrationCache
+from .devices import KinzBackend
+from .framebuffer import FrameRingBuffer
+from .preview import PreviewWorker
+from .stats import FrameGapDetector, LatencyHistogram
+from .writers import open_stream_writer, EncoderProcess, TimestampLogWriter, \
+    timestamps_file, depth_format_files
+from typing import Tuple, Sequence, List, Optional, Union, Callable, Dict, Set
+from dataclasses import dataclass, field
 
 logger = logging.getLogger("KR.recorder")
 
@@ -30,6 +34,19 @@ def statusd(cmd, result="OK", info=""):
     return {"cmd": cmd, "result": result, "info": info}
 
 
+def split_cpu_cores(parts_count: int) -> List[Optional[Set[int]]]:
+    """
+    Splits the CPU cores available to the process into parts_count sets of neighbouring cores.
+    Every set is None (no pinning) if the thread affinity is not supported or there are fewer cores than parts.
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        return [None] * parts_count
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < parts_count:
+        return [None] * parts_count
+    return [{int(core) for core in part} for part in np.array_split(cores, parts_count)]
+
+
 # def se3_inv(R, t):
 #     R = R.copy()
 #     t = t.copy()
@@ -66,6 +83,9 @@ class Kinect:
     class NotInitializedException(Exception):
         pass
 
+    class BufferTooSmallException(Exception):
+        pass
+
     _color_resolutions_dict = {
         720: (1280, 720),
         1080: (1920, 1080),
@@ -83,17 +103,40 @@ class Kinect:
         (False, True): (320, 288)
     }
 
-    def __init__(self):
+    def __init__(self, color_format: str = "bgra", calibration_cache: Optional[CalibrationCache] = None,
+            backend=None, device_index: int = 0):
+        """
+        Args:
+            color_format: "bgra" -- color is decoded by the SDK, "mjpeg" -- compressed frames are passed as is
+            calibration_cache: if given, the calibration and the depth2pc map are queried from the SDK only once
+                per Kinect serial and camera mode
+            backend: device backend (see devices.open_device_backend), KinZ by default
+            device_index: index of the device among the connected ones
+        """
+        assert color_format in ["bgra", "mjpeg"], f"Unknown color format '{color_format}'"
+        # "bgra" -- color is decoded by the SDK, "mjpeg" -- compressed frames are passed as is (1D uint8 arrays)
+        self.color_format = color_format
+        self.calibration_cache = calibration_cache
+        self.backend = KinzBackend() if backend is None else backend
+        self.device_index = device_index
         self.device = None
         self.init_frame_timeout = 5.
         self.subordinate_init_frame_timeout = 10.
         self.regular_frame_timeout = 1 / 10.
+        # Acquisition: sleep until the next frame is due, then poll the device with a fine granularity ("spin");
+        # if the frame is overdue by more than a frame period (e.g. subordinate waiting for the master), poll slower
+        self.spin_window = 2e-3
+        self.spin_poll_period = 2.5e-4
+        self.idle_poll_period = 1 / 200.
+        self._last_pickup_time = None
+        self.last_pickup_nsec = None
         self.params = None
         self.depth_calibration = None
         self.color_calibration = None
         self.depth2pc_map = None
         self.depth2color_transform = None
         self.color2depth_transform = None
+        self._calibration_dict = None
         self._id = None
         self.active = False
         self.update_params()
@@ -110,10 +153,21 @@ class Kinect:
     def _device_init(self, resolution=1440, wfov=False, binned=False, fps=30, sync_mode="none", sync_capture_delay=0):
         if self.device is not None:
             raise Kinect.DoubleActivationException()
-        kin = kinz.Kinect(resolution=resolution, wfov=wfov, binned=binned, framerate=fps, sync_mode=sync_mode,
-                          sync_capture_delay=sync_capture_delay, imu_sensors=False)
         self.start_params = dict(resolution=resolution, wfov=wfov, binned=binned, framerate=fps, sync_mode=sync_mode,
                                  sync_capture_delay=sync_capture_delay, imu_sensors=False)
+        if self.color_format == "mjpeg":
+            self.start_params["color_format"] = "mjpeg"
+        try:
+            kin = self.backend.open(device_index=self.device_index, **self.start_params)
+        except TypeError as e:
+            # Stock KinZ builds have no color_format option and reject the unknown argument
+            if "color_format" not in self.start_params:
+                raise
+            logger.warning(f"The device SDK doesn't support MJPEG color ({e}), falling back to the BGRA color, "
+                           f"the color will be decoded by the SDK and encoded to mpeg2")
+            self.color_format = "bgra"
+            del self.start_params["color_format"]
+            kin = self.backend.open(device_index=self.device_index, **self.start_params)
         self.device = kin
         self.active = False
 
@@ -142,10 +196,25 @@ class Kinect:
         else:
             raise Kinect.DoubleActivationException()
 
+    def flush_frames(self, max_frames: int = 100):
+        """
+        Drops the frames queued in the SDK while the cameras were running unattended (e.g. in standby),
+        so that the next get_next_frame returns a fresh frame
+        """
+        if not self.active:
+            raise Kinect.NotActivatedException()
+        flushed_count = 0
+        while flushed_count < max_frames and self.device.get_frames(get_color=True, get_depth=True, get_ir=False,
+                                                                   get_sensors=False, align_depth=False):
+            flushed_count += 1
+        self._last_pickup_time = None
+        return flushed_count
+
     def _camera_stop(self):
         if self.active:
             self.device.stop_cameras()
             self.active = False
+            self._last_pickup_time = None
         else:
             raise Kinect.NotActivatedException()
 
@@ -161,6 +230,13 @@ class Kinect:
     def fps(self) -> float:
         return self.params["fps"]
 
+    @property
+    def recording_color_format(self) -> str:
+        """
+        Format of the recorded color stream: MJPEG frames are stored as is, decoded frames are encoded to mpeg2
+        """
+        return "mjpeg" if self.color_format == "mjpeg" else "mpeg2"
+
     def camera_start(self):
         self._camera_start()
 
@@ -170,7 +246,7 @@ class Kinect:
     def _reinitialize(self):
         if self.initialized:
             self.close()
-        if kinz.get_connected_kinects_count() > 0:
+        if self.backend.connected_count() > self.device_index:
             self._device_init(**self.params)
 
     def try_initialize(self):
@@ -192,19 +268,46 @@ class Kinect:
         else:
             return True
 
-    def get_next_frame(self):
-        return self._get_next_frame(self.regular_frame_timeout)
+    def get_next_frame(self, color_out: Optional[np.ndarray] = None, depth_out: Optional[np.ndarray] = None,
+            copy: bool = True):
+        return self._get_next_frame(self.next_frame_timeout, color_out=color_out, depth_out=depth_out, copy=copy)
 
-    def _get_next_frame(self, timeout: float, retry_period: float = 1 / 40.):
+    @property
+    def next_frame_timeout(self) -> float:
+        # At low frame rates the frame period itself exceeds the regular timeout
+        return max(self.regular_frame_timeout, 2. / self.fps)
+
+    def _get_next_frame(self, timeout: float, color_out: Optional[np.ndarray] = None,
+            depth_out: Optional[np.ndarray] = None, copy: bool = True):
+        """
+        Waits for the next frame from the device.
+        The monotonic time of the frame pickup is stored in last_pickup_nsec
+        Args:
+            timeout (float): time to wait for the frame before raising FrameGetFailException
+            color_out (np.ndarray): optional buffer to copy the color frame into; (H, W, 4) buffers receive
+                the native BGRA layout, (H, W, 3) buffers receive RGB
+            depth_out (np.ndarray): optional buffer to copy the depth frame into
+            copy (bool): if False (and no output buffers are given), returns the native BGRA color and depth
+                borrowed from the SDK, which stay valid only until the next frame is requested
+        """
         if not self.active:
             raise Kinect.NotActivatedException()
-        stime = time.time()
+        stime = time.monotonic()
+        frame_period = 1. / self.fps
         while not self.device.get_frames(get_color=True, get_depth=True, get_ir=False, get_sensors=False,
                                          align_depth=False):
-            if time.time() - stime > timeout:
+            curr_time = time.monotonic()
+            if curr_time - stime > timeout:
                 raise Kinect.FrameGetFailException()
+            expected_time = stime if self._last_pickup_time is None else self._last_pickup_time + frame_period
+            if curr_time < expected_time - self.spin_window:
+                time.sleep(expected_time - self.spin_window - curr_time)
+            elif curr_time < expected_time + frame_period:
+                time.sleep(self.spin_poll_period)
             else:
-                time.sleep(retry_period)
+                time.sleep(self.idle_poll_period)
+        self.last_pickup_nsec = time.monotonic_ns()
+        self._last_pickup_time = self.last_pickup_nsec / 1e9
         color_data = self.device.get_color_data()
         depth_data = self.device.get_depth_data()
         system_frame_ts = int(deepcopy(self.device.get_last_frameget_timestamp_usec()))
@@ -212,13 +315,70 @@ class Kinect:
         system_color_ts = int(deepcopy(color_data.system_timestamp_nsec))
         depth_ts = int(deepcopy(depth_data.device_timestamp_usec))
         system_depth_ts = int(deepcopy(depth_data.system_timestamp_nsec))
-        color = np.array(color_data.buffer, copy=False)[:, :, 2::-1].copy()
-        depth = np.array(depth_data.buffer, copy=True)
+        # If the output buffers are provided, the frame is copied directly into them (e.g. into a ring buffer slot)
+        if self.color_format == "mjpeg":
+            payload = np.array(color_data.buffer, copy=False).reshape(-1)
+            if color_out is None:
+                color = payload.copy() if copy else payload
+            elif len(payload) > len(color_out):
+                raise Kinect.BufferTooSmallException(f"MJPEG frame of {len(payload)} bytes does not fit "
+                                                     f"into a {len(color_out)} bytes buffer")
+            else:
+                color = color_out[:len(payload)]
+                np.copyto(color, payload)
+        elif color_out is None:
+            color = np.array(color_data.buffer, copy=False)
+            if copy:
+                color = color[:, :, 2::-1].copy()
+        elif color_out.shape[2] == 4:
+            np.copyto(color_out, np.array(color_data.buffer, copy=False))
+            color = color_out
+        else:
+            np.copyto(color_out, np.array(color_data.buffer, copy=False)[:, :, 2::-1])
+            color = color_out
+        if depth_out is None:
+            depth = np.array(depth_data.buffer, copy=copy)
+        else:
+            np.copyto(depth_out, np.array(depth_data.buffer, copy=False))
+            depth = depth_out
         return color, depth, color_ts, depth_ts, system_color_ts, system_depth_ts, system_frame_ts
 
+    @staticmethod
+    def decode_mjpeg(payload: np.ndarray, scale: int = 1) -> np.ndarray:
+        img = Image.open(io.BytesIO(payload))
+        target_size = (img.size[0] // scale, img.size[1] // scale)
+        if scale != 1:
+            # Let the JPEG decoder do the downscaling (DCT scaling), it is much faster than a full decode
+            img.draft("RGB", target_size)
+        img = img.convert("RGB")
+        if img.size != target_size:
+            img = img.resize(target_size, Image.NEAREST)
+        return np.asarray(img)
+
     def update_calibration(self):
         if not self.initialized:
             raise Kinect.NotInitializedException()
+        if self._calibration_dict is not None:
+            return
+        cache = self.calibration_cache
+        if cache is None:
+            self._query_calibration()
+            self._calibration_dict = self._make_calibration_dict()
+            return
+        self._id = self.device.get_serial_number()
+        calibration = cache.load_calibration(self._id, self.params)
+        if calibration is None:
+            logger.info(f"Calibration of Kinect {self._id} is not cached, querying it")
+            self._query_calibration()
+            calibration = self._make_calibration_dict()
+            cache.save_calibration(self._id, self.params, calibration)
+        if not cache.has_depth2pc_map(self._id, self.params):
+            if self.depth2pc_map is None:
+                self.depth2pc_map = self.device.get_depth2pc_map()
+            cache.save_depth2pc_map(self._id, self.params, self.depth2pc_map)
+        self._calibration_dict = calibration
+
+    def _query_calibration(self):
         if self.color_calibration is None:
             self.depth_calibration = self.device.get_depth_calibration()
             self.color_calibration = self.device.get_color_calibration()
@@ -238,9 +398,26 @@ class Kinect:
         self.depth_calibration = None
         self.color_calibration = None
         self.depth2pc_map = None
+        self._calibration_dict = None
+
+    def save_depth2pc_map(self, path: str):
+        """
+        Stores the depth2pc map of the current camera mode as an npz keyed by the Kinect id.
+        With the calibration cache, the cached file is linked instead of compressing the map again.
+        """
+        if self.calibration_cache is None:
+            np.savez_compressed(path, **{self.id: self.depth2pc_map})
+        else:
+            self.calibration_cache.link_depth2pc_map(self.id, self.params, path)
 
     @property
-    def calibration_dict(self):
+    def calibration_dict(self) -> Optional[dict]:
+        """
+        Calibration of the current camera mode, None until update_calibration is called
+        """
+        return self._calibration_dict
+
+    def _make_calibration_dict(self) -> dict:
         def intrinsics_to_dict(calib, add_opencv=True):
             resolution = calib.get_size()
             intr_matrix = calib.get_intrinsics_matrix(extended=False)
@@ -255,8 +432,6 @@ class Kinect:
                                         ['fx', 'fy', 'cx', 'cy', 'k1', 'k2', 'p1', 'p2', 'k3', 'k4', 'k5', 'k6']]
             return calib_dict
 
-        if self.color_calibration is None:
-            return None
         color_calib_dict = intrinsics_to_dict(self.color_calibration)
         depth_calib_dict = intrinsics_to_dict(self.depth_calibration)
         color_R = self.color_calibration.get_rotation_matrix()
@@ -287,9 +462,24 @@ class Kinect:
 
 
 class RecorderThread(Thread):
+    # Per-frame durations measured for the latency histograms. The encode stages include the writes of the encoded
+    # data (to the file or to the ffmpeg pipe), timestamp_log is the append of the frame to the timestamp log
+    PIPELINE_STAGES = ["capture_wait", "color_encode", "depth_encode", "timestamp_log"]
+
     def __init__(self, kinect, recording_dir, expected_timelen=None, fps_window_size=20, final_callback=None,
-            start_delay=0):
+            start_delay=0, buffer_size=15, encoder_mode="thread", depth_format="mp4", preroll: float = 0.,
+            capture_done_callback=None, cpu_affinity: Optional[Set[int]] = None):
+        """
+        Args:
+            final_callback: called from the thread when the recording is completely written
+            preroll: if positive, the thread is started by arm() before the recording starts and keeps the last
+                preroll seconds of frames in memory; the recording then begins that much before the trigger time
+            capture_done_callback: called from the thread when the capture is over and the Kinect is not used
+                anymore, the encoders may still be writing the buffered frames
+            cpu_affinity: CPU cores to run the capture and the encoding of the recording on, None - any core
+        """
         super().__init__()
+        assert encoder_mode in ["thread", "process"], f"Unknown encoder mode '{encoder_mode}'"
         self.kinect = kinect
         self.recording_dir = recording_dir
         self.expected_timelen = expected_timelen
@@ -297,67 +487,356 @@ class RecorderThread(Thread):
         self.finished = False
         self.fps_window_size = fps_window_size
         self.last_times = np.zeros(self.fps_window_size)
-        self.color_timestamps = []
-        self.depth_timestamps = []
+        # Time between the frame arrival at the host and its pickup by the capture loop, ns
+        self.last_pickup_waits = np.zeros(self.fps_window_size, dtype=np.int64)
+        # Timestamps of the first and the last recorded frames (in FrameRingBuffer.TIMESTAMP_FIELDS order)
+        self.first_timestamps: Optional[np.ndarray] = None
+        self.last_timestamps: Optional[np.ndarray] = None
+        self.frames_recorded = 0
+        self.timestamp_log: Optional[TimestampLogWriter] = None
         self.final_callback = final_callback
+        self.capture_done_callback = capture_done_callback
+        # Set once the capture loop has exited
+        self.capture_done = Event()
         self.exception = None
         self.start_delay = start_delay
+        self.buffer_size = buffer_size
+        self.encoder_mode = encoder_mode
+        self.depth_format = depth_format
+        self.frame_buffer: Optional[FrameRingBuffer] = None
+        self.gap_detector: Optional[FrameGapDetector] = None
+        self.stage_histograms = {stage: LatencyHistogram() for stage in self.PIPELINE_STAGES}
+        self.preroll = preroll
+        self.armed = False
+        # Monotonic time of the pickup of the first frame to record, set by the trigger in the armed mode
+        self._start_pickup_ns: Optional[int] = None
+        self._preroll_frames = 0
+        self._record_start_time: Optional[float] = None
+        self.cpu_affinity = cpu_affinity
 
     def run(self) -> None:
-        with VideoWriter(os.path.join(self.recording_dir, "color.mpeg"), resolution=self.kinect.color_resolution,
-                         fps=self.kinect.fps, preset="ultrafast", codec="mpeg2") as color_writer, \
-                Uint16Writer(os.path.join(self.recording_dir, "depth.mp4"), resolution=self.kinect.depth_resolution,
-                             fps=self.kinect.fps, preset="ultrafast") as depth_writer:
-            self.color_timestamps = []
-            self.depth_timestamps = []
-            self.system_frameget_timestamps = []
-            self.system_color_timestamps = []
-            self.system_depth_timestamps = []
-            self.last_times = np.zeros(self.fps_window_size)
+        if self.cpu_affinity is not None:
+            # Encoder threads, encoder processes and ffmpeg subprocesses started from this thread inherit the affinity
+            os.sched_setaffinity(0, self.cpu_affinity)
+        # Capture only drains the device into the ring buffer, encoding is done by a separate thread per stream
+        # (in "process" mode, the thread only hands the slots over to the encoder process of the stream)
+        self._preroll_frames = int(np.ceil(self.preroll * self.kinect.fps)) if self.armed else 0
+        self.frame_buffer = FrameRingBuffer(self.buffer_size + self._preroll_frames, self.kinect.color_resolution,
+                                            self.kinect.depth_resolution, consumers=("color", "depth"),
+                                            shared=self.encoder_mode == "process",
+                                            color_format=self.kinect.color_format)
+        if self.armed:
+            # Frames are kept in the buffer until the trigger
+            self.frame_buffer.hold()
+        try:
+            with self._open_writer("color") as color_writer, self._open_writer("depth") as depth_writer, \
+                    TimestampLogWriter(os.path.join(self.recording_dir, timestamps_file),
+                                       FrameRingBuffer.TIMESTAMP_FIELDS,
+                                       flush_every=max(int(self.kinect.fps), 1)) as self.timestamp_log:
+                encoder_threads = [Thread(target=self._encode_loop,
+                                          args=("color", self._slot_writer("color", color_writer))),
+                                   Thread(target=self._encode_loop,
+                                          args=("depth", self._slot_writer("depth", depth_writer)))]
+                for encoder_thread in encoder_threads:
+                    encoder_thread.start()
+                try:
+                    self._capture_loop()
+                finally:
+                    self.frame_buffer.close()
+                    self.capture_done.set()
+                    if self.capture_done_callback is not None:
+                        self.capture_done_callback()
+                    for encoder_thread in encoder_threads:
+                        encoder_thread.join()
+        finally:
+            self.capture_done.set()
+            self.frame_buffer.free()
+        if self.frame_buffer.overflow_count > 0:
+            logger.warning(f"{self.frame_buffer.overflow_count} frames were dropped due to the frame buffer overflow")
+        if self.final_callback is not None:
+            self.final_callback()
+
+    def _open_writer(self, stream: str):
+        resolution = self.kinect.color_resolution if stream == "color" else self.kinect.depth_resolution
+        color_format = self.kinect.recording_color_format
+        if self.encoder_mode == "process":
+            return EncoderProcess(stream, self.recording_dir, resolution, self.kinect.fps,
+                                  self.frame_buffer.shared_spec(stream), color_format=color_format,
+                                  depth_format=self.depth_format)
+        else:
+            return open_stream_writer(stream, self.recording_dir, resolution, self.kinect.fps, color_format,
+                                      self.depth_format)
+
+    def _slot_writer(self, stream: str, writer) -> Callable[[int], None]:
+        if isinstance(writer, EncoderProcess):
+            return lambda slot: writer.write(slot, self.frame_buffer.frame_length(stream, slot))
+        return lambda slot: writer.write(self.frame_buffer.frame(stream, slot))
+
+    def _capture_loop(self):
+        self.first_timestamps = None
+        self.last_timestamps = None
+        self.frames_recorded = 0
+        self.last_times = np.zeros(self.fps_window_size)
+        self.last_pickup_waits = np.zeros(self.fps_window_size, dtype=np.int64)
+        self.gap_detector = FrameGapDetector(self.kinect.fps)
+        capture_wait_histogram = self.stage_histograms["capture_wait"]
+        if self.armed:
+            logger.info(f"Armed, keeping {self.preroll:.2f} seconds of frames until the start")
+        else:
             if self.start_delay > 0:
                 logger.info(f"Waiting for {self.start_delay:.2f} seconds before starting")
                 time.sleep(self.start_delay)
-            stime = time.time()
-            self.last_times[-1] = stime
+            self._record_start_time = time.time()
             logger.info("Recording started")
-            while self.active:
-                try:
-                    color, depth, color_ts, depth_ts, system_color_ts, system_depth_ts, system_frame_ts = self.kinect.get_next_frame()
-                except Kinect.FrameGetFailException as e:
+        self.last_times[-1] = time.time()
+        while self.active:
+            if self.frame_buffer.held and self.frame_buffer.fill_level >= self._preroll_frames:
+                # Pre-roll is full, the oldest frame is dropped. The rest of the buffer stays free for the frames
+                # captured while the encoders catch up with the pre-roll after the start
+                self.frame_buffer.discard_oldest()
+            slot = self.frame_buffer.acquire_write_slot()
+            get_start = time.perf_counter_ns()
+            try:
+                if slot is None:
+                    # All slots are busy, the frame still has to be taken from the device to keep up with it
+                    frame = self.kinect.get_next_frame()
+                else:
+                    frame = self.kinect.get_next_frame(color_out=self.frame_buffer.color[slot],
+                                                       depth_out=self.frame_buffer.depth[slot])
+            except Kinect.FrameGetFailException as e:
+                self.active = False
+                self.finished = True
+                self.exception = e
+            except Kinect.BufferTooSmallException as e:
+                logger.warning(f"{e}, dropping the frame")
+                self.frame_buffer.register_overflow()
+            else:
+                capture_wait_histogram.add(time.perf_counter_ns() - get_start)
+                color_ts, depth_ts, system_color_ts, system_depth_ts, system_frame_ts = frame[2:]
+                # Device system timestamps and the pickup time are both taken from the host monotonic clock
+                pickup_ts = self.kinect.last_pickup_nsec
+                self.last_pickup_waits = np.roll(self.last_pickup_waits, -1)
+                self.last_pickup_waits[-1] = pickup_ts - max(system_color_ts, system_depth_ts)
+                recording = not self.frame_buffer.held
+                if recording:
+                    # Frames dropped by the buffer overflow are still checked, so that only device-side gaps are counted
+                    self.gap_detector.update(color_ts, depth_ts)
+                if slot is None:
+                    self.frame_buffer.register_overflow()
+                    logger.warning("Frame buffer is full, dropping the frame")
+                else:
+                    self.frame_buffer.timestamps[slot] = frame[2:] + (pickup_ts,)
+                    self.frame_buffer.color_lengths[slot] = len(frame[0])
+                    if recording:
+                        self._log_frame(slot)
+                    self.frame_buffer.commit()
+                if not recording and self._start_pickup_ns is not None:
+                    self._start_from_preroll()
+                self.last_times = np.roll(self.last_times, -1)
+                curr_time = time.time()
+                self.last_times[-1] = time.time()
+                if self._record_start_time is not None and curr_time - self._record_start_time >= self.expected_timelen:
                     self.active = False
                     self.finished = True
-                    self.exception = e
-                else:
-                    color_writer.write(color)
-                    depth_writer.write(depth)
-                    self.color_timestamps.append(color_ts)
-                    self.depth_timestamps.append(depth_ts)
-                    self.system_color_timestamps.append(system_color_ts)
-                    self.system_depth_timestamps.append(system_depth_ts)
-                    self.system_frameget_timestamps.append(system_frame_ts)
-                    self.last_times = np.roll(self.last_times, -1)
-                    curr_time = time.time()
-                    self.last_times[-1] = time.time()
-                    if curr_time - stime >= self.expected_timelen:
-                        self.active = False
-                        self.finished = True
-        if self.final_callback is not None:
-            self.final_callback()
+
+    def _log_frame(self, slot: int):
+        frame_timestamps = self.frame_buffer.timestamps[slot]
+        write_start = time.perf_counter_ns()
+        self.timestamp_log.append(frame_timestamps)
+        self.stage_histograms["timestamp_log"].add(time.perf_counter_ns() - write_start)
+        if self.first_timestamps is None:
+            self.first_timestamps = frame_timestamps.copy()
+        self.last_timestamps = frame_timestamps.copy()
+        self.frames_recorded += 1
+
+    def _start_from_preroll(self):
+        """
+        Starts the recording from the kept frame nearest to the requested start, once that frame has been captured
+        """
+        first_index, end_index = self.frame_buffer.held_range()
+        timestamps = self.frame_buffer.timestamps
+        size = self.frame_buffer.size
+        pickup_column = FrameRingBuffer.TIMESTAMP_FIELDS.index("monotonic_pickup_nsec")
+        half_period_ns = int(5e8 / self.kinect.fps)
+        start_ns = self._start_pickup_ns - half_period_ns
+        if end_index == first_index or timestamps[(end_index - 1) % size, pickup_column] < start_ns:
+            # The start is still ahead (e.g. because of the start delay)
+            return
+        start_index = first_index
+        while timestamps[start_index % size, pickup_column] < start_ns:
+            start_index += 1
+        actual_preroll = (self._start_pickup_ns + self.preroll * 1e9 -
+                          timestamps[start_index % size, pickup_column]) / 1e9
+        for index in range(start_index, end_index):
+            slot = index % size
+            self.gap_detector.update(timestamps[slot, 0], timestamps[slot, 1])
+            self._log_frame(slot)
+        self.frame_buffer.start_from(start_index)
+        self._record_start_time = time.time()
+        logger.info(f"Recording started, {actual_preroll:.2f} seconds of frames before the trigger are included")
+
+    def _encode_loop(self, stream: str, write_slot: Callable[[int], None]):
+        encode_histogram = self.stage_histograms[f"{stream}_encode"]
+        while True:
+            try:
+                slot = self.frame_buffer.get(stream)
+            except FrameRingBuffer.ClosedException:
+                break
+            encode_start = time.perf_counter_ns()
+            try:
+                write_slot(slot)
+            except Exception as e:
+                logger.error(f"Failed to encode {stream} frame: {e}")
+                self.exception = e
+                self.active = False
+                self.finished = True
+                self.frame_buffer.release(stream)
+                break
+            encode_histogram.add(time.perf_counter_ns() - encode_start)
+            self.frame_buffer.release(stream)
 
     @property
     def sliding_window_fps(self):
         return 1 / (self.last_times[1:] - self.last_times[:-1]).mean()
 
-    def start_recording(self):
+    @property
+    def pickup_wait_stats(self) -> dict:
+        """
+        Mean and max wait (in ms) of the frames in the sliding window between their arrival and the pickup
+        """
+        waits = self.last_pickup_waits / 1e6
+        return {"mean": float(waits.mean()), "max": float(waits.max())}
+
+    @property
+    def stage_latency(self) -> dict:
+        return {stage: histogram.to_dict() for stage, histogram in self.stage_histograms.items()}
+
+    @property
+    def frame_gaps(self) -> Optional[dict]:
+        if self.gap_detector is None:
+            return None
+        return self.gap_detector.status_dict()
+
+    @property
+    def buffer_status(self) -> Optional[dict]:
+        if self.frame_buffer is None:
+            return None
+        return self.frame_buffer.status_dict()
+
+    def arm(self):
+        """
+        Starts capturing into the pre-roll, the recording itself starts with start_recording
+        """
+        self.armed = True
         self.active = True
         self.finished = False
         self.start()
 
+    def start_recording(self, trigger_time: Optional[float] = None):
+        """
+        Args:
+            trigger_time: wall clock time of the start (e.g. server_time), used only if armed; frames are recorded
+                from trigger_time + start_delay - preroll
+        """
+        if not self.armed:
+            self.active = True
+            self.finished = False
+            self.start()
+            return
+        trigger_time = time.time() if trigger_time is None else trigger_time
+        clock_offset = time.time() - trigger_time
+        if abs(clock_offset) > 1.:
+            logger.warning(f"Trigger time is {clock_offset:.2f} seconds off the local clock")
+        trigger_ns = time.monotonic_ns() - int(clock_offset * 1e9)
+        self._start_pickup_ns = trigger_ns + int((self.start_delay - self.preroll) * 1e9)
+
     def close_recording(self):
         self.active = False
         self.finished = True
 
 
+class FinalizeThread(Thread):
+    """
+    Seals a recording in the background once its capture is over: waits for the encoders to write
+    the buffered frames, then writes metadata.json, which marks the recording as complete
+    """
+
+    def __init__(self, recorder: RecorderThread, metadata: dict, new_server_time: Optional[float] = None,
+            done_callback: Optional[Callable[["FinalizeThread"], None]] = None):
+        """
+        Args:
+            recorder: recorder thread of the recording, its capture has to be finished
+            metadata: metadata collected at the recording initialization and start, completed by the thread
+            new_server_time: server time of the stop command, None if the recording has run its expected duration
+            done_callback: called from the thread when the recording is sealed
+        """
+        super().__init__()
+        self.recorder = recorder
+        self.metadata = metadata
+        self.new_server_time = new_server_time
+        self.done_callback = done_callback
+        self.stage = "encoding"
+        self.exception = None
+
+    @property
+    def recording_id(self) -> int:
+        return self.metadata["id"]
+
+    @property
+    def dirname(self) -> str:
+        return os.path.basename(self.recorder.recording_dir)
+
+    @property
+    def status_dict(self) -> dict:
+        """
+        Progress of the job: stage ("encoding", "metadata" or "done") and the number of frames left to encode
+        """
+        frame_buffer = self.recorder.frame_buffer
+        frames_left = 0 if frame_buffer is None or self.stage != "encoding" else frame_buffer.fill_level
+        return {"recording_id": self.recording_id, "stage": self.stage, "frames_left": frames_left}
+
+    def run(self) -> None:
+        try:
+            self._finalize()
+        except Exception as e:
+            logger.error(f"Failed to finalize recording {self.recording_id}: {e}")
+            self.exception = e
+        self.stage = "done"
+        if self.done_callback is not None:
+            self.done_callback(self)
+
+    def _finalize(self):
+        if self.recorder.ident is not None:
+            logger.info(f"Waiting for the encoders of recording {self.recording_id} to finish")
+            self.recorder.join()
+        self.stage = "metadata"
+        # Timestamps are already in the binary log written during the capture
+        logger.info("Writing metadata")
+        recorder = self.recorder
+        metadata = self.metadata
+        if self.new_server_time is None:
+            metadata["duration"] = recorder.expected_timelen
+        else:
+            metadata["duration"] = self.new_server_time - metadata["server_time"]
+        # First two columns are the device color and depth timestamps
+        if recorder.first_timestamps is None:
+            # Stopped before any frame was recorded (e.g. while armed)
+            metadata["actual_duration"] = 0
+        else:
+            metadata["actual_duration"] = int(max(recorder.last_timestamps[:2]) - min(recorder.first_timestamps[:2]))
+        metadata["frames_recorded"] = recorder.frames_recorded
+        if recorder.frame_buffer is not None:
+            metadata["buffer_overflows"] = recorder.frame_buffer.overflow_count
+        if recorder.gap_detector is not None:
+            metadata["frame_gaps"] = recorder.frame_gaps
+        # Written at once, so that the recordings listing never sees a partial metadata.json
+        metadata_path = os.path.join(recorder.recording_dir, "metadata.json")
+        with open(metadata_path + ".tmp", "w") as metadata_file:
+            json.dump(metadata, metadata_file, indent=1)
+        os.replace(metadata_path + ".tmp", metadata_path)
+        logger.info(f"Recording {self.recording_id} finalized")
+
+
 class MainController:
     class RecordingExistsException(Exception):
         pass
@@ -367,369 +846,574 @@ class MainController:
         relpath: str
         path: str
         recording_id: int
+        device: int = 0
+
+    @dataclass
+    class RecorderFinishedEvent:
+        device: int
+
+    @dataclass
+    class PreviewFrameEvent:
+        device: int
+
+    @dataclass
+    class FinalizeDoneEvent:
+        # Only the ids are posted, the event is pickled in the "process" network mode
+        device: int
+        dirname: str
 
-    def __init__(self, net_handler: NetHandler, recordings_dir="kinrec/recordings"):
+    @dataclass
+    class Device:
+        """
+        Kinect driven by the controller together with its recordings and the state of its recording and preview.
+        Every device is a separate recorder for the server, addressed by the "device" field of the messages.
+        """
+        index: int
+        kinect: Kinect
+        recordings_dir: str
+        catalog: RecordingCatalog
+        # CPU cores of the capture and the encoders of the recordings, None - not pinned
+        cpu_affinity: Optional[Set[int]] = None
+        # Cameras are running, but not used by a recording or a preview
+        in_standby: bool = False
+        recording_metadata: Optional[dict] = None
+        recorder: Optional[RecorderThread] = None
+        preview_worker: Optional[PreviewWorker] = None
+        preview_frame_requested: bool = False
+        # Final frame_gaps and stage_latency of the last finished recording, reported while there is no recorder
+        last_recording_stats: Optional[dict] = None
+        # Recordings being sealed in the background, see MainController.finalize_recording
+        finalize_jobs: List[FinalizeThread] = field(default_factory=list)
+
+    # Commands from the server, each one is handled by the cmd_<name> method
+    command_names = ["start_preview", "get_preview_frame", "stop_preview", "init_recording", "start_recording",
+                     "stop_recording", "get_recordings_list", "collect", "stop_collect", "delete_recording",
+                     "get_kinect_calibration", "set_kinect_params", "get_status", "get_devices", "shutdown",
+                     "reboot"]
+    # Commands postponed until the running finalization jobs are done
+    deferred_command_names = ["shutdown", "reboot"]
+
+    def __init__(self, net_handler: NetHandler, recordings_dir="kinrec/recordings", encoder_mode="thread",
+            color_format="bgra", depth_format="mp4", preroll: float = 0., calibration_dir: Optional[str] = None,
+            standby: bool = False, device_backend=None, devices_count: int = 1, pin_cpus: bool = True):
+        """
+        Args:
+            preroll: if positive, the capture starts already at init_recording and the recordings include
+                this many seconds of frames before the start time
+            calibration_dir: folder of the Kinect calibration cache, "calibration" next to recordings_dir by default
+            standby: keep the cameras running between the recordings and previews, so that the next one starts
+                without the camera warm-up
+            device_backend: backend providing the Kinect devices (see devices.open_device_backend), KinZ by default
+            devices_count: number of Kinects to drive; with several ones, the recordings of each Kinect are stored
+                in the "device<index>" subfolder of recordings_dir
+            pin_cpus: with several Kinects, split the CPU cores between them, so that the capture and the encoders
+                of a Kinect run on its own cores
+        """
+        assert depth_format in depth_format_files, f"Unknown depth format '{depth_format}'"
         self.net = net_handler
+        self.encoder_mode = encoder_mode
+        self.depth_format = depth_format
+        self.preroll = preroll
         self.active = False
-        self.kinect = Kinect()
+        if calibration_dir is None:
+            calibration_dir = os.path.join(os.path.dirname(os.path.normpath(recordings_dir)), "calibration")
+        calibration_cache = CalibrationCache(calibration_dir)
+        if device_backend is None:
+            device_backend = KinzBackend()
+        self.standby = standby
         self.recordings_dir = recordings_dir
-        os.makedirs(recordings_dir, exist_ok=True)
-        self.recording_expected_duration = None
-        self.recording_metadata = None
-        self.recorder: Optional[RecorderThread] = None
-        self.refresh_period = 1 / 100.
-        self.current_sendfile: Optional[IO] = None
-        self.sendfile_queue = []
-        self.sendfile_packet_size = 100_000
-
-    def start_kinect(self):
-        self.kinect.camera_start()
-
-    def get_preview_frame(self, color_scale: Union[float, int], depth_scale: Optional[int]):
-        def int_scale(img, scale: int):
-            if scale != 1:
-                img = img[::scale, ::scale]
-            return img
-
-        color, depth, color_ts, depth_ts, system_color_ts, system_depth_ts, system_frameget_ts = self.kinect.get_next_frame()
-        if isinstance(color_scale, int):
-            color = int_scale(color, color_scale)
-        else:
-            if color.dtype == np.uint8:
-                color = (rescale(color.astype(np.float32) / 255., 1. / color_scale,
-                                 multichannel=True) * 255.).astype(
-                    np.uint8)
-            else:
-                color = rescale(color, 1. / color_scale, multichannel=True)
-        if depth_scale is not None:
-            depth = int_scale(depth, depth_scale)
-            return color, depth, color_ts, depth_ts
-        else:
-            return color, None, color_ts, None
+        cpu_affinities = split_cpu_cores(devices_count) if pin_cpus and devices_count > 1 else [None] * devices_count
+        self.devices: List[MainController.Device] = []
+        for index in range(devices_count):
+            device_recordings_dir = recordings_dir if devices_count == 1 else \
+                os.path.join(recordings_dir, f"device{index}")
+            os.makedirs(device_recordings_dir, exist_ok=True)
+            kinect = Kinect(color_format=color_format, calibration_cache=calibration_cache, backend=device_backend,
+                            device_index=index)
+            self.devices.append(self.Device(index=index, kinect=kinect, recordings_dir=device_recordings_dir,
+                                            catalog=RecordingCatalog(device_recordings_dir),
+                                            cpu_affinity=cpu_affinities[index]))
+            if cpu_affinities[index] is not None:
+                logger.info(f"Device {index} recordings will run on CPU cores {sorted(cpu_affinities[index])}")
+        # Period of the Kinect initialization attempts while no Kinect is connected
+        # and of the network liveness checks, in seconds
+        self.kinect_check_period = 0.5
+        self.command_handlers: Dict[str, Callable[[MainController.Device, dict], None]] = \
+            {name: getattr(self, "cmd_" + name) for name in self.command_names}
+        # Local events posted to the network queue, and the transfer reports of the network loop
+        self.event_handlers = {SendFileDone: self.handle_sendfile_done,
+                               self.RecorderFinishedEvent: self.handle_recording,
+                               self.PreviewFrameEvent: self.handle_preview,
+                               self.FinalizeDoneEvent: self.handle_finalize_done}
+        # Files queued or being transferred by the network process
+        self.sendfile_queue: List[MainController.QueuedFile] = []
+        self.deferred_commands: List[dict] = []
 
-    def stop_kinect(self):
-        self.kinect.camera_stop()
+    @property
+    def finalize_jobs_count(self) -> int:
+        return sum(len(device.finalize_jobs) for device in self.devices)
+
+    def send(self, device: Device, data: dict):
+        """
+        Sends the reply of the device, tagged with its index
+        """
+        data["device"] = device.index
+        self.net.send(data)
+
+    def start_kinect(self, device: Device):
+        if device.in_standby and device.kinect.active:
+            device.in_standby = False
+            flushed_count = device.kinect.flush_frames()
+            logger.info(f"Kinect resumed from standby, {flushed_count} stale frames dropped")
+            return
+        device.in_standby = False
+        device.kinect.camera_start()
+
+    def start_preview(self, device: Device):
+        self.start_kinect(device)
+        device.preview_worker = PreviewWorker(device.kinect, frame_callback=lambda: self._on_preview_frame(device),
+                                              device=device.index)
+        device.preview_worker.start_preview()
+
+    def _on_preview_frame(self, device: Device):
+        # Called from the preview worker thread, wakes the main loop up only if a frame is awaited
+        if device.preview_frame_requested:
+            self.net.post(self.PreviewFrameEvent(device.index))
+
+    def stop_preview(self, device: Device):
+        if device.preview_worker is not None:
+            device.preview_worker.stop_preview()
+            device.preview_worker = None
+            device.preview_frame_requested = False
+        self.stop_kinect(device)
+
+    def stop_kinect(self, device: Device):
+        if self.standby:
+            if not device.kinect.active or device.in_standby:
+                raise Kinect.NotActivatedException()
+            device.in_standby = True
+            logger.info("Kinect left in standby")
+            return
+        device.kinect.camera_stop()
 
     @staticmethod
     def get_recording_dirname(recording_id, recording_name):
         return f"{recording_id}_{recording_name}"
 
-    def initialize_recording(self, recording_id, recording_name, recording_duration, participating_kinects,
-            start_delay=0):
-        curr_recording_dir = os.path.join(self.recordings_dir,
+    def initialize_recording(self, device: Device, recording_id, recording_name, recording_duration,
+            participating_kinects, start_delay=0):
+        curr_recording_dir = os.path.join(device.recordings_dir,
                                           self.get_recording_dirname(recording_id, recording_name))
         if os.path.exists(curr_recording_dir):
             raise MainController.RecordingExistsException()
         os.makedirs(curr_recording_dir)
         logger.info("Creating metadata")
-        self.start_kinect()
-        self.kinect.update_calibration()
-        self.recording_metadata = {"id": recording_id, "name": recording_name,
-                                   "participating_kinects": list(participating_kinects),
-                                   "kinect_id": self.kinect.id, "kinect_calibration": self.kinect.calibration_dict,
-                                   "start_params": self.kinect.start_params, "start_delay": start_delay}
-        self.recorder = RecorderThread(self.kinect, curr_recording_dir, recording_duration, start_delay=start_delay)
+        kinect = device.kinect
+        self.start_kinect(device)
+        kinect.update_calibration()
+        # The map is known in advance (and only linked from the calibration cache), so it is not left to finalization
+        kinect.save_depth2pc_map(os.path.join(curr_recording_dir, "depth2pc_map.npz"))
+        device.recording_metadata = {"id": recording_id, "name": recording_name,
+                                     "participating_kinects": list(participating_kinects),
+                                     "kinect_id": kinect.id, "kinect_calibration": kinect.calibration_dict,
+                                     "start_params": kinect.start_params, "start_delay": start_delay,
+                                     "color_format": kinect.recording_color_format,
+                                     "depth_format": self.depth_format, "timestamps_file": timestamps_file,
+                                     "preroll": self.preroll}
+        device.recorder = RecorderThread(kinect, curr_recording_dir, recording_duration, start_delay=start_delay,
+                                         encoder_mode=self.encoder_mode, depth_format=self.depth_format,
+                                         capture_done_callback=lambda: self.net.post(
+                                             self.RecorderFinishedEvent(device.index)),
+                                         preroll=self.preroll, cpu_affinity=device.cpu_affinity)
+        if self.preroll > 0:
+            # Cameras and encoders are already running when the start command arrives
+            device.recorder.arm()
         logger.info("Recording initialized, ready to start")
-        return self.kinect.active
+        return kinect.active
 
-    def start_recording(self, server_time):
-        self.recording_metadata["server_time"] = server_time
+    def start_recording(self, device: Device, server_time):
+        device.recording_metadata["server_time"] = server_time
         logger.info("Starting recorder thread")
-        self.recorder.start_recording()
+        device.recorder.start_recording(server_time)
 
-    def finalize_recording(self, new_server_time=None):
+    def finalize_recording(self, device: Device, new_server_time=None):
+        """
+        Releases the Kinect as soon as the capture is over and leaves sealing the recording to a background
+        FinalizeThread, so that the next commands are handled while the encoders are still writing
+        """
         logger.info("Finalizing the recording")
-        logger.info("Waiting for recorder thread to finish")
-        self.recorder.join()
-        logger.info("Writing timestamps and metadata")
-        timestamps = {"device_color_usec": self.recorder.color_timestamps, "device_depth_usec": self.recorder.depth_timestamps,
-                      "monotonic_color_nsec": self.recorder.system_color_timestamps,
-                      "monotonic_depth_nsec": self.recorder.system_depth_timestamps,
-                      "system_received_usec": self.recorder.system_frameget_timestamps}
-        json.dump(timestamps, open(os.path.join(self.recorder.recording_dir, "times.json"), "w"), indent=0)
-        if new_server_time is None:
-            self.recording_metadata["duration"] = self.recorder.expected_timelen
-        else:
-            self.recording_metadata["duration"] = new_server_time - self.recording_metadata["server_time"]
-        self.recording_metadata["actual_duration"] = (max(self.recorder.color_timestamps[-1],
-                                                          self.recorder.depth_timestamps[-1]) -
-                                                      min(self.recorder.color_timestamps[0],
-                                                          self.recorder.depth_timestamps[0]))
-        json.dump(self.recording_metadata, open(os.path.join(self.recorder.recording_dir, "metadata.json"), "w"),
-                  indent=1)
-        np.savez_compressed(os.path.join(self.recorder.recording_dir, "depth2pc_map.npz"),
-                            **{self.kinect.id: self.kinect.depth2pc_map})
+        recorder = device.recorder
+        if recorder.ident is not None:
+            # Capture stops within a frame timeout after the recorder is deactivated
+            recorder.capture_done.wait()
+        if recorder.exception is not None:
+            logger.error(f"===Recording stopped with exception {type(recorder.exception)}===")
+        device.last_recording_stats = {"frame_gaps": recorder.frame_gaps, "stage_latency": recorder.stage_latency}
         logger.info("Stopping Kinect")
-        if self.recorder.exception is not None:
-            logger.error(f"===Recording stopped with exception {type(self.recorder.exception)}===")
         try:
-            self.stop_kinect()
+            self.stop_kinect(device)
         except Kinect.NotActivatedException:
             logger.error("Tried to stop Kinect, but Kinect is not running")
-        else:
-            logger.info("Recording finalized successfully")
-        self.recorder = None
-
-    def get_recordings(self, with_size=True):
-        essential_files = ["metadata.json", "color.mpeg", "depth.mp4", "times.json", "depth2pc_map.npz"]
+        job = FinalizeThread(recorder, device.recording_metadata, new_server_time,
+                             done_callback=lambda job: self.net.post(
+                                 self.FinalizeDoneEvent(device.index, job.dirname)))
+        device.finalize_jobs.append(job)
+        job.start()
+        device.recorder = None
+        device.recording_metadata = None
+
+    def get_recordings(self, device: Device, with_size=True):
         recordings_dict = {}
-        for dirpath in glob(os.path.join(self.recordings_dir, "*_*")):
-            if os.path.isdir(dirpath) and all(os.path.exists(os.path.join(dirpath, x)) for x in essential_files):
-                local_metadata = json.load(open(os.path.join(dirpath, "metadata.json")))
-                metadata = {k: local_metadata[k] for k in ["id", "name", "duration", "server_time",
-                                                           "kinect_id", "participating_kinects",
-                                                           "kinect_calibration"]}
-                if "start_params" in local_metadata:
-                    metadata["start_params"] = local_metadata["start_params"]
-                if with_size:
-                    size = 0
-                    for filename in essential_files[1:]:
-                        filepath = os.path.join(dirpath, filename)
-                        size += os.path.getsize(filepath)
-                    metadata["size"] = size
-                recordings_dict[metadata["id"]] = metadata
+        for metadata in device.catalog.recordings().values():
+            if not with_size:
+                metadata = {k: v for k, v in metadata.items() if k not in ["files", "size"]}
+            recordings_dict[metadata["id"]] = metadata
         return recordings_dict
 
-    def add_recordings_sendfile_queue(self, recording_id: int):
-        files_to_transfer = ["color.mpeg", "depth.mp4", "times.json", "depth2pc_map.npz"]
-        recordings_dict = self.get_recordings(with_size=False)
+    def add_recordings_sendfile_queue(self, device: Device, recording_id: int,
+            offsets: Optional[Dict[str, int]] = None):
+        """
+        Args:
+            recording_id: recording to transfer
+            offsets: bytes of the files already received by the server (by the file name), only the rest is sent
+        """
+        offsets = {} if offsets is None else offsets
+        recordings_dict = self.get_recordings(device)
         if recording_id not in recordings_dict:
             raise FileNotFoundError()
+        # Files are listed by the catalog from the full metadata.json (e.g. with the timestamps file name)
+        files_to_transfer = list(recordings_dict[recording_id]["files"])
         recording_name = recordings_dict[recording_id]["name"]
-        dirpath = os.path.join(self.recordings_dir, self.get_recording_dirname(recording_id, recording_name))
+        dirpath = os.path.join(device.recordings_dir, self.get_recording_dirname(recording_id, recording_name))
         for filename in files_to_transfer:
             filepath = os.path.join(dirpath, filename)
-            self.sendfile_queue.append(self.QueuedFile(relpath=filename, path=filepath, recording_id=recording_id))
+            self.sendfile_queue.append(self.QueuedFile(relpath=filename, path=filepath, recording_id=recording_id,
+                                                       device=device.index))
+            self.net.send_file(filepath, filename, recording_id, offset=offsets.get(filename, 0), device=device.index)
         return files_to_transfer
 
-    def delete_recording(self, recording_id: int):
+    def delete_recording(self, device: Device, recording_id: int):
         logger.info(f"Will delete recording {recording_id}")
-        files_to_delete = ["metadata.json", "color.mpeg", "depth.mp4", "times.json", "depth2pc_map.npz"]
-        recordings_dict = self.get_recordings(with_size=False)
+        recordings_dict = self.get_recordings(device)
         if recording_id not in recordings_dict:
             raise FileNotFoundError()
+        files_to_delete = ["metadata.json"] + list(recordings_dict[recording_id]["files"])
         recording_name = recordings_dict[recording_id]["name"]
-        dirpath = os.path.join(self.recordings_dir, self.get_recording_dirname(recording_id, recording_name))
+        dirpath = os.path.join(device.recordings_dir, self.get_recording_dirname(recording_id, recording_name))
         for filename in files_to_delete:
             filepath = os.path.join(dirpath, filename)
             if os.path.isfile(filepath):
                 os.remove(filepath)
         if len(os.listdir(dirpath)) == 0:
             os.rmdir(dirpath)
-
-    def handle_recording(self):
-        if self.recorder is not None:
-            if self.recorder.finished:
-                self.finalize_recording()
-                self.net.send({"type": "pong", "cmd_report": statusd("stop_recording")})
-
-    def handle_sendfile(self):
-        if self.current_sendfile is not None:
-            data = self.current_sendfile.read(self.sendfile_packet_size)
-            if len(data) == 0:
-                current_file_info = self.sendfile_queue[0]
-                self.net.send({"type": "collect_file_end", "recording_id": current_file_info.recording_id,
-                               "relative_file_path": current_file_info.relpath})
-                self.sendfile_queue = self.sendfile_queue[1:]
-                self.current_sendfile.close()
-                self.current_sendfile = None
-            else:
-                self.net.send(data)
-        elif len(self.sendfile_queue) > 0:
-            current_file_info = self.sendfile_queue[0]
-            size = os.path.getsize(current_file_info.path)
-            self.net.send({"type": "collect_file_start", "recording_id": current_file_info.recording_id,
-                           "relative_file_path": current_file_info.relpath, "file_size": size})
-            self.current_sendfile = open(current_file_info.path, "rb")
+            device.catalog.remove(os.path.basename(dirpath))
+        else:
+            device.catalog.update(os.path.basename(dirpath))
+
+    def handle_recording(self, event: RecorderFinishedEvent):
+        device = self.devices[event.device]
+        # The event may come from a recording that is already finalized by stop_recording
+        if device.recorder is not None:
+            if device.recorder.finished:
+                self.finalize_recording(device)
+                self.send(device, {"type": "pong", "cmd_report": statusd("stop_recording")})
+
+    def handle_finalize_done(self, event: FinalizeDoneEvent):
+        device = self.devices[event.device]
+        job = next((job for job in device.finalize_jobs if job.dirname == event.dirname), None)
+        if job is None:
+            logger.warning(f"Finalization of {event.dirname} is reported, but it is not being finalized on "
+                           f"device {device.index}")
+            return
+        device.finalize_jobs.remove(job)
+        device.catalog.update(job.dirname)
+        if job.exception is None:
+            logger.info("Recording finalized successfully")
+        if self.finalize_jobs_count == 0:
+            deferred_commands, self.deferred_commands = self.deferred_commands, []
+            for msg in deferred_commands:
+                logger.info(f"Running the deferred command '{msg['type']}'")
+                self.command_handlers[msg["type"]](self.devices[msg.get("device", 0)], msg)
+
+    def handle_sendfile_done(self, event: SendFileDone):
+        for ind, queued_file in enumerate(self.sendfile_queue):
+            if queued_file.device == event.device and queued_file.recording_id == event.recording_id and \
+                    queued_file.relpath == event.relpath:
+                del self.sendfile_queue[ind]
+                break
+        else:
+            # Transfer was cancelled by stop_collect
+            return
+        if event.cancelled:
+            logger.info(f"Transfer of {event.relpath} of recording {event.recording_id} is cancelled")
+        elif event.error is not None:
+            logger.error(f"Failed to transfer {event.relpath} of recording {event.recording_id}: {event.error}")
+        else:
+            logger.info(f"Transferred {event.relpath} of recording {event.recording_id} ({event.sent_bytes} bytes)")
 
     def handle_kinect_status(self):
-        if not self.kinect.initialized:
-            self.kinect.try_initialize()
-
-    def image_encode(self, image: np.ndarray, format: str = "jpeg"):
-        fp = io.BytesIO()
-        Image.fromarray(image).save(fp, format)
-        img_encoded = fp.getvalue()
-        b64encoded = base64.b64encode(img_encoded).decode("utf-8")
-        return b64encoded
+        for device in self.devices:
+            if not device.kinect.initialized:
+                device.kinect.try_initialize()
+
+    def handle_preview(self, event: PreviewFrameEvent):
+        self._send_preview_frame(self.devices[event.device])
+
+    def _send_preview_frame(self, device: Device):
+        # Preview frame replies are sent once the worker has a new frame ready
+        if not device.preview_frame_requested:
+            return
+        frame = device.preview_worker.take_latest()
+        if frame is None:
+            return
+        device.preview_frame_requested = False
+        msgt = "get_preview_frame"
+        if "exception" not in frame:
+            # Successful replies are sent in the binary form (with the device index), see preview.pack_preview_frame
+            self.net.send(frame["packet"])
+        elif isinstance(frame["exception"], Kinect.NotActivatedException):
+            self.send(device, {"type": "preview_frame", "cmd_report":
+                statusd(msgt, "kinect fail", f"Kinect is not activated")})
+        elif isinstance(frame["exception"], Kinect.FrameGetFailException):
+            self.send(device, {"type": "preview_frame", "cmd_report":
+                statusd(msgt, "kinect fail", f"Failed to acquire a readable frame within "
+                                             f"{device.kinect.next_frame_timeout} seconds")})
+        else:
+            self.send(device, {"type": "preview_frame", "cmd_report":
+                statusd(msgt, "recorder fail", f"Failed to make a preview frame: {frame['exception']}")})
 
     def main_loop(self):
+        """
+        Waits for the incoming messages and the local events (recorder thread completion, ready preview frames,
+        finished file transfers) together on the network queue and dispatches them to the handlers.
+        Messages are handled for the device given by their "device" field, the first one if there is none.
+        The wait times out every kinect_check_period to retry the Kinect initialization while some Kinect
+        is not initialized and to stop if the network loop is gone.
+        """
         self.active = True
         while self.active:
             if not self.net.active:
                 self.active = False
                 break
-            msg = self.net.get(wait=False)
             self.handle_kinect_status()
-            self.handle_recording()
-            self.handle_sendfile()
+            msg = self.net.get(wait=True, timeout=self.kinect_check_period)
             if msg is None:
-                time.sleep(self.refresh_period)
+                continue
+            if not isinstance(msg, dict):
+                self.event_handlers[type(msg)](msg)
                 continue
             msgt = msg["type"]
-            logger.info(f"[MESSAGE] {msgt}")
-            if msgt == "start_preview":
-                try:
-                    self.start_kinect()
-                except Kinect.FrameGetFailException:
-                    self.net.send({"type": "pong", "cmd_report":
-                        statusd(msgt, "kinect fail", f"Failed to acquire a readable frame within "
-                                                     f"{self.kinect.init_frame_timeout} seconds")})
-                except Kinect.DoubleActivationException:
-                    self.net.send({"type": "pong", "cmd_report":
-                        statusd(msgt, "recorder fail", f"Kinect is already activated")})
-                else:
-                    self.net.send({"type": "pong", "cmd_report": statusd(msgt)})
-            elif msgt == "get_preview_frame":
-                color_scale = msg["color_scale"]
-                depth_scale = msg["depth_scale"]
-                try:
-                    color, depth, color_ts, depth_ts = self.get_preview_frame(color_scale, depth_scale)
-                except Kinect.NotActivatedException:
-                    self.net.send({"type": "preview_frame", "cmd_report":
-                        statusd(msgt, "kinect fail", f"Kinect is not activated")})
-                except Kinect.FrameGetFailException:
-                    self.net.send({"type": "preview_frame", "cmd_report":
-                        statusd(msgt, "kinect fail", f"Failed to acquire a readable frame within "
-                                                     f"{self.kinect.regular_frame_timeout} seconds")})
-                else:
-                    color_data = {"timestamp": color_ts, "data": self.image_encode(color, "jpeg")}
-                    depth_data = None
-                    if depth_scale is not None:
-                        depth_data = {"timestamp": depth_ts, "data": self.image_encode(depth, "png")}
-                    self.net.send({"type": "preview_frame", "cmd_report":
-                        statusd(msgt), "color": color_data, "depth": depth_data})
-            elif msgt == "stop_preview":
-                try:
-                    self.stop_kinect()
-                except Kinect.NotActivatedException:
-                    self.net.send({"type": "preview_frame", "cmd_report":
-                        statusd(msgt, "kinect fail", f"Kinect is not activated")})
-                else:
-                    self.net.send({"type": "pong", "cmd_report": statusd(msgt)})
-            elif msgt == "init_recording":
-                try:
-                    self.initialize_recording(msg["recording_id"], msg["recording_name"], msg["recording_duration"],
-                                              msg["participating_kinects"], msg["start_delay"])
-                except MainController.RecordingExistsException:
-                    self.net.send({"type": "pong", "cmd_report": statusd(msgt, "recorder fail",
-                                                                         "Recording already exists")})
-                else:
-                    self.net.send({"type": "pong", "cmd_report": statusd(msgt)})
-            elif msgt == "start_recording":
-                try:
-                    self.start_recording(msg["server_time"])
-                except Kinect.DoubleActivationException:
-                    self.net.send({"type": "pong", "cmd_report":
-                        statusd(msgt, "recorder fail", f"Kinect is already activated")})
-                except Kinect.FrameGetFailException:
-                    self.net.send({"type": "pong", "cmd_report":
-                        statusd(msgt, "kinect fail", f"Failed to acquire a readable frame within "
-                                                     f"{self.kinect.init_frame_timeout} seconds")})
-                else:
-                    self.net.send({"type": "pong", "cmd_report": statusd(msgt)})
-            elif msgt == "stop_recording":
-                if self.recorder is None:
-                    self.net.send({"type": "pong", "cmd_report": statusd(msgt, "recorder fail",
-                                                                         "No recording is running")})
-                else:
-                    self.recorder.active = False
-                    self.finalize_recording(msg["server_time"])
-                    self.net.send({"type": "pong", "cmd_report": statusd(msgt)})
-            elif msgt == "get_recordings_list":
-                rec_dict = self.get_recordings()
-                self.net.send({"type": "recordings_list", "cmd_report": statusd(msgt), "recordings": rec_dict})
-            elif msgt == "collect":
-                recording_id = msg["recording_id"]
-                try:
-                    added_files = self.add_recordings_sendfile_queue(recording_id)
-                except FileNotFoundError:
-                    self.net.send({"type": "pong", "cmd_report": statusd(msgt, "recorder fail",
-                                                                         f"Recording {msg['recording_id']} does not exist"),
-                                   "recording_id": recording_id, "files": None})
-                else:
-                    self.net.send({"type": "pong", "cmd_report": statusd(msgt, info=f"Will transfer"
-                                                                                    f" {len(added_files)} files"),
-                                   "recording_id": recording_id, "files": added_files})
-            elif msgt == "stop_collect":
-                if self.current_sendfile is not None:
-                    self.current_sendfile.close()
-                    self.current_sendfile = None
-                self.sendfile_queue = []
-                self.net.send({"type": "pong", "cmd_report": statusd(msgt)})
-            elif msgt == "delete_recording":
-                try:
-                    self.delete_recording(msg["recording_id"])
-                except FileNotFoundError:
-                    self.net.send({"type": "pong", "cmd_report": statusd(msgt, "recorder fail",
-                                                                         f"Recording {msg['recording_id']} does not exist")})
-                else:
-                    self.net.send({"type": "pong", "cmd_report": statusd(msgt)})
-            elif msgt == "get_kinect_calibration":
-                try:
-                    self.kinect.update_calibration()
-                    calibration_dict = self.kinect.calibration_dict
-                except Kinect.NotInitializedException:
-                    self.net.send({"type": "kinect_calibration", "cmd_report": statusd(msgt, "kinect fail",
-                                                                                       "Kinect is not initialized yet")})
-                else:
-                    self.net.send({"type": "kinect_calibration", "cmd_report": statusd(msgt),
-                                   "kinect_calibration": calibration_dict, "kinect_id": self.kinect.id})
-            elif msgt == "set_kinect_params":
-                self.kinect.update_params(msg["rgb_res"], msg["depth_wfov"], msg["depth_binned"],
-                                          msg["fps"], msg["sync_mode"], msg["sync_capture_delay"], msg["force_reinit"])
-                if self.kinect.initialized:
-                    self.net.send({"type": "pong", "cmd_report": statusd(msgt)})
-                else:
-                    self.net.send({"type": "pong", "cmd_report": statusd(msgt, "kinect fail",
-                                                                         "Failed to reinitialize Kinect")})
-            elif msgt == "get_status":
-                info = ""
-                recording_fps = 0
-                optionals = {}
-                # Kinect statuses (new: "ready", "preview", "recording", "kin. not ready",
-                #                  old: "recording", "active", "idle", "disconnected")
-                if self.kinect.active:
-                    if self.recorder is not None:
-                        kin_state = "recording"
-                        recording_fps = self.recorder.sliding_window_fps
-                        info = f"Recording at {recording_fps:.2f} FPS"
-                    else:
-                        kin_state = "preview"
-                else:
-                    if self.kinect.ready:
-                        kin_state = "ready"
-                    else:
-                        kin_state = "kin. not ready"
-                if "optionals" in msg:
-                    for opt_name in msg["optionals"]:
-                        if opt_name == "recording_fps":
-                            optionals["recording_fps"] = recording_fps
-                        elif opt_name == "disk_space":
-                            total, used, free = shutil.disk_usage(self.recordings_dir)
-                            optionals["disk_space"] = {"total": total, "used": used, "free": free}
-                        elif opt_name == "battery":
-                            battery = psutil.sensors_battery()
-                            if battery is None:
-                                optionals["battery"] = None
-                            else:
-                                plugged = battery.power_plugged
-                                percent = battery.percent
-                                optionals["battery"] = {"percent": percent, "plugged": plugged}
-                self.net.send({"type": "status", "cmd_report": statusd(msgt),
-                               "kinect_status": kin_state, "info": info,
-                               "transferring": len(self.sendfile_queue) > 0,
-                               "optionals": optionals})
-            elif msgt == "shutdown":
-                self.net.send({"type": "pong", "cmd_report": statusd(msgt)})
-                logger.info("Received shutdown message, attempting to call 'sudo shutdown now'")
-                os.system("sudo shutdown now")
-            elif msgt == "reboot":
-                self.net.send({"type": "pong", "cmd_report": statusd(msgt)})
-                logger.info("Received reboot message, attempting to call 'sudo shutdown -r now'")
-                os.system("sudo shutdown -r now")
+            device_index = msg.get("device", 0)
+            logger.info(f"[MESSAGE] {msgt} (device {device_index})")
+            if not 0 <= device_index < len(self.devices):
+                logger.warning(f"Command '{msgt}' for the unknown device {device_index}")
+                self.net.send({"type": "pong", "device": device_index, "cmd_report":
+                    statusd(msgt, "recorder fail", f"No device {device_index}")})
+                continue
+            device = self.devices[device_index]
+            if msgt in self.deferred_command_names and self.finalize_jobs_count > 0:
+                logger.info(f"Deferring '{msgt}' until {self.finalize_jobs_count} recordings are finalized")
+                self.deferred_commands.append(msg)
+            elif msgt in self.command_handlers:
+                self.command_handlers[msgt](device, msg)
             else:
                 logger.warning(f"Unrecognized command '{msgt}'")
-                self.net.send(
-                    {"type": "pong", "cmd_report": statusd(msgt, "recorder fail", "Unrecognized command")})
+                self.send(device, {"type": "pong", "cmd_report": statusd(msgt, "recorder fail",
+                                                                         "Unrecognized command")})
         logger.info("Main controller loop completed")
+
+    def cmd_start_preview(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        try:
+            self.start_preview(device)
+        except Kinect.FrameGetFailException:
+            self.send(device, {"type": "pong", "cmd_report":
+                statusd(msgt, "kinect fail", f"Failed to acquire a readable frame within "
+                                             f"{device.kinect.init_frame_timeout} seconds")})
+        except Kinect.DoubleActivationException:
+            self.send(device, {"type": "pong", "cmd_report":
+                statusd(msgt, "recorder fail", f"Kinect is already activated")})
+        else:
+            self.send(device, {"type": "pong", "cmd_report": statusd(msgt)})
+
+    def cmd_get_preview_frame(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        if device.preview_worker is None:
+            self.send(device, {"type": "preview_frame", "cmd_report":
+                statusd(msgt, "kinect fail", f"Kinect is not activated")})
+        else:
+            # The reply is sent by handle_preview once the frame is ready
+            device.preview_worker.request(msg["color_scale"], msg["depth_scale"], msg.get("jpeg_quality", 75))
+            device.preview_frame_requested = True
+            self._send_preview_frame(device)
+
+    def cmd_stop_preview(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        try:
+            self.stop_preview(device)
+        except Kinect.NotActivatedException:
+            self.send(device, {"type": "preview_frame", "cmd_report":
+                statusd(msgt, "kinect fail", f"Kinect is not activated")})
+        else:
+            self.send(device, {"type": "pong", "cmd_report": statusd(msgt)})
+
+    def cmd_init_recording(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        try:
+            self.initialize_recording(device, msg["recording_id"], msg["recording_name"], msg["recording_duration"],
+                                      msg["participating_kinects"], msg["start_delay"])
+        except MainController.RecordingExistsException:
+            self.send(device, {"type": "pong", "cmd_report": statusd(msgt, "recorder fail",
+                                                                     "Recording already exists")})
+        else:
+            self.send(device, {"type": "pong", "cmd_report": statusd(msgt)})
+
+    def cmd_start_recording(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        try:
+            self.start_recording(device, msg["server_time"])
+        except Kinect.DoubleActivationException:
+            self.send(device, {"type": "pong", "cmd_report":
+                statusd(msgt, "recorder fail", f"Kinect is already activated")})
+        except Kinect.FrameGetFailException:
+            self.send(device, {"type": "pong", "cmd_report":
+                statusd(msgt, "kinect fail", f"Failed to acquire a readable frame within "
+                                             f"{device.kinect.init_frame_timeout} seconds")})
+        else:
+            self.send(device, {"type": "pong", "cmd_report": statusd(msgt)})
+
+    def cmd_stop_recording(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        if device.recorder is None:
+            self.send(device, {"type": "pong", "cmd_report": statusd(msgt, "recorder fail",
+                                                                     "No recording is running")})
+        else:
+            device.recorder.active = False
+            self.finalize_recording(device, msg["server_time"])
+            self.send(device, {"type": "pong", "cmd_report": statusd(msgt)})
+
+    def cmd_get_recordings_list(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        rec_dict = self.get_recordings(device)
+        self.send(device, {"type": "recordings_list", "cmd_report": statusd(msgt), "recordings": rec_dict})
+
+    def cmd_collect(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        recording_id = msg["recording_id"]
+        try:
+            added_files = self.add_recordings_sendfile_queue(device, recording_id, msg.get("offsets"))
+        except FileNotFoundError:
+            self.send(device, {"type": "pong", "cmd_report": statusd(msgt, "recorder fail",
+                                                                     f"Recording {msg['recording_id']} does not exist"),
+                               "recording_id": recording_id, "files": None})
+        else:
+            self.send(device, {"type": "pong", "cmd_report": statusd(msgt, info=f"Will transfer"
+                                                                                f" {len(added_files)} files"),
+                               "recording_id": recording_id, "files": added_files})
+
+    def cmd_stop_collect(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        self.net.cancel_file_transfers(device.index)
+        self.sendfile_queue = [x for x in self.sendfile_queue if x.device != device.index]
+        self.send(device, {"type": "pong", "cmd_report": statusd(msgt)})
+
+    def cmd_delete_recording(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        try:
+            self.delete_recording(device, msg["recording_id"])
+        except FileNotFoundError:
+            self.send(device, {"type": "pong", "cmd_report": statusd(msgt, "recorder fail",
+                                                                     f"Recording {msg['recording_id']} does not exist")})
+        else:
+            self.send(device, {"type": "pong", "cmd_report": statusd(msgt)})
+
+    def cmd_get_kinect_calibration(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        try:
+            device.kinect.update_calibration()
+            calibration_dict = device.kinect.calibration_dict
+        except Kinect.NotInitializedException:
+            self.send(device, {"type": "kinect_calibration", "cmd_report": statusd(msgt, "kinect fail",
+                                                                                   "Kinect is not initialized yet")})
+        else:
+            self.send(device, {"type": "kinect_calibration", "cmd_report": statusd(msgt),
+                               "kinect_calibration": calibration_dict, "kinect_id": device.kinect.id})
+
+    def cmd_set_kinect_params(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        device.kinect.update_params(msg["rgb_res"], msg["depth_wfov"], msg["depth_binned"],
+                                    msg["fps"], msg["sync_mode"], msg["sync_capture_delay"], msg["force_reinit"])
+        if device.kinect.initialized:
+            self.send(device, {"type": "pong", "cmd_report": statusd(msgt)})
+        else:
+            self.send(device, {"type": "pong", "cmd_report": statusd(msgt, "kinect fail",
+                                                                     "Failed to reinitialize Kinect")})
+
+    def cmd_get_status(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        info = ""
+        recording_fps = 0
+        optionals = {}
+        kinect = device.kinect
+        recorder = device.recorder
+        # Kinect statuses (new: "ready", "preview", "recording", "kin. not ready",
+        #                  old: "recording", "active", "idle", "disconnected")
+        if kinect.active and not device.in_standby:
+            if recorder is not None:
+                kin_state = "recording"
+                recording_fps = recorder.sliding_window_fps
+                info = f"Recording at {recording_fps:.2f} FPS"
+            else:
+                kin_state = "preview"
+        else:
+            if kinect.ready:
+                kin_state = "ready"
+            else:
+                kin_state = "kin. not ready"
+        # Once the recording is over, its final statistics are reported
+        finished_stats = {} if device.last_recording_stats is None else device.last_recording_stats
+        if "optionals" in msg:
+            for opt_name in msg["optionals"]:
+                if opt_name == "recording_fps":
+                    optionals["recording_fps"] = recording_fps
+                elif opt_name == "recording_buffer":
+                    optionals["recording_buffer"] = None if recorder is None else recorder.buffer_status
+                elif opt_name == "stage_latency":
+                    optionals["stage_latency"] = \
+                        finished_stats.get("stage_latency") if recorder is None else recorder.stage_latency
+                elif opt_name == "frame_gaps":
+                    optionals["frame_gaps"] = finished_stats.get("frame_gaps") if recorder is None else recorder.frame_gaps
+                elif opt_name == "pickup_wait":
+                    optionals["pickup_wait"] = None if recorder is None else recorder.pickup_wait_stats
+                elif opt_name == "disk_space":
+                    total, used, free = shutil.disk_usage(device.recordings_dir)
+                    optionals["disk_space"] = {"total": total, "used": used, "free": free}
+                elif opt_name == "battery":
+                    battery = psutil.sensors_battery()
+                    if battery is None:
+                        optionals["battery"] = None
+                    else:
+                        plugged = battery.power_plugged
+                        percent = battery.percent
+                        optionals["battery"] = {"percent": percent, "plugged": plugged}
+        self.send(device, {"type": "status", "cmd_report": statusd(msgt),
+                           "kinect_status": kin_state, "info": info,
+                           "transferring": any(x.device == device.index for x in self.sendfile_queue),
+                           "finalizing": [job.status_dict for job in device.finalize_jobs],
+                           "optionals": optionals})
+
+    def cmd_get_devices(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        self.send(device, {"type": "devices", "cmd_report": statusd(msgt), "devices": len(self.devices)})
+
+    def cmd_shutdown(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        self.send(device, {"type": "pong", "cmd_report": statusd(msgt)})
+        logger.info("Received shutdown message, attempting to call 'sudo shutdown now'")
+        os.system("sudo shutdown now")
+
+    def cmd_reboot(self, device: Device, msg: dict):
+        msgt = msg["type"]
+        self.send(device, {"type": "pong", "cmd_report": statusd(msgt)})
+        logger.info("Received reboot message, attempting to call 'sudo shutdown -r now'")
+        os.system("sudo shutdown -r now")
@@ -0,0 +1,439 @@
+import io
+import os
+import json
+import time
+import logging
+import numpy as np
+from PIL import Image
+from dataclasses import dataclass
+from threading import Lock
+from typing import Tuple, List, Optional, Dict
+from kinrec_utils.timestamp_log import load_timestamp_log
+from .recorder import Kinect
+from .writers import DepthChunkWriter, color_format_files, depth_format_files
+
+logger = logging.getLogger("KR.simulator")
+
+# Nominal fields of view (horizontal, vertical) of the Azure Kinect cameras, in degrees
+COLOR_FOV = {(16, 9): (90., 59.), (4, 3): (90., 74.3)}
+DEPTH_FOV = {False: (75., 65.), True: (120., 120.)}
+
+
+def synthetic_depth_frames(resolution: Tuple[int, int], count: int, seed: int = 0) -> List[np.ndarray]:
+    """
+    Generates depth frames resembling a room scene: a tilted floor, a back wall and a moving sphere,
+    with sensor noise and invalid (zero) pixels
+    """
+    rng = np.random.default_rng(seed)
+    width, height = resolution
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    background = np.where(y > height * 0.6, 1500. + (height - y) * 8., 4000.)
+    frames = []
+    for frame_ind in range(count):
+        cx = width * (0.3 + 0.4 * np.sin(frame_ind / 30.) ** 2)
+        cy = height * 0.5
+        radius = min(width, height) * 0.2
+        dist2 = (x - cx) ** 2 + (y - cy) ** 2
+        sphere = 2000. - np.sqrt(np.clip(radius ** 2 - dist2, 0, None)) * 3.
+        depth = np.where(dist2 < radius ** 2, sphere, background)
+        depth += rng.normal(0, 4., size=depth.shape)
+        depth[rng.random(size=depth.shape) < 0.03] = 0
+        frames.append(np.clip(depth, 0, 65535).astype(np.uint16))
+    return frames
+
+
+def synthetic_color_frames(resolution: Tuple[int, int], count: int, seed: int = 0) -> List[np.ndarray]:
+    """
+    Generates BGRA frames of a gradient background with a moving box and a fixed noise pattern,
+    so that the encoders see both flat and textured areas
+    """
+    rng = np.random.default_rng(seed)
+    width, height = resolution
+    y, x = np.mgrid[0:height, 0:width]
+    background = np.empty((height, width, 4), dtype=np.uint8)
+    background[:, :, 0] = (x * 255 // max(width - 1, 1)).astype(np.uint8)
+    background[:, :, 1] = (y * 255 // max(height - 1, 1)).astype(np.uint8)
+    background[:, :, 2] = 128
+    background[:, :, 3] = 255
+    noise = rng.integers(0, 16, size=(height, width, 1), dtype=np.uint8)
+    background[:, :, :3] = np.minimum(background[:, :, :3].astype(np.uint16) + noise, 255)
+    box_width, box_height = width // 5, height // 4
+    frames = []
+    for frame_ind in range(count):
+        frame = background.copy()
+        left = int((width - box_width) * (0.5 + 0.5 * np.sin(frame_ind / 15.)))
+        top = (height - box_height) // 2
+        frame[top:top + box_height, left:left + box_width, :3] = (40, 200, 240)
+        frames.append(frame)
+    return frames
+
+
+def encode_jpeg(bgra: np.ndarray, quality: int = 90) -> np.ndarray:
+    fp = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(bgra[:, :, 2::-1])).save(fp, "jpeg", quality=quality)
+    return np.frombuffer(fp.getvalue(), dtype=np.uint8)
+
+
+def _fit_resolution(frame: np.ndarray, resolution: Tuple[int, int], resample) -> np.ndarray:
+    if frame.shape[1::-1] == tuple(resolution):
+        return frame
+    return np.asarray(Image.fromarray(frame).resize(tuple(resolution), resample))
+
+
+@dataclass
+class FrameSource:
+    """
+    Frames served by the simulated devices in a loop.
+    Color frames are BGRA arrays or JPEG payloads (1D uint8) depending on the color format,
+    color and depth loops may have different lengths.
+    """
+    color: List[np.ndarray]
+    depth: List[np.ndarray]
+    # Offsets of the color frames from the first one within the loop and the depth-color offset of every frame
+    # (device time, usec), taken from the replayed recording; frames follow the fps grid if None
+    color_offsets_usec: Optional[np.ndarray] = None
+    depth_color_offsets_usec: Optional[np.ndarray] = None
+    loop_usec: Optional[int] = None
+
+
+def synthetic_frame_source(color_resolution: Tuple[int, int], depth_resolution: Tuple[int, int],
+        color_format: str = "bgra", frames_count: int = 30, max_color_bytes: int = 2 ** 29) -> FrameSource:
+    # Large color frames are repeated more often to bound the memory use
+    color_count = int(np.clip(max_color_bytes // (color_resolution[0] * color_resolution[1] * 4), 1, frames_count))
+    color = synthetic_color_frames(color_resolution, color_count)
+    if color_format == "mjpeg":
+        color = [encode_jpeg(frame) for frame in color]
+    return FrameSource(color=color, depth=synthetic_depth_frames(depth_resolution, frames_count))
+
+
+def recording_frame_source(recording_dir: str, color_resolution: Tuple[int, int], depth_resolution: Tuple[int, int],
+        fps: float, color_format: str = "bgra", frames_count: int = 30) -> FrameSource:
+    """
+    Loads the first frames_count frames of a recording made by this recorder (a folder with metadata.json),
+    frames of a different resolution are resized. Timestamps are replayed only if the recording has the same fps.
+    """
+    import ffmpeg
+    from videoio import VideoReader, Uint16Reader
+    with open(os.path.join(recording_dir, "metadata.json")) as metadata_file:
+        metadata = json.load(metadata_file)
+    recorded_color_format = metadata.get("color_format", "mpeg2")
+    depth_format = metadata.get("depth_format", "mp4")
+    color_path = os.path.join(recording_dir, color_format_files[recorded_color_format][0])
+    depth_path = os.path.join(recording_dir, depth_format_files[depth_format][0])
+    color = []
+    if recorded_color_format == "mjpeg":
+        index = np.fromfile(color_path + ".idx", dtype=np.int64).reshape(-1, 2)
+        blob = np.memmap(color_path, dtype=np.uint8, mode="r")
+        for offset, length in index[:frames_count]:
+            payload = np.array(blob[offset:offset + length])
+            if color_format == "mjpeg" and Image.open(io.BytesIO(payload)).size == tuple(color_resolution):
+                color.append(payload)
+            else:
+                rgb = np.asarray(Image.open(io.BytesIO(payload)).convert("RGB"))
+                color.append(np.dstack([rgb[:, :, ::-1], np.full(rgb.shape[:2], 255, np.uint8)]))
+    else:
+        for rgb in VideoReader(color_path):
+            color.append(np.dstack([rgb[:, :, ::-1], np.full(rgb.shape[:2], 255, np.uint8)]))
+            if len(color) >= frames_count:
+                break
+    for ind, frame in enumerate(color):
+        if frame.ndim == 3:
+            frame = _fit_resolution(frame, color_resolution, Image.BILINEAR)
+            color[ind] = encode_jpeg(frame) if color_format == "mjpeg" else frame
+    depth = []
+    if depth_format in ["zstd", "lz4"]:
+        index = np.fromfile(depth_path + ".idx", dtype=np.int64).reshape(-1, 2)
+        blob = np.memmap(depth_path, dtype=np.uint8, mode="r")
+        width, height = np.frombuffer(bytes(blob[8:DepthChunkWriter.HEADER_SIZE]), dtype=np.uint32)
+        if depth_format == "zstd":
+            import zstandard
+            decompress = zstandard.ZstdDecompressor().decompress
+        else:
+            import lz4.frame
+            decompress = lz4.frame.decompress
+        for offset, length in index[:frames_count]:
+            depth.append(np.frombuffer(decompress(bytes(blob[offset:offset + length])), dtype=np.uint16)
+                         .reshape(int(height), int(width)))
+    elif depth_format == "ffv1":
+        stream_info = ffmpeg.probe(depth_path)["streams"][0]
+        width, height = stream_info["width"], stream_info["height"]
+        out, _ = ffmpeg.input(depth_path).output("pipe:", format="rawvideo", pix_fmt="gray16le",
+                                                 vframes=frames_count).run(capture_stdout=True, quiet=True)
+        depth = list(np.frombuffer(out, dtype=np.uint16).reshape(-1, height, width))
+    else:
+        for frame in Uint16Reader(depth_path):
+            depth.append(frame)
+            if len(depth) >= frames_count:
+                break
+    depth = [_fit_resolution(frame, depth_resolution, Image.NEAREST) for frame in depth]
+    if len(color) == 0 or len(depth) == 0:
+        raise ValueError(f"No frames to replay in {recording_dir}")
+    source = FrameSource(color=color, depth=depth)
+    timestamps_path = os.path.join(recording_dir, metadata.get("timestamps_file", "times.json"))
+    recorded_fps = metadata.get("start_params", {}).get("framerate")
+    if recorded_fps == fps and timestamps_path.endswith(".bin"):
+        timestamps = load_timestamp_log(timestamps_path)
+        loop_length = min(len(color), len(depth), len(timestamps["device_color_usec"]))
+        color_usec = timestamps["device_color_usec"][:loop_length]
+        source.color_offsets_usec = color_usec - color_usec[0]
+        source.depth_color_offsets_usec = timestamps["device_depth_usec"][:loop_length] - color_usec
+        source.loop_usec = int(source.color_offsets_usec[-1] + 1e6 / fps)
+    return source
+
+
+class SimulatorSyncHub:
+    """
+    Wired sync between the devices of one simulator: subordinates get frames only while a master is running,
+    delayed by their sync_capture_delay
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.master_start_ns: Optional[int] = None
+
+    def master_started(self, start_ns: int):
+        with self._lock:
+            self.master_start_ns = start_ns
+
+    def master_stopped(self):
+        with self._lock:
+            self.master_start_ns = None
+
+
+class SimulatedCalibration:
+    """
+    Pinhole calibration with the interface of the KinZ calibration objects
+    """
+
+    def __init__(self, resolution: Tuple[int, int], fov: Tuple[float, float], translation_mm: Tuple[float, ...]):
+        self.resolution = resolution
+        width, height = resolution
+        self.intrinsics = np.array([[width / 2. / np.tan(np.radians(fov[0]) / 2.), 0., (width - 1) / 2.],
+                                    [0., height / 2. / np.tan(np.radians(fov[1]) / 2.), (height - 1) / 2.],
+                                    [0., 0., 1.]])
+        self.translation_mm = np.array(translation_mm, dtype=np.float64).reshape(3, 1)
+
+    def get_size(self) -> Tuple[int, int]:
+        return self.resolution
+
+    def get_intrinsics_matrix(self, extended: bool = False) -> np.ndarray:
+        return self.intrinsics.copy()
+
+    def get_distortion_params(self) -> np.ndarray:
+        return np.zeros((1, 8))
+
+    def get_rotation_matrix(self) -> np.ndarray:
+        return np.eye(3)
+
+    def get_translation_vector(self) -> np.ndarray:
+        return self.translation_mm.copy()
+
+
+class _SimulatedData:
+    def __init__(self, buffer: np.ndarray, device_timestamp_usec: int, system_timestamp_nsec: int):
+        self.buffer = buffer
+        self.device_timestamp_usec = device_timestamp_usec
+        self.system_timestamp_nsec = system_timestamp_nsec
+
+
+class SimulatedKinect:
+    """
+    Device with the interface of kinz.Kinect, serving the frames of a FrameSource at the configured fps.
+    get_frames never blocks: it returns False until the next frame is due, like polling the SDK with a zero timeout.
+    Only the last queue_size frames are kept, older ones are dropped as by the SDK capture queue.
+    """
+    # Translation of the color camera w.r.t. the depth one, mm
+    DEPTH2COLOR_TRANSLATION = (-32., -2., 4.)
+
+    def __init__(self, source: FrameSource, serial: str, sync_hub: SimulatorSyncHub, resolution=1440, wfov=False,
+            binned=False, framerate=30, sync_mode="none", sync_capture_delay=0, imu_sensors=False,
+            color_format="bgra", queue_size: int = 2, **kwargs):
+        self.source = source
+        self.serial = serial
+        self.sync_hub = sync_hub
+        self.color_resolution = Kinect._color_resolutions_dict[resolution]
+        self.depth_resolution = Kinect._depth_resolutions_dict[(wfov, binned)]
+        self.wfov = wfov
+        self.fps = framerate
+        self.sync_mode = sync_mode
+        self.sync_capture_delay = sync_capture_delay
+        self.color_format = color_format
+        self.queue_size = queue_size
+        # Device timestamps count from the device opening
+        self._device_epoch_ns = time.monotonic_ns()
+        self._start_ns: Optional[int] = None
+        self._active = False
+        # Index of the last frame returned by get_frames since the stream start
+        self._frame_ind = -1
+        self._frame_ns = 0
+        self._frameget_usec = 0
+
+    def start_cameras(self):
+        self._active = True
+        self._frame_ind = -1
+        if self.sync_mode == "master":
+            self._start_ns = time.monotonic_ns()
+            self.sync_hub.master_started(self._start_ns)
+        elif self.sync_mode != "subordinate":
+            self._start_ns = time.monotonic_ns()
+
+    def get_camera_activation_status(self) -> bool:
+        return self._active
+
+    def stop_cameras(self):
+        self._active = False
+        if self.sync_mode == "master":
+            self.sync_hub.master_stopped()
+
+    def _stream_start_ns(self) -> Optional[int]:
+        if self.sync_mode != "subordinate":
+            return self._start_ns
+        master_start_ns = self.sync_hub.master_start_ns
+        if master_start_ns is None:
+            return None
+        if master_start_ns != self._start_ns:
+            # Master (re)started, the stream follows it
+            self._start_ns = master_start_ns
+            self._frame_ind = -1
+        return master_start_ns + self.sync_capture_delay * 1000
+
+    def _frame_offset_usec(self, frame_ind: int) -> int:
+        source = self.source
+        if source.color_offsets_usec is None:
+            return int(frame_ind * 1e6 / self.fps)
+        loop_length = len(source.color_offsets_usec)
+        return frame_ind // loop_length * source.loop_usec + int(source.color_offsets_usec[frame_ind % loop_length])
+
+    def _last_due_frame(self, elapsed_usec: int) -> int:
+        source = self.source
+        if source.color_offsets_usec is None:
+            return int(elapsed_usec * self.fps / 1e6)
+        loop_ind, loop_offset = divmod(elapsed_usec, source.loop_usec)
+        in_loop_ind = int(np.searchsorted(source.color_offsets_usec, loop_offset, side="right")) - 1
+        return loop_ind * len(source.color_offsets_usec) + in_loop_ind
+
+    def get_frames(self, get_color=True, get_depth=True, get_ir=False, get_sensors=False, align_depth=False) -> bool:
+        if not self._active:
+            return False
+        stream_start_ns = self._stream_start_ns()
+        curr_ns = time.monotonic_ns()
+        if stream_start_ns is None or curr_ns < stream_start_ns:
+            return False
+        last_due_ind = self._last_due_frame((curr_ns - stream_start_ns) // 1000)
+        next_ind = max(self._frame_ind + 1, last_due_ind - self.queue_size + 1)
+        if next_ind > last_due_ind:
+            return False
+        self._frame_ind = next_ind
+        self._frame_ns = stream_start_ns + self._frame_offset_usec(next_ind) * 1000
+        self._frameget_usec = int(time.time() * 1e6)
+        return True
+
+    def get_color_data(self) -> _SimulatedData:
+        color = self.source.color[self._frame_ind % len(self.source.color)]
+        return _SimulatedData(color, (self._frame_ns - self._device_epoch_ns) // 1000, self._frame_ns)
+
+    def get_depth_data(self) -> _SimulatedData:
+        source = self.source
+        depth = source.depth[self._frame_ind % len(source.depth)]
+        device_usec = (self._frame_ns - self._device_epoch_ns) // 1000
+        if source.depth_color_offsets_usec is not None:
+            device_usec += int(source.depth_color_offsets_usec[self._frame_ind % len(source.depth_color_offsets_usec)])
+        return _SimulatedData(depth, device_usec, self._frame_ns)
+
+    def get_last_frameget_timestamp_usec(self) -> int:
+        return self._frameget_usec
+
+    def get_serial_number(self) -> str:
+        return self.serial
+
+    def get_depth_calibration(self) -> SimulatedCalibration:
+        return SimulatedCalibration(self.depth_resolution, DEPTH_FOV[self.wfov], (0., 0., 0.))
+
+    def get_color_calibration(self) -> SimulatedCalibration:
+        width, height = self.color_resolution
+        aspect = (16, 9) if width * 9 == height * 16 else (4, 3)
+        return SimulatedCalibration(self.color_resolution, COLOR_FOV[aspect], self.DEPTH2COLOR_TRANSLATION)
+
+    def get_raw_calibration(self) -> str:
+        return json.dumps({"simulated": True, "serial": self.serial})
+
+    def get_depth2pc_map(self) -> np.ndarray:
+        """
+        Per-pixel (x/z, y/z) of the depth camera rays, as in the map provided by the SDK
+        """
+        intrinsics = self.get_depth_calibration().get_intrinsics_matrix()
+        width, height = self.depth_resolution
+        y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+        return np.dstack([(x - intrinsics[0, 2]) / intrinsics[0, 0],
+                          (y - intrinsics[1, 2]) / intrinsics[1, 1]]).astype(np.float32)
+
+    def get_depth2color_rotation_matrix(self) -> np.ndarray:
+        return np.eye(3)
+
+    def get_color2depth_rotation_matrix(self) -> np.ndarray:
+        return np.eye(3)
+
+    def get_depth2color_translation_vector(self) -> np.ndarray:
+        return np.array(self.DEPTH2COLOR_TRANSLATION).reshape(3, 1)
+
+    def get_color2depth_translation_vector(self) -> np.ndarray:
+        return -np.array(self.DEPTH2COLOR_TRANSLATION).reshape(3, 1)
+
+    def close(self):
+        if self._active:
+            self.stop_cameras()
+
+
+class SimulatorBackend:
+    """
+    Device backend serving simulated Kinects: synthetic frames, or frames replayed from an existing recording.
+    Frame sources are prepared once per camera mode and shared by the devices.
+    """
+    name = "simulator"
+
+    def __init__(self, source_dir: Optional[str] = None, devices_count: int = 1, frames_count: int = 30,
+            serial_prefix: str = "SIM"):
+        """
+        Args:
+            source_dir: folder of a recording to replay (with metadata.json), synthetic frames if None
+            devices_count: number of the simulated devices reported as connected
+            frames_count: number of distinct frames in the loop
+            serial_prefix: prefix of the serial numbers, followed by the device index
+        """
+        self.source_dir = source_dir
+        self.devices_count = devices_count
+        self.frames_count = frames_count
+        self.serial_prefix = serial_prefix
+        self.sync_hub = SimulatorSyncHub()
+        self._sources: Dict[tuple, FrameSource] = {}
+
+    def connected_count(self) -> int:
+        return self.devices_count
+
+    def frame_source(self, color_resolution: Tuple[int, int], depth_resolution: Tuple[int, int], fps: float,
+            color_format: str = "bgra") -> FrameSource:
+        key = (color_resolution, depth_resolution, fps, color_format)
+        if key not in self._sources:
+            start_time = time.monotonic()
+            if self.source_dir is None:
+                source = synthetic_frame_source(color_resolution, depth_resolution, color_format, self.frames_count)
+            else:
+                source = recording_frame_source(self.source_dir, color_resolution, depth_resolution, fps,
+                                                color_format, self.frames_count)
+            logger.info(f"Prepared {len(source.color)} color and {len(source.depth)} depth simulated frames "
+                        f"in {time.monotonic() - start_time:.1f} s")
+            self._sources[key] = source
+        return self._sources[key]
+
+    def clear(self):
+        """
+        Drops the prepared frame sources, opened devices keep theirs
+        """
+        self._sources = {}
+
+    def open(self, device_index: int = 0, **start_params) -> SimulatedKinect:
+        source = self.frame_source(Kinect._color_resolutions_dict[start_params.get("resolution", 1440)],
+                                   Kinect._depth_resolutions_dict[(start_params.get("wfov", False),
+                                                                   start_params.get("binned", False))],
+                                   start_params.get("framerate", 30), start_params.get("color_format", "bgra"))
+        return SimulatedKinect(source, f"{self.serial_prefix}{device_index:09d}", self.sync_hub, **start_params)
@@ -0,0 +1,72 @@
+import logging
+from bisect import bisect_right
+from typing import Optional, Sequence
+
+logger = logging.getLogger("KR.stats")
+
+
+class FrameGapDetector:
+    """
+    Detects dropped frames online from the device timestamps: a delta between the consecutive timestamps of a stream
+    spanning several frame periods means the frames in between were lost.
+    Color and depth of the same capture are considered desynchronized if their timestamps differ by more than
+    half of the frame period.
+    """
+
+    def __init__(self, fps: float):
+        self.frame_period = 1e6 / fps  # in usec, same as the device timestamps
+        self.dropped_color = 0
+        self.dropped_depth = 0
+        self.desync = 0
+        self._last_color_ts: Optional[int] = None
+        self._last_depth_ts: Optional[int] = None
+
+    def _count_missed(self, last_ts: Optional[int], ts: int) -> int:
+        if last_ts is None:
+            return 0
+        return max(int(round((ts - last_ts) / self.frame_period)) - 1, 0)
+
+    def update(self, color_ts: int, depth_ts: int):
+        missed_color = self._count_missed(self._last_color_ts, color_ts)
+        missed_depth = self._count_missed(self._last_depth_ts, depth_ts)
+        if missed_color > 0 or missed_depth > 0:
+            logger.warning(f"Frame gap detected: {missed_color} color and {missed_depth} depth frames missing")
+        self.dropped_color += missed_color
+        self.dropped_depth += missed_depth
+        if abs(color_ts - depth_ts) > self.frame_period / 2:
+            self.desync += 1
+        self._last_color_ts = color_ts
+        self._last_depth_ts = depth_ts
+
+    def status_dict(self) -> dict:
+        return {"dropped_color": self.dropped_color, "dropped_depth": self.dropped_depth, "desync": self.desync}
+
+
+class LatencyHistogram:
+    """
+    Fixed-bucket histogram of per-frame durations, cheap enough to be updated on every frame.
+    Bucket i counts the durations in [edges[i-1], edges[i]), the last bucket counts everything above the last edge.
+    """
+    DEFAULT_EDGES_MS = (1, 2, 4, 8, 16, 33, 66, 133, 266)
+
+    def __init__(self, edges_ms: Sequence[float] = DEFAULT_EDGES_MS):
+        self.edges_ms = tuple(edges_ms)
+        self._edges_ns = tuple(int(edge * 1e6) for edge in self.edges_ms)
+        self.counts = [0] * (len(self.edges_ms) + 1)
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def add(self, duration_ns: int):
+        self.counts[bisect_right(self._edges_ns, duration_ns)] += 1
+        self.total_ns += duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def to_dict(self) -> dict:
+        count = self.count
+        return {"edges_ms": list(self.edges_ms), "counts": list(self.counts), "count": count,
+                "mean_ms": self.total_ns / count / 1e6 if count > 0 else 0., "max_ms": self.max_ns / 1e6}
@@ -0,0 +1,189 @@
+import os
+import json
+import struct
+import hashlib
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Optional, Callable, Tuple, Dict
+
+logger = logging.getLogger("KR.transfer")
+
+# Binary file chunk: header (magic, stream id) followed by the file data
+FILE_CHUNK_HEADER_FORMAT = "<4sI"
+FILE_CHUNK_HEADER_SIZE = struct.calcsize(FILE_CHUNK_HEADER_FORMAT)
+FILE_CHUNK_MAGIC = b"KRFC"
+
+
+@dataclass
+class SendFileJob:
+    path: str
+    relpath: str
+    recording_id: int
+    # Bytes already received by the server, transfer resumes from there
+    offset: int = 0
+    # Kinect of the recording, for the recorders driving several ones
+    device: int = 0
+
+
+@dataclass
+class SendFileDone:
+    recording_id: int
+    relpath: str
+    sent_bytes: int
+    error: Optional[str] = None
+    device: int = 0
+    # Interrupted by FileSender.cancel, not failed
+    cancelled: bool = False
+
+
+@dataclass
+class CancelTransfers:
+    # Transfers of this device only, all of them if None
+    device: Optional[int] = None
+
+
+def new_file_hash() -> Tuple[str, object]:
+    """
+    Returns the name and a new incremental hash object of the fastest available algorithm:
+    xxh3_64 if xxhash is installed, BLAKE2b from the standard library otherwise
+    """
+    try:
+        import xxhash
+    except ImportError:
+        return "blake2b", hashlib.blake2b(digest_size=16)
+    return "xxh3_64", xxhash.xxh3_64()
+
+
+class FileSender:
+    """
+    Streams the queued files over the websocket inside the event loop of the network process.
+    Up to max_streams files are sent at once, multiplexed over the connection: every binary chunk starts with
+    a header holding the stream id announced in collect_file_start, so small files don't wait behind large videos.
+    Files are read and hashed in large chunks by worker threads, the next chunk of a file is read while the current
+    one is being sent. Every file is wrapped with the collect_file_start/collect_file_end messages, the latter
+    carries the hash of the whole file. The result of every job (sent, failed or cancelled) is reported
+    through the done_callback.
+    """
+
+    def __init__(self, websocket, done_callback: Callable[[SendFileDone], None], chunk_size: int = 4 * 2 ** 20,
+            max_streams: int = 3):
+        self.websocket = websocket
+        self.done_callback = done_callback
+        self.chunk_size = chunk_size
+        self.max_streams = max_streams
+        self._jobs = asyncio.Queue()
+        self._current_tasks: Dict[int, asyncio.Task] = {}
+        self._current_jobs: Dict[int, SendFileJob] = {}
+        self._last_stream_id = 0
+
+    def add(self, job: SendFileJob):
+        self._jobs.put_nowait(job)
+
+    def cancel(self, device: Optional[int] = None):
+        """
+        Drops the queued jobs and interrupts the files being sent
+
+        Args:
+            device: cancel only the transfers of the recordings of this device, all of them if None
+        """
+        kept_jobs = []
+        while not self._jobs.empty():
+            job = self._jobs.get_nowait()
+            if device is not None and job.device != device:
+                kept_jobs.append(job)
+        for job in kept_jobs:
+            self._jobs.put_nowait(job)
+        for stream_id, task in self._current_tasks.items():
+            if device is None or self._current_jobs[stream_id].device == device:
+                task.cancel()
+
+    async def run(self):
+        await asyncio.gather(*[self._stream_worker() for _ in range(self.max_streams)])
+
+    async def _stream_worker(self):
+        while True:
+            job = await self._jobs.get()
+            # Stream ids are unique over the connection, the files of all the devices share it
+            self._last_stream_id += 1
+            stream_id = self._last_stream_id
+            task = asyncio.create_task(self._send_file(job, stream_id))
+            self._current_tasks[stream_id] = task
+            self._current_jobs[stream_id] = job
+            try:
+                sent_bytes = await task
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    # The sender itself is being cancelled
+                    raise
+                logger.info(f"Transfer of {job.relpath} is cancelled")
+                self.done_callback(SendFileDone(job.recording_id, job.relpath, 0, device=job.device, cancelled=True))
+            except Exception as e:
+                logger.error(f"Failed to send {job.path}: {e}")
+                self.done_callback(SendFileDone(job.recording_id, job.relpath, 0, error=str(e), device=job.device))
+            else:
+                self.done_callback(SendFileDone(job.recording_id, job.relpath, sent_bytes, device=job.device))
+            finally:
+                del self._current_tasks[stream_id]
+                del self._current_jobs[stream_id]
+
+    async def _send_file(self, job: SendFileJob, stream_id: int) -> int:
+        loop = asyncio.get_running_loop()
+        size = os.path.getsize(job.path)
+        offset = job.offset
+        if not 0 <= offset <= size:
+            logger.warning(f"Cannot resume {job.relpath} from byte {offset} (file size is {size}), sending it whole")
+            offset = 0
+        sent_bytes = 0
+        hash_algorithm, file_hash = new_file_hash()
+        header = struct.pack(FILE_CHUNK_HEADER_FORMAT, FILE_CHUNK_MAGIC, stream_id)
+
+        def read_chunk() -> memoryview:
+            # The data is read right after the header to avoid copying the chunk.
+            # Both reading and hashing release the GIL, so they don't stall the event loop
+            packet = bytearray(FILE_CHUNK_HEADER_SIZE + self.chunk_size)
+            packet[:FILE_CHUNK_HEADER_SIZE] = header
+            data_size = f.readinto(memoryview(packet)[FILE_CHUNK_HEADER_SIZE:])
+            file_hash.update(memoryview(packet)[FILE_CHUNK_HEADER_SIZE:FILE_CHUNK_HEADER_SIZE + data_size])
+            return memoryview(packet)[:FILE_CHUNK_HEADER_SIZE + data_size]
+
+        def read_first_chunk() -> memoryview:
+            # The part of the file received by the server before is hashed without sending it,
+            # so that the hash always covers the whole file and verifies the data joined by the server too
+            while f.tell() < offset:
+                data = f.read(min(self.chunk_size, offset - f.tell()))
+                if len(data) == 0:
+                    break
+                file_hash.update(data)
+            return read_chunk()
+
+        with open(job.path, "rb") as f:
+            await self.websocket.send(json.dumps({"type": "collect_file_start", "recording_id": job.recording_id,
+                                                  "relative_file_path": job.relpath, "file_size": size,
+                                                  "offset": offset, "hash_algorithm": hash_algorithm,
+                                                  "stream_id": stream_id, "device": job.device}))
+            next_packet = loop.run_in_executor(None, read_first_chunk)
+            try:
+                while True:
+                    # Shielded, so that cancelling the transfer doesn't detach the future from the running read
+                    packet = await asyncio.shield(next_packet)
+                    if len(packet) == FILE_CHUNK_HEADER_SIZE:
+                        break
+                    # Read-ahead of the next chunk overlaps with sending the current one
+                    next_packet = loop.run_in_executor(None, read_chunk)
+                    await self.websocket.send(packet)
+                    sent_bytes += len(packet) - FILE_CHUNK_HEADER_SIZE
+            finally:
+                # A cancelled transfer may leave the read-ahead running, the file is closed only after it is done
+                while not next_packet.done():
+                    try:
+                        await asyncio.wait([next_packet])
+                    except asyncio.CancelledError:
+                        pass
+                if not next_packet.cancelled():
+                    # A failed read-ahead of an interrupted transfer is not an error of its own
+                    next_packet.exception()
+        await self.websocket.send(json.dumps({"type": "collect_file_end", "recording_id": job.recording_id,
+                                              "relative_file_path": job.relpath, "hash": file_hash.hexdigest(),
+                                              "stream_id": stream_id, "device": job.device}))
+        return sent_bytes
@@ -0,0 +1,329 @@
+import os
+import queue
+import numpy as np
+import ffmpeg
+import logging
+from multiprocessing import Process, Queue as MPQueue, get_start_method
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing import resource_tracker
+from videoio import Uint16Writer
+from kinrec_utils import timestamp_log
+from typing import Tuple, Union, List, Optional
+
+logger = logging.getLogger("KR.writers")
+
+# Files produced by each color recording format
+color_format_files = {
+    "mpeg2": ["color.mpeg"],
+    "mjpeg": ["color.mjpeg", "color.mjpeg.idx"]
+}
+# Files produced by each lossless depth storage backend
+depth_format_files = {
+    "mp4": ["depth.mp4"],
+    "ffv1": ["depth.mkv"],
+    "zstd": ["depth.zst", "depth.zst.idx"],
+    "lz4": ["depth.lz4", "depth.lz4.idx"]
+}
+timestamps_file = "times.bin"
+
+
+def recording_stream_files(color_format: str = "mpeg2", depth_format: str = "mp4") -> List[str]:
+    return color_format_files[color_format] + depth_format_files[depth_format]
+
+
+class IndexedBlobWriter:
+    """
+    Concatenates variable-length frame payloads into a blob file,
+    the (offset, length) pair of every frame is appended to an int64 index file
+    """
+
+    def __init__(self, path: str, index_path: str = None):
+        self.path = path
+        self.index_path = path + ".idx" if index_path is None else index_path
+        self._blob_file = open(self.path, "wb")
+        self._index_file = open(self.index_path, "wb")
+        self._offset = 0
+
+    def write(self, payload: np.ndarray):
+        length = len(payload)
+        self._blob_file.write(memoryview(payload))
+        self._index_file.write(np.array([self._offset, length], dtype=np.int64).tobytes())
+        self._offset += length
+
+    def close(self):
+        if self._blob_file is not None:
+            self._blob_file.close()
+            self._index_file.close()
+            self._blob_file = None
+            self._index_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class MjpegBlobWriter(IndexedBlobWriter):
+    """
+    Stores compressed MJPEG color frames as is, the blob is also a valid raw MJPEG stream for ffmpeg
+    """
+    pass
+
+
+class DepthChunkWriter(IndexedBlobWriter):
+    """
+    Stores every depth frame as a separately compressed uint16 chunk, which allows random access to the frames.
+    The blob starts with a header: magic, codec name (4 bytes) and the frame resolution (2 x uint32).
+    """
+    MAGIC = b"KRDC"
+    HEADER_SIZE = 16
+
+    def __init__(self, path: str, resolution: Tuple[int, int], codec: str = "zstd", level: Optional[int] = None,
+            index_path: str = None):
+        """
+        Args:
+            path: path to the blob file
+            resolution: (width, height) of the depth frames
+            codec: "zstd" or "lz4"
+            level: compression level, codec default if None
+            index_path: path to the index file, path + ".idx" if None
+        """
+        self.resolution = resolution
+        self.codec = codec
+        # Compression libraries are optional, only needed if the backend is used
+        if codec == "zstd":
+            import zstandard
+            self._compress = zstandard.ZstdCompressor(level=3 if level is None else level).compress
+        elif codec == "lz4":
+            import lz4.frame
+            level = 0 if level is None else level
+            self._compress = lambda data: lz4.frame.compress(data, compression_level=level)
+        else:
+            raise ValueError(f"Unknown depth chunk codec '{codec}'")
+        super().__init__(path, index_path)
+        self._blob_file.write(self.MAGIC + codec.encode("ascii").ljust(4, b"\0") +
+                              np.array(resolution, dtype=np.uint32).tobytes())
+        self._offset = self.HEADER_SIZE
+
+    def write(self, frame: np.ndarray):
+        assert frame.shape == (self.resolution[1], self.resolution[0]), \
+            f"Expected a depth frame of resolution {self.resolution}, got shape {frame.shape}"
+        super().write(self._compress(memoryview(np.ascontiguousarray(frame)).cast("B")))
+
+
+class RawVideoPipeWriter:
+    """
+    Encodes raw frames with ffmpeg, frames are written to the pipe directly from the source memory,
+    without intermediate copies
+    """
+
+    def __init__(self, path: str, resolution: Tuple[int, int], input_pix_fmt: str, frame_shape: Tuple[int, ...],
+            output_params: dict, fps: float = None):
+        self.resolution = resolution
+        self.frame_shape = frame_shape
+        input_params = dict(format='rawvideo', pix_fmt=input_pix_fmt, s='{}x{}'.format(*resolution), loglevel='quiet')
+        if fps is not None:
+            input_params['framerate'] = fps
+        self.ffmpeg_process = (
+            ffmpeg.input('pipe:', **input_params)
+            .output(path, **output_params)
+            .overwrite_output()
+            .run_async(pipe_stdin=True)
+        )
+
+    def write(self, frame: np.ndarray):
+        assert frame.shape == self.frame_shape, \
+            f"Expected a frame of shape {self.frame_shape}, got shape {frame.shape}"
+        self.ffmpeg_process.stdin.write(memoryview(np.ascontiguousarray(frame)).cast("B"))
+
+    def close(self):
+        if self.ffmpeg_process is not None:
+            self.ffmpeg_process.stdin.close()
+            self.ffmpeg_process.wait()
+            self.ffmpeg_process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TimestampLogWriter:
+    """
+    Append-only binary log of per-frame timestamps, one fixed-width row of int64 columns per frame.
+    The file starts with a header: magic, format version, number of columns (uint16 each)
+    and the null-padded column names, so that the rows can be memory-mapped directly when reading
+    (the format is defined in kinrec_utils.timestamp_log, which also reads it).
+    """
+    MAGIC = timestamp_log.MAGIC
+    VERSION = timestamp_log.VERSION
+    NAME_SIZE = timestamp_log.NAME_SIZE
+
+    def __init__(self, path: str, fields: List[str], flush_every: int = 30):
+        """
+        Args:
+            path: path to the log file
+            fields: names of the columns
+            flush_every: number of rows after which the file is flushed to the disk
+        """
+        self.path = path
+        self.fields = list(fields)
+        self.flush_every = flush_every
+        self.rows_count = 0
+        self._file = open(self.path, "wb")
+        header = self.MAGIC + np.array([self.VERSION, len(self.fields)], dtype=np.uint16).tobytes()
+        for field in self.fields:
+            assert len(field) < self.NAME_SIZE, f"Field name '{field}' is too long"
+            header += field.encode("ascii").ljust(self.NAME_SIZE, b"\0")
+        self._file.write(header)
+
+    def append(self, row: np.ndarray):
+        assert len(row) == len(self.fields)
+        self._file.write(np.asarray(row, dtype=np.int64).tobytes())
+        self.rows_count += 1
+        if self.rows_count % self.flush_every == 0:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class BGRAVideoWriter(RawVideoPipeWriter):
+    """
+    Encodes color frames given in the native BGRA layout of the camera.
+    Channel reordering is done by ffmpeg as a part of the pixel format conversion.
+    """
+
+    def __init__(self, path: str, resolution: Tuple[int, int], fps: float = None, codec: str = "mpeg2video",
+            quality: int = 2):
+        super().__init__(path, resolution, input_pix_fmt="bgra", frame_shape=(resolution[1], resolution[0], 4),
+                         output_params={"pix_fmt": "yuv420p", "c:v": codec, "q:v": quality}, fps=fps)
+
+
+class FFV1DepthWriter(RawVideoPipeWriter):
+    """
+    Losslessly encodes uint16 depth frames with FFV1, every frame is a keyframe to keep the seeking cheap
+    """
+
+    def __init__(self, path: str, resolution: Tuple[int, int], fps: float = None):
+        super().__init__(path, resolution, input_pix_fmt="gray16le", frame_shape=(resolution[1], resolution[0]),
+                         output_params={"pix_fmt": "gray16le", "c:v": "ffv1", "level": 3, "g": 1, "slices": 4},
+                         fps=fps)
+
+
+StreamWriter = Union[BGRAVideoWriter, MjpegBlobWriter, Uint16Writer, FFV1DepthWriter, DepthChunkWriter]
+
+
+def open_stream_writer(stream: str, recording_dir: str, resolution: Tuple[int, int],
+        fps: float, color_format: str = "mpeg2", depth_format: str = "mp4") -> StreamWriter:
+    if stream == "color":
+        path = os.path.join(recording_dir, color_format_files[color_format][0])
+        if color_format == "mjpeg":
+            return MjpegBlobWriter(path)
+        return BGRAVideoWriter(path, resolution=resolution, fps=fps)
+    elif stream == "depth":
+        path = os.path.join(recording_dir, depth_format_files[depth_format][0])
+        if depth_format == "ffv1":
+            return FFV1DepthWriter(path, resolution=resolution, fps=fps)
+        elif depth_format in ["zstd", "lz4"]:
+            return DepthChunkWriter(path, resolution=resolution, codec=depth_format)
+        return Uint16Writer(path, resolution=resolution, fps=fps, preset="ultrafast")
+    else:
+        raise ValueError(f"Unknown stream '{stream}'")
+
+
+def _encoder_process_main(stream: str, recording_dir: str, resolution: Tuple[int, int], fps: float,
+        color_format: str, depth_format: str, shm_name: str, shape: Tuple[int, ...], dtype: str, slots_queue: MPQueue,
+        acks_queue: MPQueue):
+    # The block is owned (and unlinked) by the parent process, do not let the tracker of this process clean it up
+    try:
+        shm = SharedMemory(name=shm_name, track=False)  # Python 3.13+
+    except TypeError:
+        shm = SharedMemory(name=shm_name)
+        if get_start_method() != "fork":
+            # Forked children share the resource tracker with the parent, others have their own
+            resource_tracker.unregister(shm._name, "shared_memory")
+    frames = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    try:
+        with open_stream_writer(stream, recording_dir, resolution, fps, color_format, depth_format) as writer:
+            while True:
+                slot_length = slots_queue.get()
+                if slot_length is None:
+                    break
+                slot, length = slot_length
+                try:
+                    writer.write(frames[slot] if length is None else frames[slot, :length])
+                except Exception as e:
+                    acks_queue.put(e)
+                    break
+                else:
+                    acks_queue.put(slot)
+    finally:
+        del frames
+        shm.close()
+
+
+class EncoderProcess:
+    """
+    Runs the writer of a single stream in a separate process.
+    Frames are read by the process directly from the shared memory slots of the frame buffer,
+    only the slot indices are passed through the queues.
+    """
+
+    class ProcessDiedException(Exception):
+        pass
+
+    def __init__(self, stream: str, recording_dir: str, resolution: Tuple[int, int], fps: float,
+            shared_spec: Tuple[str, Tuple[int, ...], str], color_format: str = "mpeg2", depth_format: str = "mp4"):
+        self.stream = stream
+        self._slots_queue = MPQueue()
+        self._acks_queue = MPQueue()
+        shm_name, shape, dtype = shared_spec
+        self.process = Process(target=_encoder_process_main, daemon=True,
+                               args=(stream, recording_dir, resolution, fps, color_format, depth_format, shm_name,
+                                     shape, dtype, self._slots_queue, self._acks_queue))
+        self.process.start()
+        logger.info(f"Started {stream} encoder process (pid {self.process.pid})")
+
+    def write(self, slot: int, length: Optional[int] = None):
+        """
+        Passes the slot (and the payload length for variable-length slots) to the encoder process
+        and waits until the frame is written
+        """
+        self._slots_queue.put((slot, length))
+        while True:
+            try:
+                ack = self._acks_queue.get(timeout=1.)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise EncoderProcess.ProcessDiedException(f"{self.stream} encoder process has exited "
+                                                              f"with code {self.process.exitcode}")
+            else:
+                break
+        if isinstance(ack, Exception):
+            raise ack
+
+    def close(self):
+        if self.process is not None:
+            if self.process.is_alive():
+                self._slots_queue.put(None)
+            self.process.join()
+            self.process = None
+            self._slots_queue.close()
+            self._acks_queue.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -4,6 +4,7 @@ import logging
 from logging.handlers import RotatingFileHandler
 from kinrec_recorder.recorder import MainController
 from kinrec_recorder.net import NetHandler
+from kinrec_recorder.devices import open_device_backend, device_backend_names
 from kinrec_recorder.internal import ColoredFormatter
 
 logger = logging.getLogger("KR")
@@ -30,6 +31,34 @@ if __name__ == "__main__":
     parser.add_argument("--logfile_maxsize", type=float, default=20., help="logfile maxsize (in MB)")
     parser.add_argument("--logfile_backups", type=int, default=2, help="logfile backup count")
     parser.add_argument("-s", "--server", default="192.168.1.40:4400", help="Server address and port")
+    parser.add_argument("--encoder_mode", choices=["thread", "process"], default="thread",
+                        help="Run color and depth encoders in threads or in separate processes")
+    parser.add_argument("--preroll", type=float, default=0.,
+                        help="Seconds of frames before the start command to include in the recordings; if positive, "
+                             "the capture is armed already at the recording initialization")
+    parser.add_argument("--standby", action="store_true",
+                        help="Keep the cameras running between the recordings and previews, so that the next one "
+                             "starts without the camera warm-up")
+    parser.add_argument("--calibdir", default=None,
+                        help="Folder of the cached Kinect calibrations, 'calibration' next to the recordings folder "
+                             "by default")
+    parser.add_argument("--net_mode", choices=["process", "thread"], default="process",
+                        help="Run the websocket client in a separate process or in a thread of the recorder process "
+                             "(lower message latency, no copies of the outgoing data)")
+    parser.add_argument("--device", choices=device_backend_names, default="kinz",
+                        help="Device backend: 'kinz' for the Azure Kinect, 'simulator' for a simulated camera")
+    parser.add_argument("--devices", type=int, default=1,
+                        help="Number of Kinects connected to this machine, each one is a separate recorder "
+                             "for the server")
+    parser.add_argument("--no_cpu_pinning", action="store_true",
+                        help="With several Kinects, don't split the CPU cores between their recordings")
+    parser.add_argument("--sim_source", default=None,
+                        help="Recording folder replayed by the simulated camera, synthetic frames if not set")
+    parser.add_argument("--color_format", choices=["bgra", "mjpeg"], default="bgra",
+                        help="Color format requested from the camera: 'bgra' frames are re-encoded to mpeg2, "
+                             "'mjpeg' frames are stored as is")
+    parser.add_argument("--depth_format", choices=["mp4", "ffv1", "zstd", "lz4"], default="mp4",
+                        help="Lossless depth storage backend, see benchmark.py to compare them")
 
     args = parser.parse_args()
 
@@ -44,8 +73,15 @@ if __name__ == "__main__":
         ws_logger.addHandler(file_handler)
 
     logger.info("Starting network")
-    net = NetHandler(args.server)
+    net = NetHandler(args.server, mode=args.net_mode)
     net.start()
+    device_backend = open_device_backend(args.device, **({} if args.device == "kinz" else
+                                                         {"source_dir": args.sim_source,
+                                                          "devices_count": args.devices}))
     logger.info("Starting main controller")
-    controller = MainController(net_handler=net, recordings_dir=args.recdir)
+    controller = MainController(net_handler=net, recordings_dir=args.recdir, encoder_mode=args.encoder_mode,
+                                color_format=args.color_format, depth_format=args.depth_format, preroll=args.preroll,
+                                calibration_dir=args.calibdir, standby=args.standby,
+                                device_backend=device_backend, devices_count=args.devices,
+                                pin_cpus=not args.no_cpu_pinning)
     controller.main_loop()
@@ -2,7 +2,7 @@ import tkinter as tk
 
 from .view import KinRecView
 from .controller import KinRecController
-from .recorder_communication import RecorderComm
+from .recorder_communication import RecorderComm, RecorderConnection
 from .parameters import app_default_parameters
 
 import logging
@@ -78,15 +78,24 @@ class KinRecApp(tk.Tk):
         return ind
 
     async def handle_new_recorder_connection(self, websocket):
-        recorder = RecorderComm(websocket, self.controller, self._next_recorder_id,
-                                connection_close_callback=self.handle_closed_recorder)
-        # recorder_task = asyncio.create_task()
-        recorder_id = self._next_recorder_id
-        self._connected_recorders[recorder_id] = recorder
-        self._connected_recorder_tasks[recorder_id] = None
-        logger.info(f"Created a new recorder ID {recorder_id}")
-        await self.controller.add_recorder(recorder, recorder_id)
-        await recorder.event_loop()
+        # Every Kinect of the recorder process is a separate recorder
+        connection = RecorderConnection(websocket)
+        try:
+            devices_count = await connection.get_devices_count()
+        except websockets.ConnectionClosed:
+            logger.warning("Recorder disconnected before reporting its devices")
+            return
+        for device in range(devices_count):
+            recorder_id = self._next_recorder_id
+            recorder = RecorderComm(websocket, self.controller, recorder_id,
+                                    connection_close_callback=self.handle_closed_recorder, device=device)
+            connection.add_comm(device, recorder)
+            # recorder_task = asyncio.create_task()
+            self._connected_recorders[recorder_id] = recorder
+            self._connected_recorder_tasks[recorder_id] = None
+            logger.info(f"Created a new recorder ID {recorder_id} (device {device} of the connection)")
+            await self.controller.add_recorder(recorder, recorder_id)
+        await connection.event_loop()
 
     async def recorder_server_loop(self, stop_event: asyncio.Event):
         host, port = self.server_address.split(":")
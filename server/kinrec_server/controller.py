@@ -14,8 +14,9 @@ from collections import defaultdict
 from .recorder_communication import RecorderComm
 from typing import Dict, Optional, Union, Sequence, Mapping, List
 from .internal import RecorderState, KinectParams, KinectNotReadyException, RecorderDisconnectedException, RecordsEntry, \
-    KinectCalibration
+    KinectCalibration, PreviewSettings
 from .view import KinRecView
+from .preview_control import AdaptivePreviewControl
 
 logger = logging.getLogger("KRS.controller")
 
@@ -31,6 +32,7 @@ class KinRecController:
         self._connected_recorders: Dict[int, RecorderComm] = {}
         self._preview_loop_active = defaultdict(lambda: False)
         self._preview_fps = preview_fps
+        self._preview_control = AdaptivePreviewControl(max_fps=preview_fps)
         self._preview_frame_received = asyncio.Event()
         self._preview_frame_received.set()
         self._recording_initialized_event = asyncio.Event()
@@ -55,6 +57,8 @@ class KinRecController:
         self._receive_speed_timeframe = 3
         self._recordings_received_last_size: Dict[int, np.ndarray] = {}
         self._recordings_received_last_timestamp: Dict[int, int] = {}
+        self._stage_latency: Dict[int, dict] = {}
+        self._stage_slow_frames: Dict[str, int] = defaultdict(int)
 
     def kinect_alias_from_recorder(self, recorder_id: int) -> Optional[int]:
         return self._kinect_id_mapping[self._connected_recorders[recorder_id].kinect_id]
@@ -62,18 +66,23 @@ class KinRecController:
     def kinect_alias_from_kinect(self, kinect_id: str) -> Optional[int]:
         return self._kinect_id_mapping[kinect_id]
 
-    async def _start_preview(self, recorder_id, color_scale: Union[float, int] = 3,
-            depth_scale: Optional[int] = 1):
+    async def _start_preview(self, recorder_id, settings: Optional[PreviewSettings] = None):
+        """
+        Runs the preview loop, the settings are adapted to the link if not given explicitly
+        """
         self._preview_loop_active[recorder_id] = True
         recorder = self._connected_recorders[recorder_id]
         await self._apply_last_kinect_params(ignore_sync=True)
         await recorder.start_preview()
+        self._preview_control.reset()
         while self._preview_loop_active[recorder_id]:
             await self._preview_frame_received.wait()
             if self._preview_loop_active[recorder_id]:
-                await recorder.get_preview_frame(color_scale, depth_scale)
+                curr_settings = self._preview_control.settings if settings is None else settings
+                await recorder.get_preview_frame(curr_settings.color_scale, curr_settings.depth_scale,
+                                                 curr_settings.jpeg_quality)
                 self._preview_frame_received.clear()
-                await asyncio.sleep(1. / self._preview_fps)
+                await asyncio.sleep(1. / curr_settings.fps)
 
     async def _stop_preview(self, recorder_id: int):
         self._preview_loop_active[recorder_id] = False
@@ -183,6 +192,8 @@ class KinRecController:
         self._curr_recording_initialized_ids = None
         self._curr_recording_started_ids = None
         self._curr_recording_stopped_ids = None
+        self._stage_latency = {}
+        self._stage_slow_frames = defaultdict(int)
 
     def _compile_recordings_list(self, recorderwise_reclists: Dict[int, dict]):
         recordings_completeness_tracker = dict()
@@ -253,7 +264,8 @@ class KinRecController:
                             file_prefix = f"{kin_alias}_{recorder_recording_kinect_id}"
                         recording_dict["participating_kinects"][recorder_recording_kinect_id]["alias"] = kin_alias
                         recording_dict["participating_kinects"][recorder_recording_kinect_id]["file_prefix"] = file_prefix
-                        curr_routines.append(recorder.collect(rec_id, rec_path, file_prefix))
+                        recorder_files = self._recorderwise_reclists[recorder_id][rec_id].get("files")
+                        curr_routines.append(recorder.collect(rec_id, rec_path, file_prefix, recorder_files))
                         ready_kinects.add(recorder_recording_kinect_id)
                 else:
                     logger.warning(f"{rec_id} not in {list(self._recorderwise_reclists[recorder_id].keys())}")
@@ -362,6 +374,58 @@ class KinRecController:
 
     def remove_recorder(self, recorder_id):
         del self._connected_recorders[recorder_id]
+        self._stage_latency.pop(recorder_id, None)
+
+    @staticmethod
+    def _merge_latency_histograms(histograms: Sequence[dict]) -> dict:
+        merged = {"edges_ms": histograms[0]["edges_ms"], "counts": list(histograms[0]["counts"]),
+                  "count": histograms[0]["count"], "mean_ms": histograms[0]["mean_ms"] * histograms[0]["count"],
+                  "max_ms": histograms[0]["max_ms"]}
+        for histogram in histograms[1:]:
+            assert histogram["edges_ms"] == merged["edges_ms"], "Cannot merge histograms with different buckets"
+            merged["counts"] = [x + y for x, y in zip(merged["counts"], histogram["counts"])]
+            merged["count"] += histogram["count"]
+            merged["mean_ms"] += histogram["mean_ms"] * histogram["count"]
+            merged["max_ms"] = max(merged["max_ms"], histogram["max_ms"])
+        merged["mean_ms"] = merged["mean_ms"] / merged["count"] if merged["count"] > 0 else 0.
+        return merged
+
+    def get_stage_latency(self) -> Dict[str, dict]:
+        """
+        Per-stage latency histograms of the recording pipeline, aggregated over all recording Kinects
+        """
+        recorders_latency = list(self._stage_latency.values())
+        if len(recorders_latency) == 0:
+            return {}
+        return {stage: self._merge_latency_histograms([x[stage] for x in recorders_latency])
+                for stage in recorders_latency[0]}
+
+    @staticmethod
+    def _count_slower_than(histogram: dict, duration_ms: float) -> int:
+        """
+        Estimated number of the histogram durations above duration_ms, the count of the bucket containing duration_ms
+        is interpolated linearly, the last (unbounded) bucket is counted whole
+        """
+        lower_edges = [0.] + histogram["edges_ms"]
+        upper_edges = histogram["edges_ms"] + [float("inf")]
+        slow_count = 0.
+        for lower_edge, upper_edge, count in zip(lower_edges, upper_edges, histogram["counts"]):
+            if lower_edge >= duration_ms or upper_edge == float("inf"):
+                slow_count += count
+            elif upper_edge > duration_ms:
+                slow_count += count * (upper_edge - duration_ms) / (upper_edge - lower_edge)
+        return int(round(slow_count))
+
+    def _check_stage_latency(self):
+        # Frames that took longer than the frame period at some stage, growth of their number
+        # means that the stage can't keep up and frames will be dropped once the buffer is full
+        frame_period_ms = 1000. / self._last_kinect_params.fps
+        for stage, histogram in self.get_stage_latency().items():
+            slow_frames = self._count_slower_than(histogram, frame_period_ms)
+            if slow_frames > self._stage_slow_frames[stage]:
+                logger.warning(f"Stage '{stage}': {slow_frames} frames took more than {frame_period_ms:.1f} ms "
+                               f"(mean {histogram['mean_ms']:.1f} ms, max {histogram['max_ms']:.1f} ms)")
+            self._stage_slow_frames[stage] = slow_frames
 
     async def ask_kinect_status(self):
         status_routines = [comm.get_status() for comm in self._connected_recorders.values()]
@@ -370,6 +434,9 @@ class KinRecController:
     ### Callbacks ###
     def comm_get_status_reply(self, recorder_id: int, reply_result: bool, recorder_state: RecorderState):
         if reply_result:
+            if recorder_state.stage_latency is not None:
+                self._stage_latency[recorder_id] = recorder_state.stage_latency
+                self._check_stage_latency()
             self._view.update_recorder_state(recorder_id, recorder_state)
         else:
             self._view.update_recorder_state(recorder_id, RecorderState())
@@ -425,6 +492,10 @@ class KinRecController:
         else:
             target_img = color_resized
         logger.info(f"Made a preview frame with resolution {target_img.shape}")
+        frame_stats = self._connected_recorders[recorder_id].last_preview_frame_stats
+        if frame_stats is not None:
+            self._preview_control.update(*frame_stats)
+            self._view.set_preview_info(self._preview_control.settings, *frame_stats)
         self._preview_frame_received.set()
         self._view.set_preview_frame(target_img)
 
@@ -516,10 +587,17 @@ class KinRecController:
         else:
             logger.error(f"Recorder {recorder_id}:{kin_alias} failed to reboot, more info: {info}")
 
-    def comm_file_receive_start(self, recorder_id: int, file_rec_id: int, file_rel_path: str, file_size: int):
+    def comm_file_receive_start(self, recorder_id: int, file_rec_id: int, file_rel_path: str, file_size: int,
+            offset: int = 0):
         kin_alias = self.kinect_alias_from_recorder(recorder_id)
-        logger.debug(
-            f"Will receive a file {file_rel_path} ({file_size / 2 ** 20:.2f}MB) from recorder {recorder_id}:{kin_alias}")
+        # Bytes received in the interrupted collection count towards the progress
+        self._recordings_received_size[file_rec_id] += offset
+        if offset > 0:
+            logger.debug(f"Will receive the rest of a file {file_rel_path} ({(file_size - offset) / 2 ** 20:.2f}MB of "
+                         f"{file_size / 2 ** 20:.2f}MB) from recorder {recorder_id}:{kin_alias}")
+        else:
+            logger.debug(f"Will receive a file {file_rel_path} ({file_size / 2 ** 20:.2f}MB) "
+                         f"from recorder {recorder_id}:{kin_alias}")
 
     def comm_file_receive_update(self, recorder_id: int, file_rec_id: int, file_rel_path: str, size_curr_received: int,
             size_already_received: int):
@@ -544,11 +622,18 @@ class KinRecController:
         # TODO: add view callback
 
     def comm_file_receive_end(self, recorder_id: int, file_rec_id: int, file_rel_path: str, file_size: int,
-            file_received: int):
+            file_received: int, hash_match: Optional[bool] = None):
+        """
+        hash_match is None if the file could not be verified (the recorder or the server lacks the hash algorithm,
+        or the transfer was interrupted)
+        """
         kin_alias = self.kinect_alias_from_recorder(recorder_id)
         if file_size != file_received:
             logger.error(
                 f"Received a corrupt file from {recorder_id}:{kin_alias}: {file_rel_path}, "
                 f"received {file_received / 2 * 20:.2f}MB, expected {file_size / 2 * 20:.2f}MB")
+        elif hash_match is False:
+            logger.error(f"Received a corrupt file from {recorder_id}:{kin_alias}: {file_rel_path}, "
+                         f"checksum mismatch")
         else:
             logger.info(f"Received a file from {recorder_id}:{kin_alias}: {file_rel_path}")
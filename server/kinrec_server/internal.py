@@ -1,7 +1,7 @@
 import logging
 import numpy as np
-from typing import NamedTuple, Optional, Dict
-from dataclasses import dataclass
+from typing import NamedTuple, Optional, Dict, List
+from dataclasses import dataclass, field
 from colorama import init as colorama_init, Fore
 
 
@@ -13,6 +13,22 @@ class RecorderState:
     free_space: int = 0  # in GB
     bat_power: int = 0  # 0..100
     bat_plugged: bool = False
+    # Frame gaps detected in the current recording, None if not reported
+    dropped_color: Optional[int] = None
+    dropped_depth: Optional[int] = None
+    desync: Optional[int] = None
+    # Per-stage latency histograms of the current recording, None if not reported
+    stage_latency: Optional[dict] = None
+    # Recordings being finalized in the background: recording_id, stage and the number of frames left to encode
+    finalizing: List[dict] = field(default_factory=list)
+
+
+@dataclass
+class PreviewSettings:
+    color_scale: int = 3
+    depth_scale: Optional[int] = 1
+    jpeg_quality: int = 75
+    fps: float = 10.
 
 
 @dataclass
@@ -0,0 +1,97 @@
+import logging
+from typing import Optional
+from .internal import PreviewSettings
+
+logger = logging.getLogger("KRS.preview_control")
+
+
+class AdaptivePreviewControl:
+    """
+    Chooses the preview settings from the measured round-trip time and size of the preview frames.
+    Settings are taken from a ladder ordered from the best to the cheapest one: the level is lowered as soon as
+    the smoothed round-trip time exceeds the target latency, and raised when the frames of the next level
+    are estimated to still fit into it.
+    """
+    # (color_scale, depth_scale, jpeg_quality), from the best to the cheapest
+    QUALITY_LADDER = [
+        (1, 1, 90),
+        (2, 1, 85),
+        (2, 1, 75),
+        (3, 1, 75),
+        (3, 1, 60),
+        (4, 2, 60),
+        (6, 2, 50),
+        (8, 4, 40)
+    ]
+    # Relative size of the frame of each quality w.r.t. quality 75, roughly measured on the Kinect frames
+    JPEG_QUALITY_SIZE_FACTORS = {90: 1.8, 85: 1.4, 75: 1., 60: 0.75, 50: 0.65, 40: 0.55}
+
+    def __init__(self, target_latency: float = 0.15, max_fps: float = 15., min_fps: float = 1.,
+            initial_level: int = 3, smoothing: float = 0.3, raise_after: int = 10):
+        """
+        Args:
+            target_latency: desired round-trip time of a preview frame, in seconds
+            max_fps, min_fps: limits of the preview request rate
+            initial_level: index of the starting settings in QUALITY_LADDER
+            smoothing: weight of the newest measurement in the exponential moving averages
+            raise_after: number of frames to wait at a level before trying a better one
+        """
+        self.target_latency = target_latency
+        self.max_fps = max_fps
+        self.min_fps = min_fps
+        self.initial_level = initial_level
+        self.smoothing = smoothing
+        self.raise_after = raise_after
+        self.reset()
+
+    def reset(self):
+        self.level = self.initial_level
+        self.rtt: Optional[float] = None
+        self.frame_bytes: Optional[float] = None
+        self._frames_at_level = 0
+
+    def _smooth(self, prev_value: Optional[float], value: float) -> float:
+        if prev_value is None:
+            return value
+        return prev_value * (1 - self.smoothing) + value * self.smoothing
+
+    def _relative_size(self, level: int) -> float:
+        color_scale, _, quality = self.QUALITY_LADDER[level]
+        return self.JPEG_QUALITY_SIZE_FACTORS[quality] / color_scale ** 2
+
+    def update(self, rtt: float, frame_bytes: int):
+        """
+        Registers the measurements of the received frame and adjusts the level
+        """
+        self._frames_at_level += 1
+        if self._frames_at_level < 2:
+            # The first frame after a switch may have been requested with the previous settings, it is skipped
+            return
+        self.rtt = self._smooth(self.rtt, rtt)
+        self.frame_bytes = self._smooth(self.frame_bytes, frame_bytes)
+        prev_level = self.level
+        if self.rtt > self.target_latency and self.level < len(self.QUALITY_LADDER) - 1:
+            self.level += 1
+        elif self._frames_at_level >= self.raise_after and self.level > 0:
+            # Transfer time is assumed to be proportional to the frame size
+            size_ratio = self._relative_size(self.level - 1) / self._relative_size(self.level)
+            if self.rtt * size_ratio < self.target_latency * 0.8:
+                self.level -= 1
+        if self.level != prev_level:
+            logger.info(f"Preview RTT {self.rtt * 1000.:.0f} ms, {self.frame_bytes / 1024.:.0f} KB/frame, "
+                        f"switching to {self.settings}")
+            self._frames_at_level = 0
+            # Measurements of the previous level don't describe the new one
+            self.rtt = None
+            self.frame_bytes = None
+
+    @property
+    def fps(self) -> float:
+        if self.rtt is None:
+            return self.max_fps
+        return max(min(1. / self.rtt, self.max_fps), self.min_fps)
+
+    @property
+    def settings(self) -> PreviewSettings:
+        color_scale, depth_scale, quality = self.QUALITY_LADDER[self.level]
+        return PreviewSettings(color_scale=color_scale, depth_scale=depth_scale, jpeg_quality=quality, fps=self.fps)
@@ -5,13 +5,16 @@ import time
 import logging
 import base64
 import io
+import struct
+import hashlib
 import websockets
 import os
 from io import BytesIO
 from PIL import Image
 from collections import namedtuple
 from functools import partial
-from typing import Optional, Union, List, Sequence
+from dataclasses import dataclass
+from typing import Optional, Union, List, Sequence, Tuple, Dict
 from .internal import RecorderState
 
 logger = logging.getLogger("KRS.recorder_comm")
@@ -26,6 +29,18 @@ class RecorderComm:
     class FileReceiveException(Exception):
         pass
 
+    @dataclass
+    class IncomingFile:
+        recording_id: int
+        rel_path: str
+        size: int
+        received: int
+        descriptor: object
+        hash: Optional[object] = None
+        path: Optional[str] = None
+        # Bytes received before the transfer was resumed
+        offset: int = 0
+
     callback_names = [
         "set_kinect_params_reply",
         "get_status_reply",
@@ -48,10 +63,26 @@ class RecorderComm:
     ]
     ControllerCallbacks = namedtuple("ControllerCallbacks", " ".join(callback_names))
     unmatched_answers = ["collect_file_start", "collect_file_end"]
-
-    def __init__(self, websocket, controller, recorder_id, connection_close_callback, full_status_update_step=30):
+    # Binary preview_frame replies, see kinrec_recorder.preview.pack_preview_frame
+    PREVIEW_HEADER_FORMAT = "<4sBBHqqII"
+    PREVIEW_HEADER_SIZE = struct.calcsize(PREVIEW_HEADER_FORMAT)
+    PREVIEW_MAGIC = b"KRPV"
+    PREVIEW_FLAG_DEPTH = 1
+    # Binary file chunks, see kinrec_recorder.transfer.FileSender
+    FILE_CHUNK_HEADER_FORMAT = "<4sI"
+    FILE_CHUNK_HEADER_SIZE = struct.calcsize(FILE_CHUNK_HEADER_FORMAT)
+    FILE_CHUNK_MAGIC = b"KRFC"
+
+    def __init__(self, websocket, controller, recorder_id, connection_close_callback, full_status_update_step=30,
+            device: int = 0):
+        """
+        Args:
+            device: index of the Kinect among the ones of the recorder process, see RecorderConnection
+        """
         self._recorder_id = recorder_id
         self._websocket = websocket
+        self._device = device
+        self._closed = False
         self._kinect_id = None
         self._event_loop_active = False
         self._kinect_calibration = None
@@ -61,11 +92,8 @@ class RecorderComm:
         self._recorder_transferring = False
         self._recording_paths = {}
         self._recording_prefixes = {}
-        self._current_file_descriptor = None
-        self._current_file_size = None
-        self._current_file_received = None
-        self._current_file_rel_path = None
-        self._current_file_rec_id = None
+        # Files being received, by the stream id, None is the id of the stream without chunk headers (older recorders)
+        self._incoming_files: Dict[Optional[int], RecorderComm.IncomingFile] = {}
         # self.controller_callbacks: RecorderComm.ControllerCallbacks = None
         self._register_callbacks(controller)
         self._connection_close_callback = connection_close_callback
@@ -73,7 +101,12 @@ class RecorderComm:
         self._till_full_status_update = 0
         self._full_status_update_step = full_status_update_step
         self._full_status_update_requested = False
+        # Recording statistics are requested from the start of the recording till its final status reply
+        self._recording_stats_requested = False
         self._last_status_reply_received = True
+        self._preview_request_time = None
+        # Round-trip time (s) and size (bytes) of the last received preview frame
+        self.last_preview_frame_stats: Optional[Tuple[float, int]] = None
 
     def _register_callbacks(self, controller):
         callbacks_list = []
@@ -116,148 +149,267 @@ class RecorderComm:
             await self.close()
             return
         if isinstance(msg, str):
-            msg_text = msg
-            msg = json.loads(msg)
-            if msg["type"] != "preview_frame":
-                logger.debug(f"INCOMING MESSAGE: {msg_text}")
-            if 'cmd_report' in msg:
-                cmd_report = msg['cmd_report']
-                try:
-                    waiting_event = self._match_answer(cmd_report)
-                except RecorderComm.UnmatchedAnswerException as e:
-                    logger.error(f"Received unexpected answer {e.cmd_report}, ignoring...")
+            self.process_json_message(json.loads(msg), msg)
+        else:
+            self.process_binary_message(msg)
+
+    def process_json_message(self, msg: dict, msg_text: str):
+        """
+        Args:
+            msg: decoded message
+            msg_text: message as received
+        """
+        if msg["type"] != "preview_frame":
+            logger.debug(f"INCOMING MESSAGE: {msg_text}")
+        if 'cmd_report' in msg:
+            cmd_report = msg['cmd_report']
+            try:
+                waiting_event = self._match_answer(cmd_report)
+            except RecorderComm.UnmatchedAnswerException as e:
+                logger.error(f"Received unexpected answer {e.cmd_report}, ignoring...")
+            else:
+                cmdt = cmd_report["cmd"]
+                cmd_result = cmd_report["result"]
+                cmd_info = cmd_report["info"]
+                if cmd_result != "OK":
+                    logger.error(f"Error on recorder {self._recorder_id}: {cmd_report}")
+                    return
                 else:
-                    cmdt = cmd_report["cmd"]
-                    cmd_result = cmd_report["result"]
-                    cmd_info = cmd_report["info"]
-                    if cmd_result != "OK":
-                        logger.error(f"Error on recorder {self._recorder_id}: {cmd_report}")
-                        return
+                    logger.info(f"{cmdt} -- OK")
+
+                if self._kinect_id is None and cmdt not in ["get_kinect_calibration", "get_status",
+                                                            "set_kinect_params", "get_recordings_list",
+                                                            "collect", "delete_recording", "shutdown",
+                                                            "reboot"]:
+                    logger.error(f"Received {cmdt} before obtaining Kinect info")
+                    return
+
+                if cmdt == "get_status":
+                    self._process_status_msg(msg)
+                elif cmdt == "get_kinect_calibration":
+                    self._process_calibration_msg(msg)
+                elif cmdt == "set_kinect_params":
+                    self.controller_callbacks.set_kinect_params_reply(True)
+                elif cmdt == "start_preview":
+                    self.controller_callbacks.start_preview_reply(cmd_result == "OK",
+                                                                  info=None if cmd_result == "OK" else cmd_info)
+                elif cmdt == "get_preview_frame":
+                    self._update_preview_frame_stats(len(msg_text))
+                    self._process_preview_frame(msg)
+                elif cmdt == "stop_preview":
+                    self.controller_callbacks.stop_preview_reply(cmd_result == "OK",
+                                                                 info=None if cmd_result == "OK" else cmd_info)
+                elif cmdt == "init_recording":
+                    self.controller_callbacks.init_recording_reply(cmd_result == "OK",
+                                                                    info=None if cmd_result == "OK" else cmd_info)
+                elif cmdt == "start_recording":
+                    self.controller_callbacks.start_recording_reply(cmd_result == "OK",
+                                                                    info=None if cmd_result == "OK" else cmd_info)
+                elif cmdt == "stop_recording":
+                    self.controller_callbacks.stop_recording_reply(cmd_result == "OK",
+                                                                   info=None if cmd_result == "OK" else cmd_info)
+                elif cmdt == "get_recordings_list":
+                    if cmd_result == "OK":
+                        self.controller_callbacks.get_recordings_list_reply(True, msg['recordings'])
                     else:
-                        logger.info(f"{cmdt} -- OK")
-
-                    if self._kinect_id is None and cmdt not in ["get_kinect_calibration", "get_status",
-                                                                "set_kinect_params", "get_recordings_list",
-                                                                "collect", "delete_recording", "shutdown",
-                                                                "reboot"]:
-                        logger.error(f"Received {cmdt} before obtaining Kinect info")
-                        return
-
-                    if cmdt == "get_status":
-                        self._process_status_msg(msg)
-                    elif cmdt == "get_kinect_calibration":
-                        self._process_calibration_msg(msg)
-                    elif cmdt == "set_kinect_params":
-                        self.controller_callbacks.set_kinect_params_reply(True)
-                    elif cmdt == "start_preview":
-                        self.controller_callbacks.start_preview_reply(cmd_result == "OK",
-                                                                      info=None if cmd_result == "OK" else cmd_info)
-                    elif cmdt == "get_preview_frame":
-                        self._process_preview_frame(msg)
-                    elif cmdt == "stop_preview":
-                        self.controller_callbacks.stop_preview_reply(cmd_result == "OK",
-                                                                     info=None if cmd_result == "OK" else cmd_info)
-                    elif cmdt == "init_recording":
-                        self.controller_callbacks.init_recording_reply(cmd_result == "OK",
-                                                                        info=None if cmd_result == "OK" else cmd_info)
-                    elif cmdt == "start_recording":
-                        self.controller_callbacks.start_recording_reply(cmd_result == "OK",
-                                                                        info=None if cmd_result == "OK" else cmd_info)
-                    elif cmdt == "stop_recording":
-                        self.controller_callbacks.stop_recording_reply(cmd_result == "OK",
-                                                                       info=None if cmd_result == "OK" else cmd_info)
-                    elif cmdt == "get_recordings_list":
-                        if cmd_result == "OK":
-                            self.controller_callbacks.get_recordings_list_reply(True, msg['recordings'])
-                        else:
-                            self.controller_callbacks.get_recordings_list_reply(False, info=cmd_info)
-                    elif cmdt == "collect":
-                        self.controller_callbacks.collect_reply(cmd_result == "OK", recording_id=msg['recording_id'],
-                                                                files=msg['files'],
-                                                                info=None if cmd_result == "OK" else cmd_info)
-                    elif cmdt == "delete_recording":
-                        self.controller_callbacks.delete_recording_reply(cmd_result == "OK",
-                                                                         info=None if cmd_result == "OK" else cmd_info)
-                    elif cmdt == "stop_collect":
-                        if cmd_result == "OK":
-                            self._file_collect_end()
-                        self.controller_callbacks.stop_collect_reply(cmd_result == "OK",
+                        self.controller_callbacks.get_recordings_list_reply(False, info=cmd_info)
+                elif cmdt == "collect":
+                    self.controller_callbacks.collect_reply(cmd_result == "OK", recording_id=msg['recording_id'],
+                                                            files=msg['files'],
+                                                            info=None if cmd_result == "OK" else cmd_info)
+                elif cmdt == "delete_recording":
+                    self.controller_callbacks.delete_recording_reply(cmd_result == "OK",
                                                                      info=None if cmd_result == "OK" else cmd_info)
-
-                    elif cmdt == "shutdown":
-                        self.controller_callbacks.shutdown_reply(cmd_result == "OK",
+                elif cmdt == "stop_collect":
+                    if cmd_result == "OK":
+                        self._all_files_collect_end()
+                    self.controller_callbacks.stop_collect_reply(cmd_result == "OK",
                                                                  info=None if cmd_result == "OK" else cmd_info)
-                    elif cmdt == "reboot":
-                        self.controller_callbacks.reboot_reply(cmd_result == "OK",
-                                                               info=None if cmd_result == "OK" else cmd_info)
-                    if waiting_event is not None:
-                        waiting_event.set()
-            else:
-                if msg["type"] == "collect_file_start":
-                    if self._current_file_rec_id is not None:
-                        raise self.FileReceiveException(f"Comm {self._recorder_id}:{self._kinect_id}: "
-                                                        f"Cannot receive more than one file at once")
-                    rec_id = msg["recording_id"]
-                    rec_path = self._recording_paths[rec_id]
-                    rec_file_prefix = self._recording_prefixes[rec_id]
-                    typename, file_ext = os.path.basename(msg["relative_file_path"]).split(".")[-2:]
-                    download_folder = ""
-                    if "color" in typename:
-                        download_folder = "color"
-                    elif "depth2pc" in typename:
-                        download_folder = "depth2pc_maps"
-                    elif "depth" in typename:
-                        download_folder = "depth"
-                    elif "time" in typename:
-                        download_folder = "times"
-
-                    filename = f"{rec_file_prefix}.{file_ext}"
-
-                    self._current_file_rel_path = os.path.join(download_folder, filename)
-                    self._current_file_rec_id = rec_id
-                    file_path = os.path.join(rec_path, self._current_file_rel_path)
-                    self._current_file_size = msg["file_size"]
-                    self._current_file_received = 0
-                    self._current_file_descriptor = open(file_path, "wb")
-                    self.controller_callbacks.file_receive_start(self._current_file_rec_id,
-                                                                 self._current_file_rel_path,
-                                                                 self._current_file_size)
-
-                elif msg["type"] == "collect_file_end":
-                    self._file_collect_end()
-                else:
-                    logger.error(f"Comm {self._recorder_id}:{self._kinect_id}: Unrecognized command '{msg['type']}'")
+
+                elif cmdt == "shutdown":
+                    self.controller_callbacks.shutdown_reply(cmd_result == "OK",
+                                                             info=None if cmd_result == "OK" else cmd_info)
+                elif cmdt == "reboot":
+                    self.controller_callbacks.reboot_reply(cmd_result == "OK",
+                                                           info=None if cmd_result == "OK" else cmd_info)
+                if waiting_event is not None:
+                    waiting_event.set()
         else:
-            if self._current_file_descriptor is None:
-                raise self.FileReceiveException(f"Comm {self._recorder_id}:{self._kinect_id} received a data packet,"
-                                                f" but has no opened files to write to")
+            if msg["type"] == "collect_file_start":
+                self._file_collect_start(msg)
+            elif msg["type"] == "collect_file_end":
+                self._file_collect_end(msg.get("stream_id"), msg.get("hash"))
             else:
-                self._current_file_descriptor.write(msg)
-                self._current_file_received += len(msg)
-                self.controller_callbacks.file_receive_update(self._current_file_rec_id,
-                                                              self._current_file_rel_path,
-                                                              len(msg),
-                                                              self._current_file_received)
-
-    def _file_collect_end(self):
-        if self._current_file_descriptor is not None:
-            self._current_file_descriptor.close()
+                logger.error(f"Comm {self._recorder_id}:{self._kinect_id}: Unrecognized command '{msg['type']}'")
+
+    def process_binary_message(self, msg: bytes):
+        if self.is_preview_packet(msg):
+            self._process_binary_preview_frame(msg)
+        elif msg[:len(self.FILE_CHUNK_MAGIC)] == self.FILE_CHUNK_MAGIC and len(msg) >= self.FILE_CHUNK_HEADER_SIZE:
+            _, stream_id = struct.unpack_from(self.FILE_CHUNK_HEADER_FORMAT, msg)
+            self._file_collect_data(stream_id, memoryview(msg)[self.FILE_CHUNK_HEADER_SIZE:])
+        else:
+            self._file_collect_data(None, msg)
+
+    def _file_collect_start(self, msg: dict):
+        stream_id = msg.get("stream_id")
+        if stream_id in self._incoming_files:
+            raise self.FileReceiveException(f"Comm {self._recorder_id}:{self._kinect_id}: "
+                                            f"Stream {stream_id} is already receiving a file")
+        rec_id = msg["recording_id"]
+        rel_path = self.local_file_rel_path(msg["relative_file_path"], self._recording_prefixes[rec_id])
+        file_path = os.path.join(self._recording_paths[rec_id], rel_path)
+        offset = msg.get("offset", 0)
+        if offset > 0:
+            # Resumed transfer: the data after the offset is overwritten
+            descriptor = open(file_path, "r+b")
+            descriptor.seek(offset)
+            descriptor.truncate()
         else:
+            descriptor = open(file_path, "wb")
+        self._incoming_files[stream_id] = self.IncomingFile(recording_id=rec_id, rel_path=rel_path,
+                                                            size=msg["file_size"], received=offset,
+                                                            descriptor=descriptor,
+                                                            hash=self._new_file_hash(msg.get("hash_algorithm")),
+                                                            path=file_path, offset=offset)
+        self.controller_callbacks.file_receive_start(rec_id, rel_path, msg["file_size"], offset)
+
+    def _file_collect_data(self, stream_id: Optional[int], data: Union[bytes, memoryview]):
+        if stream_id not in self._incoming_files:
+            raise self.FileReceiveException(f"Comm {self._recorder_id}:{self._kinect_id} received a data packet,"
+                                            f" but has no opened files to write to (stream {stream_id})")
+        incoming_file = self._incoming_files[stream_id]
+        incoming_file.descriptor.write(data)
+        if incoming_file.hash is not None and incoming_file.offset == 0:
+            # Resumed files are hashed from the disk once complete, see _file_collect_end
+            incoming_file.hash.update(data)
+        incoming_file.received += len(data)
+        self.controller_callbacks.file_receive_update(incoming_file.recording_id, incoming_file.rel_path,
+                                                      len(data), incoming_file.received)
+
+    def _new_file_hash(self, algorithm: Optional[str]):
+        """
+        Returns the incremental hash object matching the one of the recorder, None if the algorithm is not available
+        """
+        if algorithm is None:
+            return None
+        if algorithm == "blake2b":
+            return hashlib.blake2b(digest_size=16)
+        if algorithm == "xxh3_64":
+            try:
+                import xxhash
+            except ImportError:
+                pass
+            else:
+                return xxhash.xxh3_64()
+        logger.warning(f"Comm {self._recorder_id}:{self._kinect_id}: hash algorithm '{algorithm}' is not available, "
+                       f"received files will not be verified")
+        return None
+
+    @staticmethod
+    def local_file_rel_path(recorder_rel_path: str, file_prefix: str) -> str:
+        """
+        Path of the recorder file inside the collected recording folder
+        """
+        # Extension may be compound (e.g. "color.mjpeg.idx")
+        typename, file_ext = os.path.basename(recorder_rel_path).split(".", 1)
+        download_folder = ""
+        if "color" in typename:
+            download_folder = "color"
+        elif "depth2pc" in typename:
+            download_folder = "depth2pc_maps"
+        elif "depth" in typename:
+            download_folder = "depth"
+        elif "time" in typename:
+            download_folder = "times"
+        return os.path.join(download_folder, f"{file_prefix}.{file_ext}")
+
+    @classmethod
+    def partial_file_offsets(cls, recording_path: str, file_prefix: str, recorder_files: Dict[str, int]) \
+            -> Dict[str, int]:
+        """
+        Finds the files of the recording left from an interrupted collection.
+        Files of the full size are requested too (from their end), so that they are verified by the hash
+        of the whole file like the resumed ones.
+
+        Args:
+            recording_path: local folder of the recording
+            file_prefix: prefix of the local files of the recorder
+            recorder_files: sizes of the recorder files, by the recorder file name
+        Returns:
+            dict: number of bytes already received for each recorder file that exists locally
+        """
+        offsets = {}
+        for recorder_rel_path, size in recorder_files.items():
+            local_path = os.path.join(recording_path, cls.local_file_rel_path(recorder_rel_path, file_prefix))
+            if not os.path.isfile(local_path):
+                continue
+            local_size = os.path.getsize(local_path)
+            if 0 < local_size <= size:
+                offsets[recorder_rel_path] = local_size
+            elif local_size > size:
+                logger.warning(f"Local file {local_path} is larger than the recorder one, it will be received anew")
+        return offsets
+
+    def _file_collect_end(self, stream_id: Optional[int], expected_hash: Optional[str] = None):
+        """
+        Args:
+            stream_id: stream of the file, None for the older recorders
+            expected_hash: hash of the whole file computed by the recorder, None if the transfer was interrupted
+        """
+        incoming_file = self._incoming_files.pop(stream_id, None)
+        if incoming_file is None:
             logger.error(f"Comm {self._recorder_id}:{self._kinect_id}: Received 'collect_file_end', "
-                         f"but no file was opened")
-        self._current_file_descriptor = None
-        if self._current_file_received != self._current_file_size:
+                         f"but no file was opened (stream {stream_id})")
+            return
+        incoming_file.descriptor.close()
+        if incoming_file.received != incoming_file.size:
             logger.error(f"Comm {self._recorder_id}:{self._kinect_id}: File size mismatch: "
-                         f"received {self._current_file_received} but "
-                         f"should be {self._current_file_size}")
-        self.controller_callbacks.file_receive_end(self._current_file_rec_id,
-                                                   self._current_file_rel_path,
-                                                   self._current_file_size,
-                                                   self._current_file_received)
-        self._current_file_received = 0
-        self._current_file_size = None
-        self._current_file_rec_id = None
-        self._current_file_rel_path = None
+                         f"received {incoming_file.received} but "
+                         f"should be {incoming_file.size}")
+        hash_match = None
+        if expected_hash is not None and incoming_file.hash is not None:
+            if incoming_file.offset > 0:
+                # The part received before has to be hashed too, the whole file is read in a worker thread
+                # to keep the event loop responsive
+                hash_future = asyncio.get_running_loop().run_in_executor(None, self._hash_local_file,
+                                                                         incoming_file.path, incoming_file.hash)
+                hash_future.add_done_callback(partial(self._local_file_hash_done, incoming_file, expected_hash))
+                return
+            hash_match = incoming_file.hash.hexdigest() == expected_hash
+        self._file_received(incoming_file, hash_match)
+
+    @staticmethod
+    def _hash_local_file(path: str, file_hash, chunk_size: int = 4 * 2 ** 20) -> str:
+        with open(path, "rb") as local_file:
+            while True:
+                data = local_file.read(chunk_size)
+                if len(data) == 0:
+                    break
+                file_hash.update(data)
+        return file_hash.hexdigest()
+
+    def _local_file_hash_done(self, incoming_file: IncomingFile, expected_hash: str, hash_future: asyncio.Future):
+        try:
+            hash_match = hash_future.result() == expected_hash
+        except OSError as e:
+            logger.error(f"Comm {self._recorder_id}:{self._kinect_id}: Failed to verify {incoming_file.path}: {e}")
+            hash_match = None
+        self._file_received(incoming_file, hash_match)
+
+    def _file_received(self, incoming_file: IncomingFile, hash_match: Optional[bool]):
+        if hash_match is False and os.path.isfile(incoming_file.path):
+            # Kept for inspection under another name, so that the next collection receives the file anew
+            os.replace(incoming_file.path, incoming_file.path + ".corrupt")
+        self.controller_callbacks.file_receive_end(incoming_file.recording_id,
+                                                   incoming_file.rel_path,
+                                                   incoming_file.size,
+                                                   incoming_file.received,
+                                                   hash_match)
+
+    def _all_files_collect_end(self):
+        for stream_id in list(self._incoming_files.keys()):
+            self._file_collect_end(stream_id)
 
     async def update_kinect_id(self) -> str:
         event = asyncio.Event()
@@ -293,6 +445,8 @@ class RecorderComm:
             self._till_full_status_update = self._full_status_update_step
         else:
             optionals = []
+        if self._kinect_status == "recording" or self._recording_stats_requested:
+            optionals.extend(["frame_gaps", "stage_latency"])
         if self._last_status_reply_received:
             await self._send({"type": "get_status", "optionals": optionals})
             self._full_status_update_requested = False
@@ -301,8 +455,16 @@ class RecorderComm:
     async def start_preview(self):
         await self._send({"type": "start_preview"})
 
-    async def get_preview_frame(self, color_scale: Union[float, int] = 1, depth_scale: Optional[int] = 1):
-        await self._send({"type": "get_preview_frame", "color_scale": color_scale, "depth_scale": depth_scale})
+    async def get_preview_frame(self, color_scale: Union[float, int] = 1, depth_scale: Optional[int] = 1,
+            jpeg_quality: int = 75):
+        self._preview_request_time = time.monotonic()
+        await self._send({"type": "get_preview_frame", "color_scale": color_scale, "depth_scale": depth_scale,
+                          "jpeg_quality": jpeg_quality})
+
+    def _update_preview_frame_stats(self, frame_size: int):
+        if self._preview_request_time is not None:
+            self.last_preview_frame_stats = (time.monotonic() - self._preview_request_time, frame_size)
+            self._preview_request_time = None
 
     async def stop_preview(self):
         await self._send({"type": "stop_preview"})
@@ -314,6 +476,7 @@ class RecorderComm:
 
     async def start_recording(self, server_time):
         self._append_sent_cmd("stop_recording")
+        self._recording_stats_requested = True
         await self._send({"type": "start_recording","server_time": server_time})
 
     async def stop_recording(self, server_time):
@@ -322,10 +485,21 @@ class RecorderComm:
     async def get_recordings_list(self):
         await self._send({"type": "get_recordings_list"})
 
-    async def collect(self, recording_id, recording_path, file_prefix):
+    async def collect(self, recording_id, recording_path, file_prefix, recorder_files: Optional[Dict[str, int]] = None):
+        """
+        Args:
+            recorder_files: sizes of the recorder files of the recording (from the recordings list), if given,
+                only the missing tails of the files partially received before are requested
+        """
         self._recording_paths[recording_id] = recording_path
         self._recording_prefixes[recording_id] = file_prefix
-        await self._send({"type": "collect", "recording_id": recording_id})
+        offsets = {}
+        if recorder_files is not None:
+            offsets = self.partial_file_offsets(recording_path, file_prefix, recorder_files)
+            if len(offsets) > 0:
+                logger.info(f"Comm {self._recorder_id}:{self._kinect_id}: resuming the collection of recording "
+                            f"{recording_id}, {sum(offsets.values()) / 2 ** 20:.2f}MB already received")
+        await self._send({"type": "collect", "recording_id": recording_id, "offsets": offsets})
 
     async def delete_recording(self, recording_id):
         await self._send({"type": "delete_recording", "recording_id": recording_id})
@@ -346,6 +520,8 @@ class RecorderComm:
         if isinstance(data, dict):
             logger.info(f"Sending '{data['type']}'")
             self._sent_cmds.append((data['type'], waiting_event))
+            # Recorders driving a single Kinect ignore the field
+            data["device"] = self._device
             data = json.dumps(data)
         try:
             await self._websocket.send(data)
@@ -353,7 +529,17 @@ class RecorderComm:
             await self.close()
 
     async def close(self):
+        if self._closed:
+            # Comms of a connection are closed by both the failed send and the connection
+            return
+        self._closed = True
         self.stop_event_loop()
+        for incoming_file in self._incoming_files.values():
+            # The received part is kept, the next collection resumes from it
+            logger.warning(f"Comm {self._recorder_id}:{self._kinect_id}: connection closed while receiving "
+                           f"{incoming_file.rel_path} ({incoming_file.received}/{incoming_file.size})")
+            incoming_file.descriptor.close()
+        self._incoming_files = {}
         await self._websocket.close()
         self.controller_callbacks.get_status_reply(False, self._last_state)
         self._connection_close_callback(self._recorder_id)
@@ -365,8 +551,12 @@ class RecorderComm:
         self._send({"type": "get_kinect_calibration"})
 
     def _process_status_msg(self, msg):
+        # The first reply after the recording carries its final statistics
+        recording_just_finished = self._kinect_status == "recording" and msg["kinect_status"] != "recording"
         self._kinect_status = msg["kinect_status"]
         self._recorder_transferring = msg["transferring"]
+        # Older recorders finalize the recordings synchronously and don't report it
+        self._last_state.finalizing = msg.get("finalizing", [])
         self._last_state.status = msg["kinect_status"]
         if "battery" in msg["optionals"]:
             if msg["optionals"]["battery"] is None:
@@ -377,6 +567,20 @@ class RecorderComm:
                 self._last_state.bat_plugged = bool(msg["optionals"]["battery"]["plugged"])
         if "disk_space" in msg["optionals"]:
             self._last_state.free_space = int(msg["optionals"]["disk_space"]["free"] / 2 ** 30)
+        recording_stats = msg["kinect_status"] == "recording" or recording_just_finished
+        if recording_just_finished:
+            self._recording_stats_requested = False
+        if not recording_stats:
+            # Not started yet, or the statistics of an earlier recording
+            self._last_state.dropped_color = self._last_state.dropped_depth = self._last_state.desync = None
+            self._last_state.stage_latency = None
+        elif "frame_gaps" in msg["optionals"] and msg["optionals"]["frame_gaps"] is not None:
+            frame_gaps = msg["optionals"]["frame_gaps"]
+            self._last_state.dropped_color = frame_gaps["dropped_color"]
+            self._last_state.dropped_depth = frame_gaps["dropped_depth"]
+            self._last_state.desync = frame_gaps["desync"]
+        if recording_stats and "stage_latency" in msg["optionals"] and msg["optionals"]["stage_latency"] is not None:
+            self._last_state.stage_latency = msg["optionals"]["stage_latency"]
         self._last_status_reply_received = True
         self.controller_callbacks.get_status_reply(True, self._last_state)
 
@@ -400,6 +604,36 @@ class RecorderComm:
         img = np.array(Image.open(BytesIO(data), formats=[format]))
         return img
 
+    @classmethod
+    def is_preview_packet(cls, msg: bytes) -> bool:
+        # Sizes in the header have to match the packet size, so that a file chunk can't be mistaken for a preview
+        if len(msg) < cls.PREVIEW_HEADER_SIZE or msg[:len(cls.PREVIEW_MAGIC)] != cls.PREVIEW_MAGIC:
+            return False
+        color_size, depth_size = struct.unpack_from("<II", msg, cls.PREVIEW_HEADER_SIZE - 8)
+        return len(msg) == cls.PREVIEW_HEADER_SIZE + color_size + depth_size
+
+    def _process_binary_preview_frame(self, msg: bytes):
+        try:
+            waiting_event = self._match_answer({"cmd": "get_preview_frame"})
+        except RecorderComm.UnmatchedAnswerException:
+            logger.error("Received unexpected preview frame, ignoring...")
+            return
+        self._update_preview_frame_stats(len(msg))
+        _, version, flags, _, color_ts, depth_ts, color_size, depth_size = \
+            struct.unpack_from(self.PREVIEW_HEADER_FORMAT, msg)
+        data = memoryview(msg)
+        color_start = self.PREVIEW_HEADER_SIZE
+        color = np.array(Image.open(BytesIO(data[color_start:color_start + color_size]), formats=["jpeg"]))
+        if flags & self.PREVIEW_FLAG_DEPTH:
+            depth_start = color_start + color_size
+            depth = np.array(Image.open(BytesIO(data[depth_start:depth_start + depth_size]), formats=["png"]))
+        else:
+            depth = None
+            depth_ts = None
+        self.controller_callbacks.get_preview_frame_reply(True, color, color_ts, depth, depth_ts)
+        if waiting_event is not None:
+            waiting_event.set()
+
     def _process_preview_frame(self, msg):
         cmd_report = msg['cmd_report']
         cmd_result = cmd_report["result"]
@@ -420,3 +654,86 @@ class RecorderComm:
             self.controller_callbacks.get_preview_frame_reply(True, color, color_ts, depth, depth_ts)
         else:
             self.controller_callbacks.get_preview_frame_reply(False, info=cmd_info)
+
+
+class RecorderConnection:
+    """
+    Websocket connection of a recorder process, which may drive several Kinects.
+    Every Kinect is a separate RecorderComm, i.e. a separate recorder for the controller. Incoming messages are
+    routed to the comms by the device index: the "device" field of the JSON messages, the header of the binary
+    preview frames and the stream of the file chunks. Recorders without it are a single device 0.
+    """
+
+    def __init__(self, websocket):
+        self._websocket = websocket
+        self._comms: Dict[int, RecorderComm] = {}
+        # Device of the file being received, by the stream id
+        self._stream_devices: Dict[int, int] = {}
+        self._event_loop_active = False
+
+    async def get_devices_count(self) -> int:
+        """
+        Asks the recorder for the number of its Kinects, called before the event loop is started
+        """
+        await self._websocket.send(json.dumps({"type": "get_devices"}))
+        msg = json.loads(await self._websocket.recv())
+        cmd_report = msg.get("cmd_report", {})
+        if cmd_report.get("cmd") != "get_devices" or cmd_report.get("result") != "OK":
+            # Older recorders reply to the unknown command with an error
+            return 1
+        return msg["devices"]
+
+    def add_comm(self, device: int, comm: RecorderComm):
+        self._comms[device] = comm
+
+    async def event_loop(self):
+        self._event_loop_active = True
+        while self._event_loop_active:
+            try:
+                msg = await self._websocket.recv()
+            except websockets.ConnectionClosed:
+                await self.close()
+                return
+            if isinstance(msg, str):
+                msg_text = msg
+                msg = json.loads(msg_text)
+                device = msg.get("device", 0)
+                self._track_streams(device, msg)
+                comm = self._comms.get(device)
+                if comm is None:
+                    logger.error(f"Received '{msg['type']}' of the unknown device {device}, ignoring...")
+                else:
+                    comm.process_json_message(msg, msg_text)
+            else:
+                device = self._binary_message_device(msg)
+                comm = self._comms.get(device)
+                if comm is None:
+                    logger.error(f"Received a binary message of the unknown device {device}, ignoring...")
+                else:
+                    comm.process_binary_message(msg)
+
+    def _track_streams(self, device: int, msg: dict):
+        if msg["type"] == "collect_file_start" and msg.get("stream_id") is not None:
+            self._stream_devices[msg["stream_id"]] = device
+        elif msg["type"] == "collect_file_end":
+            self._stream_devices.pop(msg.get("stream_id"), None)
+        elif msg.get("cmd_report", {}).get("cmd") == "stop_collect":
+            # Interrupted transfers of the device end without collect_file_end
+            self._stream_devices = {stream_id: stream_device for stream_id, stream_device in
+                                    self._stream_devices.items() if stream_device != device}
+
+    def _binary_message_device(self, msg: bytes) -> int:
+        if RecorderComm.is_preview_packet(msg):
+            # Device index is in the field that was reserved (and zero) before
+            return struct.unpack_from(RecorderComm.PREVIEW_HEADER_FORMAT, msg)[3]
+        if msg[:len(RecorderComm.FILE_CHUNK_MAGIC)] == RecorderComm.FILE_CHUNK_MAGIC and \
+                len(msg) >= RecorderComm.FILE_CHUNK_HEADER_SIZE:
+            _, stream_id = struct.unpack_from(RecorderComm.FILE_CHUNK_HEADER_FORMAT, msg)
+            return self._stream_devices.get(stream_id, 0)
+        # File data of the older recorders, without the chunk header
+        return 0
+
+    async def close(self):
+        self._event_loop_active = False
+        for comm in list(self._comms.values()):
+            await comm.close()
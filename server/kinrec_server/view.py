@@ -9,7 +9,7 @@ import tkinter as tk
 from tkinter import messagebox, filedialog, ttk
 from PIL import Image, ImageTk
 
-from .internal import RecorderState, RecordsEntry, KinectParams
+from .internal import RecorderState, RecordsEntry, KinectParams, PreviewSettings
 from .tk_wrappers import FocusButton, FocusCheckButton, FocusLabelFrame
 
 logger = logging.getLogger("KRS.view")
@@ -30,6 +30,8 @@ class KinRecView(ttk.Frame):
         # Variables to store state of the system
         self._state_template_kinect = "Status: {}\nFree space: {:03d} GB\nBatt. power: {:03d}%{:s}"
         self._state_template_server = "Status: {}"
+        self._state_template_gaps = "\nDropped: {} color, {} depth\nDesync: {}"
+        self._state_template_finalizing = "\nFinalizing: {} recording(s), {} frames left"
         self._recorders = [{
             "state": RecorderState(),
             "button": None,
@@ -137,6 +139,8 @@ class KinRecView(ttk.Frame):
                                         width=self._preview_frame_size[0], height=self._preview_frame_size[1])
         self.preview_image = None
         self.preview_canvas.grid(row=0, column=0, sticky='news', padx=5, pady=5)
+        self.preview_info_label = tk.Label(self.preview_frame, text="", anchor="w")
+        self.preview_info_label.grid(row=1, column=0, sticky='ew', padx=5, pady=1)
 
         self._preview_frame_grid = {"row": 1, "rowspan": 2, "sticky": "news", "padx": 5, "pady": 5}
         self.preview_frame.grid(column=self._n_side_frames + 1, **self._preview_frame_grid)
@@ -352,6 +356,7 @@ class KinRecView(ttk.Frame):
 
                 self.preview_canvas.delete("preview_iamge")
                 self.preview_image = None
+                self.preview_info_label.configure(text="")
 
                 self.parent.geometry("{}x{}".format(*self._get_window_size()))
                 logger.info(f"stopped preview for {recorder_index}")
@@ -372,6 +377,11 @@ class KinRecView(ttk.Frame):
         else:
             self.preview_canvas.itemconfig(self.preview_image, image=self.image_tk)
 
+    def set_preview_info(self, settings: PreviewSettings, rtt: float, frame_size: int):
+        self.preview_info_label.configure(
+            text=f"Scale 1/{settings.color_scale}, JPEG quality {settings.jpeg_quality}, {settings.fps:.1f} FPS | "
+                 f"RTT {rtt * 1000.:.0f} ms, {frame_size / 1024.:.0f} KB/frame")
+
     def update_progressbar(self):
         pass
 
@@ -404,9 +414,15 @@ class KinRecView(ttk.Frame):
             raise ValueError(f"Unknown recorder {recorder_index} status {state.status}")
 
         self._recorders[recorder_index]["button"].configure(text=text)
-        self._recorders[recorder_index]["label"].configure(text=self._state_template_kinect.format(
+        label_text = self._state_template_kinect.format(
             state.status, state.free_space, state.bat_power, ", Plugged" if state.bat_plugged else ""
-        ))
+        )
+        if state.status == "recording" and state.dropped_color is not None:
+            label_text += self._state_template_gaps.format(state.dropped_color, state.dropped_depth, state.desync)
+        if len(state.finalizing) > 0:
+            label_text += self._state_template_finalizing.format(
+                len(state.finalizing), sum(job["frames_left"] for job in state.finalizing))
+        self._recorders[recorder_index]["label"].configure(text=label_text)
 
     # TODO rename to apply_kinect_params_reply
     # TODO add freeze and unfreeze via params
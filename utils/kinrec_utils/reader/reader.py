@@ -5,7 +5,8 @@ from pathlib import Path
 from typing import Union, List, Optional, Tuple, Dict
 from loguru import logger
 
-from .videoscroller import VideoScroller, Uint16Scroller
+from ..timestamp_log import load_timestamp_log
+from .videoscroller import VideoScroller, Uint16Scroller, MjpegScroller, Ffv1DepthScroller, DepthChunkScroller
 from .spatial import KinectSpatialOperator
 
 
@@ -18,8 +19,12 @@ class KinectTimestamps:
     }
 
     def __init__(self, timestamps_path):
-        timestamps = {k: np.asarray(v, dtype=np.int64) for k, v in
-                      json.load(Path(timestamps_path).open()).items()}
+        timestamps_path = Path(timestamps_path)
+        if timestamps_path.suffix == ".bin":
+            timestamps = self.load_binary(timestamps_path)
+        else:
+            timestamps = {k: np.asarray(v, dtype=np.int64) for k, v in
+                          json.load(timestamps_path.open()).items()}
         # If older version, convert it to the new format
         if 'color' in timestamps:
             timestamps = {self.NEWFORMAT_CONVERSION_MAP[k]: v for k, v in timestamps.items() if k in self.NEWFORMAT_CONVERSION_MAP}
@@ -29,6 +34,15 @@ class KinectTimestamps:
             self.timestamps[k[:-5]] = v.astype(np.float64) / (1e6 if k.endswith("usec") else 1e9)
         self.timestamps_offsets = {k: 0. for k, v in self.timestamps.items()}
 
+    @classmethod
+    def load_binary(cls, timestamps_path) -> Dict[str, np.ndarray]:
+        """
+        Memory-maps the binary timestamp log written by the recorder (times.bin), see kinrec_utils.timestamp_log
+        Returns:
+            Dict[str, np.ndarray]: int64 column for each timestamp name
+        """
+        return load_timestamp_log(timestamps_path)
+
     def __getitem__(self, item):
         return self.timestamps[item] + self.timestamps_offsets[item]
 
@@ -52,6 +66,11 @@ class KinectTimestamps:
     def system_received(self):
         return self["system_received"]
 
+    @property
+    def monotonic_pickup(self):
+        # Absent in the recordings made before the pickup time was logged
+        return self["monotonic_pickup"]
+
     def set_offset(self, offset_name, offset):
         self.timestamps[offset_name] += offset
 
@@ -91,8 +110,14 @@ class KinectRecording:
         self.depth_readers = {}
         for kinect_id, kinect_info in self.kinects.items():
             file_prefix = kinect_info['file_prefix']
-            self.color_readers[kinect_id] = VideoScroller(self.color_dir / f"{file_prefix}.mp4", cache_size=cache_size)
-            self.depth_readers[kinect_id] = Uint16Scroller(self.depth_dir / f"{file_prefix}.mp4", cache_size=cache_size)
+            if (self.color_dir / f"{file_prefix}.mjpeg").is_file():
+                # MJPEG pass-through recording
+                self.color_readers[kinect_id] = MjpegScroller(self.color_dir / f"{file_prefix}.mjpeg",
+                                                              cache_size=cache_size)
+            else:
+                self.color_readers[kinect_id] = VideoScroller(self.color_dir / f"{file_prefix}.mp4",
+                                                              cache_size=cache_size)
+            self.depth_readers[kinect_id] = self._open_depth_reader(file_prefix, cache_size)
         if cached_colored_pc:
             self.depthcolor_readers = {}
             for kinect_id, kinect_info in self.kinects.items():
@@ -101,11 +126,24 @@ class KinectRecording:
         else:
             self.depthcolor_readers = None
 
+    def _open_depth_reader(self, file_prefix: str, cache_size: int):
+        # Depth storage backend is determined by the file extension
+        for ext in ["zst", "lz4"]:
+            if (self.depth_dir / f"{file_prefix}.{ext}").is_file():
+                return DepthChunkScroller(self.depth_dir / f"{file_prefix}.{ext}", cache_size=cache_size)
+        if (self.depth_dir / f"{file_prefix}.mkv").is_file():
+            return Ffv1DepthScroller(self.depth_dir / f"{file_prefix}.mkv", cache_size=cache_size)
+        return Uint16Scroller(self.depth_dir / f"{file_prefix}.mp4", cache_size=cache_size)
+
     def load_timestamps(self):
         timestamps = {}
         for kinect_id, kinect_info in self.kinects.items():
             file_prefix = kinect_info['file_prefix']
-            timestamps[kinect_id] = KinectTimestamps(self.rec_dir / f"times/{file_prefix}.json")
+            timestamps_path = self.rec_dir / f"times/{file_prefix}.bin"
+            if not timestamps_path.is_file():
+                # Recorded before the binary timestamp log was introduced
+                timestamps_path = self.rec_dir / f"times/{file_prefix}.json"
+            timestamps[kinect_id] = KinectTimestamps(timestamps_path)
         return timestamps
 
     @staticmethod
@@ -1,8 +1,10 @@
 import numpy as np
+import cv2
+from abc import ABC, abstractmethod
 from videoio import VideoReader, Uint16Reader
 from collections import OrderedDict
 from pathlib import Path
-from typing import Union, Tuple
+from typing import Union, Tuple, Optional
 
 class BaseScroller:
     DataReader = None
@@ -87,3 +89,148 @@ class Uint16Scroller(BaseScroller):
     DataReader = Uint16Reader
 
 
+class Ffv1DepthReader:
+    """
+    Reads uint16 depth frames from the FFV1 (gray16le) recordings, starting from the given frame
+    """
+    def __init__(self, video_path: Union[Path, str], start_frame: int = 0, output_resolution=None):
+        # ffmpeg-python is needed only for the FFV1 recordings
+        import ffmpeg
+        self._ffmpeg = ffmpeg
+        self.video_path = str(video_path)
+        stream_info = next(x for x in ffmpeg.probe(self.video_path)["streams"] if x["codec_type"] == "video")
+        self.resolution = (int(stream_info["width"]), int(stream_info["height"]))
+        fps_num, fps_den = stream_info["avg_frame_rate"].split("/")
+        self.fps = float(fps_num) / float(fps_den) if float(fps_den) > 0 else None
+        self.start_frame = start_frame
+        # Resizing depth would invent the values, frames are always read in the original resolution
+        self.output_resolution = output_resolution
+
+    def __iter__(self):
+        input_params = {}
+        if self.start_frame > 0 and self.fps is not None:
+            # Every frame is a keyframe, so the seek is precise
+            input_params["ss"] = self.start_frame / self.fps
+        process = (
+            self._ffmpeg.input(self.video_path, **input_params)
+            .output("pipe:", format="rawvideo", pix_fmt="gray16le", loglevel="quiet")
+            .run_async(pipe_stdout=True)
+        )
+        frame_size = self.resolution[0] * self.resolution[1] * 2
+        try:
+            while True:
+                data = process.stdout.read(frame_size)
+                if len(data) < frame_size:
+                    break
+                yield np.frombuffer(data, dtype=np.uint16).reshape(self.resolution[1], self.resolution[0])
+        finally:
+            process.stdout.close()
+            process.wait()
+
+
+class Ffv1DepthScroller(BaseScroller):
+    DataReader = Ffv1DepthReader
+
+
+class IndexedBlobScroller(ABC):
+    """
+    Random access reader for the recordings stored as a blob of separately encoded frames
+    + int64 (offset, length) pair per frame (index)
+    """
+    def __init__(self, blob_path: Union[Path, str], index_path: Union[Path, str] = None, cache_size: int = 100):
+        self.blob_path = Path(blob_path)
+        self.index_path = Path(str(blob_path) + ".idx") if index_path is None else Path(index_path)
+        self.index = np.fromfile(self.index_path, dtype=np.int64).reshape(-1, 2)
+        self.blob = np.memmap(self.blob_path, dtype=np.uint8, mode="r")
+        self.frame_cache = OrderedDict()
+        self.frame_cache_max_size = cache_size
+        self._resolution = self.read_resolution()
+        self._empty_frame = self.make_empty_frame()
+
+    def read_resolution(self) -> Tuple[int, int]:
+        if len(self.index) > 0:
+            first_frame = self.decode_frame(0)
+            self.add_to_cache(first_frame, 0)
+            return first_frame.shape[:2][::-1]
+        return 0, 0
+
+    def make_empty_frame(self) -> np.ndarray:
+        return np.zeros(tuple(self.resolution)[::-1] + (3,), dtype=np.uint8)
+
+    @abstractmethod
+    def decode_frame(self, frame_ind: int) -> np.ndarray:
+        pass
+
+    def add_to_cache(self, frame_data: np.ndarray, frame_ind: int):
+        if frame_ind in self.frame_cache:
+            return
+        if len(self.frame_cache) >= self.frame_cache_max_size:
+            self.frame_cache.popitem(last=False)
+        self.frame_cache[frame_ind] = frame_data
+
+    def get_frame(self, query_frame_ind: int):
+        if query_frame_ind in self.frame_cache:
+            self.frame_cache.move_to_end(query_frame_ind)
+            return self.frame_cache[query_frame_ind]
+        if query_frame_ind < 0 or query_frame_ind >= len(self.index):
+            return self._empty_frame.copy()
+        frame = self.decode_frame(query_frame_ind)
+        self.add_to_cache(frame, query_frame_ind)
+        return frame
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def fps(self) -> None:
+        # Frame timing is only available from the timestamps
+        return None
+
+    @property
+    def resolution(self) -> Tuple[int, int]:
+        return self._resolution
+
+
+class MjpegScroller(IndexedBlobScroller):
+    """
+    Random access reader for MJPEG pass-through color recordings (blob of JPEG payloads)
+    """
+    def decode_frame(self, frame_ind: int) -> np.ndarray:
+        offset, length = self.index[frame_ind]
+        frame = cv2.imdecode(np.asarray(self.blob[offset:offset + length]), cv2.IMREAD_COLOR)
+        return frame[:, :, ::-1].copy()
+
+
+class DepthChunkScroller(IndexedBlobScroller):
+    """
+    Random access reader for the depth recordings stored as separately compressed (zstd or lz4) uint16 chunks.
+    The blob header holds the codec and the frame resolution.
+    """
+    MAGIC = b"KRDC"
+    HEADER_SIZE = 16
+
+    def read_resolution(self) -> Tuple[int, int]:
+        header = bytes(self.blob[:self.HEADER_SIZE])
+        if header[:4] != self.MAGIC:
+            raise ValueError(f"{self.blob_path} is not a depth chunk recording")
+        codec = header[4:8].rstrip(b"\0").decode("ascii")
+        # Decompression libraries are optional, only needed for such recordings
+        if codec == "zstd":
+            import zstandard
+            self._decompress = zstandard.ZstdDecompressor().decompress
+        elif codec == "lz4":
+            import lz4.frame
+            self._decompress = lz4.frame.decompress
+        else:
+            raise ValueError(f"Unknown depth chunk codec '{codec}'")
+        self.codec = codec
+        width, height = np.frombuffer(header[8:16], dtype=np.uint32)
+        return int(width), int(height)
+
+    def make_empty_frame(self) -> np.ndarray:
+        return np.zeros(tuple(self.resolution)[::-1], dtype=np.uint16)
+
+    def decode_frame(self, frame_ind: int) -> np.ndarray:
+        offset, length = self.index[frame_ind]
+        data = self._decompress(self.blob[offset:offset + length])
+        return np.frombuffer(data, dtype=np.uint16).reshape(self._resolution[1], self._resolution[0])
@@ -0,0 +1,35 @@
+import os
+import numpy as np
+from pathlib import Path
+from typing import Union, Dict
+
+# Binary timestamp log of the recorder (times.bin): magic, format version, number of columns (uint16 each)
+# and the null-padded column names, followed by the fixed-width rows of int64 columns, one row per frame.
+# Only numpy is imported here, the recorder writes the log with the same constants.
+MAGIC = b"KRTS"
+VERSION = 1
+NAME_SIZE = 32
+
+
+def load_timestamp_log(path: Union[Path, str]) -> Dict[str, np.ndarray]:
+    """
+    Memory-maps the binary timestamp log written by the recorder
+    Returns:
+        Dict[str, np.ndarray]: int64 column for each timestamp name
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a timestamp log")
+        version, fields_count = np.frombuffer(f.read(4), dtype=np.uint16)
+        if version != VERSION:
+            raise ValueError(f"Unsupported timestamp log version {version}")
+        fields = [f.read(NAME_SIZE).rstrip(b"\0").decode("ascii") for _ in range(fields_count)]
+    header_size = len(MAGIC) + 4 + NAME_SIZE * fields_count
+    row_size = 8 * fields_count
+    # The last row may be incomplete if the recording was interrupted
+    rows_count = (os.path.getsize(path) - header_size) // row_size
+    if rows_count == 0:
+        return {field: np.zeros(0, dtype=np.int64) for field in fields}
+    rows = np.memmap(path, dtype=np.int64, mode="r", offset=header_size, shape=(rows_count, fields_count))
+    return {field: rows[:, ind] for ind, field in enumerate(fields)}